@@ -0,0 +1,36 @@
+# accounts/firebase.py
+
+"""
+Lazy access to the Firebase Admin SDK.
+
+Importing firebase_admin and loading the service account takes a few
+hundred milliseconds and needs the credentials file, so it is done on the
+first call of get_auth() instead of when Django starts. Management
+commands, tests and workers that never touch Firebase users skip it
+entirely.
+"""
+
+import threading
+
+from django.conf import settings
+
+_lock = threading.Lock()
+
+
+def get_app():
+    """The default Firebase app, initialised from FIREBASE_CREDENTIALS on first use."""
+    import firebase_admin
+
+    if not firebase_admin._apps:
+        with _lock:
+            if not firebase_admin._apps:
+                from firebase_admin import credentials
+                firebase_admin.initialize_app(credentials.Certificate(settings.FIREBASE_CREDENTIALS))
+    return firebase_admin.get_app()
+
+
+def get_auth():
+    """The firebase_admin.auth module, with the default app initialised."""
+    get_app()
+    from firebase_admin import auth
+    return auth
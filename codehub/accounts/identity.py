@@ -0,0 +1,187 @@
+# accounts/identity.py
+
+"""
+Client for the Firebase Identity Toolkit REST API (password sign-in).
+
+All requests go through one keep-alive requests.Session per process, so a
+login reuses an open TLS connection instead of doing a new handshake.
+Every call has connect and read timeouts; connection failures and
+overload answers (429/5xx) are retried a few times with backoff, but a
+slow answer is not, so a login never waits much longer than
+FIREBASE_AUTH_READ_TIMEOUT.
+
+A circuit breaker stops calling Firebase for FIREBASE_AUTH_BREAKER_RESET
+seconds after FIREBASE_AUTH_BREAKER_THRESHOLD failures in a row; logins
+then fail straight away instead of each tying up a worker until its
+timeout. After the pause one trial request is let through, and its
+outcome closes or reopens the breaker.
+"""
+
+import threading
+import time
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from shared import metrics
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class AuthError(Exception):
+    """Base class of sign-in failures."""
+
+
+class InvalidCredentials(AuthError):
+    """Firebase rejected the email or password; message is its error code."""
+
+
+class AuthUnavailable(AuthError):
+    """Firebase could not be reached, answered with an error, or the breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failures and refuses calls for reset_after seconds
+    once there are threshold of them. Shared by all threads of a process.
+    """
+
+    def __init__(self, threshold, reset_after, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None and self.clock() - self._opened_at < self.reset_after
+
+    def allow(self):
+        """
+        Return True if a call may go ahead. Once the pause is over, only one
+        trial call is allowed until it reports back.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self.clock() - self._opened_at < self.reset_after or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.threshold:
+                self._opened_at = self.clock()
+            self._trial = False
+
+
+class IdentityClient:
+    """Password sign-in against one Identity Toolkit endpoint."""
+
+    def __init__(self, base_url, api_key, connect_timeout=3.0, read_timeout=5.0,
+                 retries=2, pool_size=10, breaker=None):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker or CircuitBreaker(threshold=5, reset_after=30)
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0, # A slow answer is not retried; the timeout is the budget
+            status=retries,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None, # Sign-in has no side effects, POST included
+            backoff_factor=0.2,
+            backoff_max=2,
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        self.session = requests.Session()
+        self.session.mount(self.base_url, HTTPAdapter(pool_maxsize=pool_size, max_retries=retry))
+
+    def sign_in_with_password(self, email, password):
+        """
+        Return the Firebase response (with 'localId', 'idToken', ...) for a
+        valid email and password. Raises InvalidCredentials or
+        AuthUnavailable.
+        """
+        if not self.breaker.allow():
+            raise AuthUnavailable("The authentication service is unavailable.")
+        try:
+            with metrics.span('firebase'):
+                response = self.session.post(
+                    f'{self.base_url}/accounts:signInWithPassword',
+                    params={'key': self.api_key},
+                    json={'email': email, 'password': password, 'returnSecureToken': True},
+                    timeout=self.timeout,
+                )
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            self.breaker.failure()
+            raise AuthUnavailable("Network error. Could not connect to authentication service.")
+        except BaseException:
+            # Anything else (an error requests does not wrap, a cancelled
+            # request) still counts, or a trial call would never report back
+            # and the breaker would refuse every later sign-in
+            self.breaker.failure()
+            raise
+
+        if response.status_code == 200:
+            self.breaker.success()
+            return data
+        if response.status_code >= 500 or response.status_code == 429:
+            self.breaker.failure()
+            raise AuthUnavailable("The authentication service is unavailable.")
+
+        # Wrong credentials mean Firebase itself is fine
+        self.breaker.success()
+        error = data.get('error', {}) if isinstance(data, dict) else {}
+        raise InvalidCredentials(error.get('message', "Invalid credentials."))
+
+    async def asign_in_with_password(self, email, password):
+        """
+        Async variant of sign_in_with_password. The call runs in a worker
+        thread of its own rather than the shared thread sync code uses
+        under ASGI, so a slow Firebase does not hold up other requests.
+        """
+        return await sync_to_async(self.sign_in_with_password, thread_sensitive=False)(email, password)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The process-wide IdentityClient configured from settings."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = IdentityClient(
+                    settings.FIREBASE_AUTH_URL,
+                    settings.FIREBASE_WEB_API_KEY,
+                    connect_timeout=settings.FIREBASE_AUTH_CONNECT_TIMEOUT,
+                    read_timeout=settings.FIREBASE_AUTH_READ_TIMEOUT,
+                    retries=settings.FIREBASE_AUTH_RETRIES,
+                    pool_size=settings.FIREBASE_AUTH_POOL_SIZE,
+                    breaker=CircuitBreaker(
+                        settings.FIREBASE_AUTH_BREAKER_THRESHOLD,
+                        settings.FIREBASE_AUTH_BREAKER_RESET,
+                    ),
+                )
+    return _client
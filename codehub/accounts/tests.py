@@ -1,3 +1,278 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import urllib3
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from shared import mailqueue, ratelimit
+from shared.tests import StubSMTPServer
+
+from . import identity
+
+
+class StubIdentityToolkit(BaseHTTPRequestHandler):
+    """
+    Stands in for the Identity Toolkit endpoint. The server's 'script' is a
+    list of (status, body, delay) answers, one per request; the last one
+    repeats.
+    """
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.requests.append(body)
+            status, answer, delay = server.script[min(len(server.requests), len(server.script)) - 1]
+        time.sleep(delay)
+        data = json.dumps(answer).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except OSError:
+            pass # The client gave up waiting
+
+    def log_message(self, *args):
+        pass
+
+
+SIGNED_IN = (200, {'localId': 'uid-1', 'idToken': 'token'}, 0)
+WRONG_PASSWORD = (400, {'error': {'message': 'INVALID_LOGIN_CREDENTIALS'}}, 0)
+UNAVAILABLE = (503, {'error': {'message': 'UNAVAILABLE'}}, 0)
+SLOW = (200, {'localId': 'uid-1'}, 2)
+
+
+class StubServerMixin:
+    def start_stub(self, *script):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubIdentityToolkit)
+        server.daemon_threads = True
+        server.lock = threading.Lock()
+        server.requests = []
+        server.script = list(script)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def make_client(self, server, **options):
+        options.setdefault('read_timeout', 0.5)
+        return identity.IdentityClient(f'http://127.0.0.1:{server.server_port}/v1', 'test-key', **options)
+
+
+class IdentityClientTests(StubServerMixin, SimpleTestCase):
+
+    def test_sign_in(self):
+        server = self.start_stub(SIGNED_IN)
+        data = self.make_client(server).sign_in_with_password('a@example.com', 'secret')
+        self.assertEqual(data['localId'], 'uid-1')
+        self.assertEqual(server.requests[0]['email'], 'a@example.com')
+
+    def test_wrong_password(self):
+        server = self.start_stub(WRONG_PASSWORD)
+        client = self.make_client(server)
+        with self.assertRaisesMessage(identity.InvalidCredentials, 'INVALID_LOGIN_CREDENTIALS'):
+            client.sign_in_with_password('a@example.com', 'wrong')
+        self.assertEqual(len(server.requests), 1)
+        self.assertFalse(client.breaker.is_open)
+
+    def test_overload_is_retried(self):
+        server = self.start_stub(UNAVAILABLE, UNAVAILABLE, SIGNED_IN)
+        data = self.make_client(server, retries=2).sign_in_with_password('a@example.com', 'secret')
+        self.assertEqual(data['localId'], 'uid-1')
+        self.assertEqual(len(server.requests), 3)
+
+    def test_slow_answer_times_out_without_retry(self):
+        server = self.start_stub(SLOW)
+        client = self.make_client(server, read_timeout=0.3)
+        started = time.monotonic()
+        with self.assertRaises(identity.AuthUnavailable):
+            client.sign_in_with_password('a@example.com', 'secret')
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_connection_reuse(self):
+        server = self.start_stub(SIGNED_IN)
+        client = self.make_client(server)
+        client.sign_in_with_password('a@example.com', 'secret')
+        client.sign_in_with_password('a@example.com', 'secret')
+        pool = next(iter(client.session.adapters[client.base_url].poolmanager.pools._container.values()))
+        self.assertEqual(pool.num_connections, 1)
+
+    def test_breaker_opens_and_recovers(self):
+        server = self.start_stub(UNAVAILABLE, UNAVAILABLE, SIGNED_IN)
+        now = [0.0]
+        breaker = identity.CircuitBreaker(threshold=2, reset_after=30, clock=lambda: now[0])
+        client = self.make_client(server, retries=0, breaker=breaker)
+
+        for _ in range(2):
+            with self.assertRaises(identity.AuthUnavailable):
+                client.sign_in_with_password('a@example.com', 'secret')
+        self.assertTrue(breaker.is_open)
+
+        # Open: fails without calling Firebase
+        with self.assertRaises(identity.AuthUnavailable):
+            client.sign_in_with_password('a@example.com', 'secret')
+        self.assertEqual(len(server.requests), 2)
+
+        # After the pause one trial call goes through and closes it again
+        now[0] = 31
+        self.assertEqual(client.sign_in_with_password('a@example.com', 'secret')['localId'], 'uid-1')
+        self.assertFalse(breaker.is_open)
+
+    def test_failed_trial_reopens_breaker(self):
+        now = [0.0]
+        breaker = identity.CircuitBreaker(threshold=1, reset_after=30, clock=lambda: now[0])
+        breaker.failure()
+        now[0] = 31
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow()) # Only one trial at a time
+        breaker.failure()
+        self.assertTrue(breaker.is_open)
+
+    def test_unexpected_error_in_trial_reopens_breaker(self):
+        server = self.start_stub(SIGNED_IN)
+        now = [0.0]
+        breaker = identity.CircuitBreaker(threshold=1, reset_after=30, clock=lambda: now[0])
+        client = self.make_client(server, breaker=breaker)
+        breaker.failure()
+
+        now[0] = 31
+        with mock.patch.object(client.session, 'post', side_effect=urllib3.exceptions.ProtocolError('reset')):
+            with self.assertRaises(urllib3.exceptions.ProtocolError):
+                client.sign_in_with_password('a@example.com', 'secret')
+        self.assertTrue(breaker.is_open) # Not stuck waiting for the trial
+
+        now[0] = 62
+        self.assertEqual(client.sign_in_with_password('a@example.com', 'secret')['localId'], 'uid-1')
+        self.assertFalse(breaker.is_open)
+
+    def test_async_sign_in(self):
+        server = self.start_stub(SIGNED_IN)
+        client = self.make_client(server)
+
+        async def sign_in_twice():
+            return await asyncio.gather(
+                client.asign_in_with_password('a@example.com', 'secret'),
+                client.asign_in_with_password('b@example.com', 'secret'),
+            )
+
+        results = asyncio.run(sign_in_twice())
+        self.assertEqual([data['localId'] for data in results], ['uid-1', 'uid-1'])
+
+
+class LoginViewTests(StubServerMixin, TestCase):
+
+    def login(self, server, password='secret'):
+        url = f'http://127.0.0.1:{server.server_port}/v1'
+        with override_settings(FIREBASE_AUTH_URL=url, FIREBASE_WEB_API_KEY='test-key'):
+            identity._client = None
+            self.addCleanup(setattr, identity, '_client', None)
+            return self.client.post('/accounts/login/', {'email': 'a@example.com', 'password': password})
+
+    def test_login(self):
+        User.objects.create_user(username='uid-1')
+        response = self.login(self.start_stub(SIGNED_IN))
+        self.assertRedirects(response, '/core/dashboard/', fetch_redirect_response=False)
+        self.assertEqual(self.client.session['_auth_user_id'], str(User.objects.get(username='uid-1').pk))
+
+    def test_wrong_password(self):
+        response = self.login(self.start_stub(WRONG_PASSWORD), password='wrong')
+        self.assertContains(response, 'INVALID_LOGIN_CREDENTIALS')
+
+    def test_unknown_user(self):
+        response = self.login(self.start_stub(SIGNED_IN))
+        self.assertContains(response, 'User not found in our system')
+
+
+class SendOtpViewTests(SimpleTestCase):
+
+    def test_answers_without_waiting_for_smtp(self):
+        server = StubSMTPServer(data_delay=1)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        firebase_auth = mock.Mock()
+        firebase_auth.get_user_by_email.return_value.uid = 'uid-1'
+        smtp = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1', EMAIL_PORT=server.server_address[1], EMAIL_USE_TLS=False,
+            EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', EMAIL_DEAD_LETTER_FILE=None,
+        )
+        with smtp, mock.patch('accounts.firebase.get_auth', return_value=firebase_auth):
+            mailqueue._queue = None
+            self.addCleanup(setattr, mailqueue, '_queue', None)
+
+            started = time.monotonic()
+            response = self.client.post('/accounts/api/send-otp/', {'email': 'a@example.com'})
+            elapsed = time.monotonic() - started
+
+            self.assertTrue(response.json()['success'])
+            self.assertLess(elapsed, 0.5)
+            self.assertTrue(mailqueue.get_queue().flush(5))
+
+        self.assertEqual(len(server.messages), 1)
+        self.assertIn(f"Your OTP code is: {self.client.session['reset_otp']}", server.messages[0])
+
+
+@override_settings(RATELIMIT_RATES={'otp-check': '3/m'}, EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class CheckOtpRateLimitTests(SimpleTestCase):
+
+    def setUp(self):
+        ratelimit._backend = None
+        self.addCleanup(setattr, ratelimit, '_backend', None)
+        mailqueue._queue = None
+        self.addCleanup(setattr, mailqueue, '_queue', None)
+
+        firebase_auth = mock.Mock()
+        firebase_auth.get_user_by_email.return_value.uid = 'uid-1'
+        with mock.patch('accounts.firebase.get_auth', return_value=firebase_auth):
+            response = self.client.post('/accounts/api/send-otp/', {'email': 'victim@example.com'})
+        self.assertTrue(response.json()['success'])
+        mailqueue.get_queue().flush(5)
+
+    def test_guesses_are_limited_whatever_email_is_posted(self):
+        # A new address and a new email with every guess: only the code's
+        # own address (from the session) can tell the guesses apart
+        statuses = [
+            self.client.post(
+                '/accounts/api/check-otp/', {'otp': '000000', 'email': f'other{number}@example.com'},
+                REMOTE_ADDR=f'10.0.0.{number}',
+            ).status_code
+            for number in range(5)
+        ]
+        self.assertEqual(statuses, [200, 200, 200, 429, 429])
+
+
+@mock.patch('accounts.firebase.get_auth', side_effect=ValueError('Invalid certificate'))
+class FirebaseUnavailableTests(SimpleTestCase):
+    """A broken credentials file fails each view the way its other errors do."""
+
+    def setUp(self):
+        ratelimit._backend = None
+        self.addCleanup(setattr, ratelimit, '_backend', None)
+
+    def test_send_otp(self, get_auth):
+        response = self.client.post('/accounts/api/send-otp/', {'email': 'a@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'success': False, 'message': 'An error occurred: Invalid certificate'})
+
+    def test_register(self, get_auth):
+        response = self.client.post('/accounts/register/', {'username': 'a', 'email': 'a@example.com', 'password': 'secret'})
+        self.assertContains(response, 'Invalid certificate')
+
+    def test_finalize_reset(self, get_auth):
+        session = self.client.session
+        session.update({'otp_verified': True, 'reset_uid': 'uid-1'})
+        session.save()
+        self.client.cookies['sessionid'] = session.session_key
+        response = self.client.post('/accounts/api/finalize-reset/', {'new_password': 'secret2'})
+        self.assertFalse(response.json()['success'])
+        self.assertIn('Invalid certificate', response.json()['message'])
@@ -1,19 +1,23 @@
 from django.shortcuts import render, redirect
 
 # Create your views here.
-from django.contrib.auth import login, logout
+from django.contrib.auth import alogin, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User # Using Django's User for sessions
-import requests
-import os # Import os to access environment variables
+from asgiref.sync import sync_to_async
 import random
 import time
-from django.core.mail import send_mail
+from shared.mailqueue import send_mail
+from shared.ratelimit import ratelimit
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.urls import reverse
-# Firebase Admin SDK (if you still need it for user creation)
-from firebase_admin import auth
+# Firebase Admin SDK (if you still need it for user creation), loaded on first use
+from . import firebase, identity
+
+# Templates can touch the database (request.user), so async views render
+# them in a thread
+arender = sync_to_async(render)
 
 def generate_otp(length=6):
     """Generates a random 6-digit OTP."""
@@ -27,6 +31,7 @@ def register_view(request):
 
         try:
             # 1. Create user in Firebase
+            auth = firebase.get_auth()
             user_record = auth.create_user(
                 email=email,
                 password=password,
@@ -42,40 +47,32 @@ def register_view(request):
 
     return render(request, "registration.html")
 
-def login_view(request):
+async def login_view(request):
+    """
+    Signs in with Firebase, then logs into the matching Django user.
+    Async so that under ASGI a slow Firebase only holds up this request.
+    """
     if request.method == "POST":
         email = request.POST.get("email")
         password = request.POST.get("password")
 
-        # Get the API key securely from the environment variables
-        api_key = os.getenv("FIREBASE_WEB_API_KEY")
-        rest_api_url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={api_key}"
-
-        payload = {"email": email, "password": password, "returnSecureToken": True}
+        try:
+            response_data = await identity.get_client().asign_in_with_password(email, password)
+        except identity.AuthError as e:
+            # The login failed, show the error from Firebase
+            return await arender(request, "login.html", {"error": str(e)})
 
+        # User is authenticated with Firebase, now log them into Django
+        uid = response_data.get("localId")
         try:
-            response = requests.post(rest_api_url, json=payload)
-            response_data = response.json()
-
-            if response.status_code == 200:
-                # User is authenticated with Firebase, now log them into Django
-                uid = response_data.get("localId")
-                try:
-                    # Find the corresponding Django user by the UID we stored as username
-                    user = User.objects.get(username=uid)
-                    login(request, user) # This creates the session
-                    return redirect("dashboard")
-                except User.DoesNotExist:
-                    return render(request, "login.html", {"error": "User not found in our system. Please register."})
-            else:
-                # The login failed, show the error from Firebase
-                error_message = response_data.get("error", {}).get("message", "Invalid credentials.")
-                return render(request, "login.html", {"error": error_message})
-
-        except requests.exceptions.RequestException:
-            return render(request, "login.html", {"error": "Network error. Could not connect to authentication service."})
-
-    return render(request, "login.html")
+            # Find the corresponding Django user by the UID we stored as username
+            user = await User.objects.aget(username=uid)
+        except User.DoesNotExist:
+            return await arender(request, "login.html", {"error": "User not found in our system. Please register."})
+        await alogin(request, user) # This creates the session
+        return redirect("dashboard")
+
+    return await arender(request, "login.html")
 
 @login_required(login_url='/accounts/login/')
 def profile_view(request):
@@ -94,7 +91,24 @@ def forgot_password_view(request):
     """
     return render(request, 'forgotpassword.html')
 
+def _email_key(email):
+    return f"email:{email.strip().lower()}" if email else None
+
+def _requested_email(request):
+    """Rate limit key for the address a reset code is sent to."""
+    return _email_key(request.POST.get('email'))
+
+def _session_email(request):
+    """
+    Rate limit key for the address a code is checked for. Only the session
+    counts: it holds the code, so a posted email would just let every guess
+    pick a fresh bucket.
+    """
+    return _email_key(request.session.get('reset_email'))
+
 @csrf_exempt
+@ratelimit('otp-send', key='ip')
+@ratelimit('otp-send-email', key=_requested_email)
 def send_otp_view(request):
     """
     Handles the POST request from forgotpassword.html.
@@ -105,6 +119,11 @@ def send_otp_view(request):
         if not email:
             return JsonResponse({'success': False, 'message': 'Email is required.'})
 
+        try:
+            auth = firebase.get_auth()
+        except Exception as e:
+            # Missing or invalid credentials: answer in JSON like every other failure
+            return JsonResponse({'success': False, 'message': f'An error occurred: {str(e)}'})
         try:
             # 1. Find the user in FIREBASE AUTH (the 'codehubdebug' way)
             user = auth.get_user_by_email(email)
@@ -116,13 +135,12 @@ def send_otp_view(request):
             request.session['reset_email'] = email
             request.session['reset_uid'] = user.uid # Store the Firebase UID!
 
-            # 3. Send the email with the OTP
+            # 3. Queue the email with the OTP; it is sent in the background
             send_mail(
                 'Your CodeHub Password Reset Code',
                 f'Your OTP code is: {otp}\nIt will expire in 5 minutes.',
                 'noreply@codehub.com', # Configure this in settings.py
                 [email],
-                fail_silently=False,
             )
             
             # 4. Redirect to the 'verify_otp' page
@@ -149,6 +167,8 @@ def verify_otp_view(request):
 
 # STEP 2b: API TO CHECK THE OTP
 @csrf_exempt
+@ratelimit('otp-check', key='ip')
+@ratelimit('otp-check', key=_session_email)
 def check_otp_view(request):
     """
     Handles the POST request from verify_otp.html.
@@ -210,7 +230,7 @@ def finalize_reset_view(request):
         try:
             # THIS IS THE KEY:
             # Use Firebase Admin SDK to update the password in Firebase Auth
-            auth.update_user(uid, password=new_password)
+            firebase.get_auth().update_user(uid, password=new_password)
             
             # Clear all reset-related session keys
             request.session.pop('reset_otp', None)
@@ -3,6 +3,10 @@ ASGI config for codehub project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serving through this module (e.g. ``uvicorn codehub.asgi:application``) lets
+the streaming run-code endpoint (/core/api/run-code/stream/) send output
+asynchronously with backpressure instead of tying up a thread per stream.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
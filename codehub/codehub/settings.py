@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 import dotenv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -47,11 +48,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shared.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'shared.ratelimit.RateLimitMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -79,12 +82,59 @@ WSGI_APPLICATION = 'codehub.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE selects the backend: 'sqlite' (default) or 'postgresql'.
+
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    # Several gunicorn workers writing at once: use PostgreSQL, either with
+    # a psycopg connection pool per worker (DB_POOL=True) or with
+    # persistent connections kept for DB_CONN_MAX_AGE seconds. Django does
+    # not allow both at the same time.
+    DB_POOL = os.getenv('DB_POOL', 'True') == 'True'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'codehub'),
+            'USER': os.getenv('DB_USER', 'codehub'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            'CONN_MAX_AGE': 0 if DB_POOL else int(os.getenv('DB_CONN_MAX_AGE', '60')),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '5')),
+            },
+        }
+    }
+    if DB_POOL:
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+            'timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+        }
+else:
+    # SQLite allows a single writer. WAL lets readers carry on while a file
+    # is saved, synchronous=NORMAL is safe with WAL and avoids an fsync per
+    # commit, and IMMEDIATE transactions take the write lock up front so a
+    # busy database makes writers wait (up to DB_TIMEOUT seconds) instead of
+    # failing with "database is locked" halfway through a transaction.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                'timeout': int(os.getenv('DB_TIMEOUT', '20')),
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA temp_store=MEMORY;'
+                    'PRAGMA cache_size=-20000;'
+                ),
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -118,6 +168,43 @@ USE_I18N = True
 USE_TZ = True
 
 
+# Caches
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Results of deterministic run-code submissions (see RUN_CODE_RESULT_CACHE)
+    'run_code': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'run-code-results',
+        'TIMEOUT': int(os.getenv('RUN_CODE_RESULT_CACHE_TTL', '600')),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('RUN_CODE_RESULT_CACHE_ENTRIES', '500'))},
+    },
+    # Plots produced by code runs, served from /core/api/artifacts/<id>/.
+    # The plot is usually fetched from another server process than the one
+    # that ran the code, so this must be shared by all of them: files on
+    # this host, or Redis when several hosts serve the site
+    'artifacts': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv(
+            'RUN_CODE_ARTIFACT_DIR', os.path.join(tempfile.gettempdir(), 'codehub-artifacts')
+        ),
+        'TIMEOUT': int(os.getenv('RUN_CODE_ARTIFACT_TTL', '300')),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('RUN_CODE_ARTIFACT_ENTRIES', '1000'))},
+    },
+    # Highlighted file contents, keyed by content hash (see core.highlight).
+    # A shared backend lets every server process reuse one rendering.
+    'highlight': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'highlighted-files',
+        'TIMEOUT': int(os.getenv('HIGHLIGHT_CACHE_TTL', str(24 * 60 * 60))),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('HIGHLIGHT_CACHE_ENTRIES', '5000'))},
+    },
+}
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
@@ -140,6 +227,23 @@ SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
 SESSION_COOKIE_SECURE = True            # Only send over HTTPS
 SESSION_COOKIE_HTTPONLY = True          # Prevent JavaScript access
 SESSION_COOKIE_SAMESITE = 'Strict'      # CSRF protection
+# --- FIREBASE AUTHENTICATION ---
+# Service account for the Admin SDK (user management); loaded on first use
+FIREBASE_CREDENTIALS = os.getenv('FIREBASE_CREDENTIALS', str(BASE_DIR / 'firebase_credentials.json'))
+# Password sign-in goes through the Identity Toolkit REST API (accounts.identity)
+FIREBASE_WEB_API_KEY = os.getenv('FIREBASE_WEB_API_KEY')
+FIREBASE_AUTH_URL = os.getenv('FIREBASE_AUTH_URL', 'https://identitytoolkit.googleapis.com/v1')
+# Seconds to wait for a connection and for the answer; a slow answer is not retried
+FIREBASE_AUTH_CONNECT_TIMEOUT = float(os.getenv('FIREBASE_AUTH_CONNECT_TIMEOUT', '3'))
+FIREBASE_AUTH_READ_TIMEOUT = float(os.getenv('FIREBASE_AUTH_READ_TIMEOUT', '5'))
+# Retries for failed connections and 429/5xx answers
+FIREBASE_AUTH_RETRIES = int(os.getenv('FIREBASE_AUTH_RETRIES', '2'))
+# Keep-alive connections per process
+FIREBASE_AUTH_POOL_SIZE = int(os.getenv('FIREBASE_AUTH_POOL_SIZE', '10'))
+# After this many failures in a row, logins fail fast for FIREBASE_AUTH_BREAKER_RESET seconds
+FIREBASE_AUTH_BREAKER_THRESHOLD = int(os.getenv('FIREBASE_AUTH_BREAKER_THRESHOLD', '5'))
+FIREBASE_AUTH_BREAKER_RESET = float(os.getenv('FIREBASE_AUTH_BREAKER_RESET', '30'))
+
 # --- EMAIL CONFIGURATION FOR PASSWORD RESET ---
 # This setup is for Gmail.
 # IMPORTANT: You MUST add EMAIL_HOST_USER and EMAIL_HOST_PASSWORD to your .env file
@@ -154,3 +258,117 @@ EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER') # Your Gmail address, e.g., 'your-email@gmail.com'
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD') # Your Gmail "App Password"
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+# Seconds before a stalled SMTP connection is given up on
+EMAIL_TIMEOUT = float(os.getenv('EMAIL_TIMEOUT', '10'))
+# Mail is delivered in the background by shared.mailqueue
+EMAIL_QUEUE_MAX_SIZE = int(os.getenv('EMAIL_QUEUE_MAX_SIZE', '1000'))
+EMAIL_QUEUE_MAX_ATTEMPTS = int(os.getenv('EMAIL_QUEUE_MAX_ATTEMPTS', '5'))
+# Seconds before the first retry, doubled for every further attempt
+EMAIL_QUEUE_RETRY_DELAY = float(os.getenv('EMAIL_QUEUE_RETRY_DELAY', '2'))
+EMAIL_QUEUE_RETRY_MAX_DELAY = float(os.getenv('EMAIL_QUEUE_RETRY_MAX_DELAY', '300'))
+# Close the SMTP connection after this many seconds without mail
+EMAIL_QUEUE_IDLE_CLOSE = float(os.getenv('EMAIL_QUEUE_IDLE_CLOSE', '30'))
+# Seconds a stopping process waits for queued mail
+EMAIL_QUEUE_SHUTDOWN_TIMEOUT = float(os.getenv('EMAIL_QUEUE_SHUTDOWN_TIMEOUT', '10'))
+# Messages that could not be delivered are logged here, one JSON object per line
+EMAIL_DEAD_LETTER_FILE = os.getenv('EMAIL_DEAD_LETTER_FILE', str(BASE_DIR / 'mail-dead-letter.jsonl'))
+
+# --- PYTHON EXECUTION ENGINE ---
+# Code from the run-code API runs in a pool of pre-warmed worker processes.
+# Jobs beyond RUN_CODE_WORKERS wait in a queue of RUN_CODE_QUEUE_SIZE slots;
+# when that is full the API answers 503 instead of tying up a web worker.
+RUN_CODE_WORKERS = int(os.getenv('RUN_CODE_WORKERS', os.cpu_count() or 2))
+RUN_CODE_QUEUE_SIZE = int(os.getenv('RUN_CODE_QUEUE_SIZE', '16'))
+RUN_CODE_QUEUE_TIMEOUT = float(os.getenv('RUN_CODE_QUEUE_TIMEOUT', '5'))    # seconds waiting for a worker
+RUN_CODE_TIMEOUT = float(os.getenv('RUN_CODE_TIMEOUT', '15'))               # wall-clock seconds per job
+RUN_CODE_CPU_SECONDS = int(os.getenv('RUN_CODE_CPU_SECONDS', '10'))         # CPU seconds per job
+RUN_CODE_MEMORY_MB = int(os.getenv('RUN_CODE_MEMORY_MB', '256'))            # extra memory per job
+RUN_CODE_MAX_JOBS_PER_WORKER = int(os.getenv('RUN_CODE_MAX_JOBS_PER_WORKER', '200'))
+# Programs waiting at input() keep their worker until the next value arrives.
+RUN_CODE_SESSION_IDLE_TIMEOUT = float(os.getenv('RUN_CODE_SESSION_IDLE_TIMEOUT', '120'))  # seconds
+RUN_CODE_MAX_SESSIONS = int(os.getenv('RUN_CODE_MAX_SESSIONS', max(1, RUN_CODE_WORKERS // 2)))
+RUN_CODE_MAX_OUTPUT = int(os.getenv('RUN_CODE_MAX_OUTPUT', '1000000'))     # characters of stdout/stderr per run
+# Opt-in: serve byte-identical, deterministic submissions from the 'run_code' cache
+RUN_CODE_RESULT_CACHE = os.getenv('RUN_CODE_RESULT_CACHE', 'False') == 'True'
+RUN_CODE_RESULT_CACHE_MAX_BYTES = int(os.getenv('RUN_CODE_RESULT_CACHE_MAX_BYTES', '262144'))
+RUN_CODE_CODE_CACHE_SIZE = int(os.getenv('RUN_CODE_CODE_CACHE_SIZE', '128'))  # compiled snippets kept per worker
+# Plots: up to RUN_CODE_MAX_FIGURES per run, rendered as png, svg or webp
+RUN_CODE_MAX_FIGURES = int(os.getenv('RUN_CODE_MAX_FIGURES', '10'))
+RUN_CODE_PLOT_DPI = int(os.getenv('RUN_CODE_PLOT_DPI', '100'))
+RUN_CODE_PLOT_MIN_DPI = 50
+RUN_CODE_PLOT_MAX_DPI = int(os.getenv('RUN_CODE_PLOT_MAX_DPI', '200'))
+RUN_CODE_ARTIFACT_TTL = CACHES['artifacts']['TIMEOUT']
+
+# --- REPOSITORY DOWNLOADS ---
+# zlib level (0-9) used when streaming a repository as a ZIP
+REPO_ARCHIVE_COMPRESSLEVEL = int(os.getenv('REPO_ARCHIVE_COMPRESSLEVEL', '6'))
+# Built archives are kept here and reused until a file of the repository changes
+REPO_ARCHIVE_CACHE_DIR = os.getenv(
+    'REPO_ARCHIVE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'codehub-archives')
+)
+
+# --- FILE STORAGE ---
+# File contents are stored once per distinct content (core.models.Blob);
+# contents of at least BLOB_COMPRESS_MIN_SIZE bytes are zlib-compressed.
+BLOB_COMPRESSION = os.getenv('BLOB_COMPRESSION', 'True') == 'True'
+BLOB_COMPRESS_MIN_SIZE = int(os.getenv('BLOB_COMPRESS_MIN_SIZE', '256'))
+# File history stores deltas between versions, with a full snapshot every
+# REVISION_SNAPSHOT_INTERVAL revisions to bound the cost of rebuilding one
+REVISION_SNAPSHOT_INTERVAL = int(os.getenv('REVISION_SNAPSHOT_INTERVAL', '20'))
+
+# Limits for uploads (single files, several files, ZIP archives, tarballs).
+# Larger and binary files are skipped; exceeding the totals rejects the upload.
+UPLOAD_MAX_FILE_SIZE = int(os.getenv('UPLOAD_MAX_FILE_SIZE', str(1024 * 1024)))
+UPLOAD_MAX_FILES = int(os.getenv('UPLOAD_MAX_FILES', '5000'))
+UPLOAD_MAX_TOTAL_SIZE = int(os.getenv('UPLOAD_MAX_TOTAL_SIZE', str(100 * 1024 * 1024)))
+# Files selected one by one in the upload form count against Django's limit
+DATA_UPLOAD_MAX_NUMBER_FILES = int(os.getenv('DATA_UPLOAD_MAX_NUMBER_FILES', '1000'))
+
+# --- REPOSITORY BROWSING ---
+# Entries per page when listing a folder of a repository
+REPO_TREE_PAGE_SIZE = int(os.getenv('REPO_TREE_PAGE_SIZE', '100'))
+# Repositories per dashboard section, per page of the infinite scroll
+DASHBOARD_PAGE_SIZE = int(os.getenv('DASHBOARD_PAGE_SIZE', '24'))
+# Files are highlighted on the server in chunks of this many lines; the
+# page shows the first chunk and loads the others while scrolling
+HIGHLIGHT_CHUNK_LINES = int(os.getenv('HIGHLIGHT_CHUNK_LINES', '500'))
+# Larger files are shown without highlighting
+HIGHLIGHT_MAX_SIZE = int(os.getenv('HIGHLIGHT_MAX_SIZE', str(512 * 1024)))
+# Any Pygments style name
+HIGHLIGHT_STYLE = os.getenv('HIGHLIGHT_STYLE', 'github-dark')
+
+# --- RATE LIMITING ---
+# Token buckets per client (see shared.ratelimit). 'local' keeps them per
+# process; 'cache' shares them through the RATELIMIT_CACHE cache, which
+# should then be Redis, Memcached or the database
+RATELIMIT_ENABLED = os.getenv('RATELIMIT_ENABLED', 'True') == 'True'
+RATELIMIT_BACKEND = os.getenv('RATELIMIT_BACKEND', 'local')
+RATELIMIT_CACHE = os.getenv('RATELIMIT_CACHE', 'default')
+# Behind a proxy, the META key holding the client address, e.g. HTTP_X_FORWARDED_FOR,
+# and how many proxies in front of Django append to it (the client's own
+# entries are ignored)
+RATELIMIT_IP_HEADER = os.getenv('RATELIMIT_IP_HEADER', '')
+RATELIMIT_PROXY_HOPS = int(os.getenv('RATELIMIT_PROXY_HOPS', '1'))
+# '<count>/<period>' per scope: bursts of up to count, refilled over the period
+RATELIMIT_RATES = {
+    'otp-send': os.getenv('RATELIMIT_OTP_SEND', '5/10m'),
+    'otp-send-email': os.getenv('RATELIMIT_OTP_SEND_EMAIL', '3/10m'),
+    'otp-check': os.getenv('RATELIMIT_OTP_CHECK', '10/10m'),
+    'run-code': os.getenv('RATELIMIT_RUN_CODE', '60/m'),
+}
+# (path regex, scope, key, methods) limits applied by the middleware
+RATELIMIT_RULES = [
+    (r'^/core/api/run-code/', 'run-code', 'user_or_ip', ('POST',)),
+]
+
+# --- METRICS ---
+# Request durations, query counts and span timings (see shared.metrics),
+# served in the Prometheus text format at /metrics
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+# Adds each response's database time and spans as a Server-Timing header
+METRICS_SERVER_TIMING = os.getenv('METRICS_SERVER_TIMING', 'True') == 'True'
+# Scrapers send 'Authorization: Bearer <token>'; without a token, /metrics
+# only answers these addresses (as found by shared.ratelimit.client_ip,
+# so RATELIMIT_IP_HEADER and RATELIMIT_PROXY_HOPS apply behind a proxy)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
@@ -0,0 +1,149 @@
+# core/archives.py
+
+"""
+ZIP export of repositories.
+
+Archives are produced as a stream: each file is compressed and yielded as
+soon as it has been read, so memory use does not grow with the size of the
+repository and the download starts before the last file is compressed.
+
+The first download of a given repository version is also written to
+REPO_ARCHIVE_CACHE_DIR; later downloads of the same version are served from
+that file. Repository.content_version changes whenever a file is saved or
+deleted, so a cached archive is never stale.
+"""
+
+import glob
+import os
+import uuid
+import zipfile
+
+from django.conf import settings
+
+
+class _ZipSink:
+    """
+    Write-only stand-in for a file that collects what ZipFile writes so it
+    can be yielded. ZipFile treats it as unseekable and writes data
+    descriptors after each entry instead of seeking back.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _date_time(value):
+    # ZIP timestamps cannot go before 1980
+    return max(value.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def stream_zip(entries, compresslevel=None):
+    """
+    Yield the bytes of a ZIP archive built from (path, text, modified)
+    tuples, one entry at a time.
+    """
+    if compresslevel is None:
+        compresslevel = settings.REPO_ARCHIVE_COMPRESSLEVEL
+
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zip_file:
+        for path, content, modified in entries:
+            info = zipfile.ZipInfo(path, date_time=_date_time(modified))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            zip_file.writestr(info, (content or '').encode('utf-8'), compresslevel=compresslevel)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    # Central directory, written when the ZipFile closes
+    yield sink.drain()
+
+
+def repository_entries(repo):
+    """
+    Yield (path, text, modified) for every file of a repository, reading
+    the rows in batches rather than loading them all at once.
+    """
+    files = (
+        repo.files.select_related('blob')
+        .only('file_path', 'updated_at', 'blob__data', 'blob__compressed')
+        .order_by('file_path')
+    )
+    for f in files.iterator(chunk_size=100):
+        yield f.file_path, f.content, f.updated_at
+
+
+def stream_repository_zip(repo):
+    return stream_zip(repository_entries(repo))
+
+
+def archive_version(repo):
+    """
+    Identifies the bytes of a repository's archive; used in the cache file
+    name and as the ETag.
+    """
+    return f'{repo.pk}-{repo.content_version}-{settings.REPO_ARCHIVE_COMPRESSLEVEL}'
+
+
+def _cache_path(repo):
+    return os.path.join(settings.REPO_ARCHIVE_CACHE_DIR, f'{archive_version(repo)}.zip')
+
+
+def open_cached_archive(repo):
+    """
+    Return an open binary file with the cached archive of the repository's
+    current version, or None if it has not been built yet.
+    """
+    try:
+        return open(_cache_path(repo), 'rb')
+    except FileNotFoundError:
+        return None
+
+
+def stream_and_cache_repository_zip(repo):
+    """
+    Stream the repository's archive while writing a copy to the cache. The
+    copy is only kept if the whole archive was produced and no file changed
+    in the meantime.
+    """
+    from .models import Repository
+
+    path = _cache_path(repo)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f'{path}.{uuid.uuid4().hex}.part'
+    completed = False
+    try:
+        with open(partial, 'wb') as cache_file:
+            for chunk in stream_repository_zip(repo):
+                cache_file.write(chunk)
+                yield chunk
+        completed = Repository.objects.filter(
+            pk=repo.pk, content_version=repo.content_version,
+        ).exists()
+    finally:
+        if completed:
+            os.replace(partial, path)
+            _remove_older_versions(repo, keep=path)
+        else:
+            os.remove(partial)
+
+
+def _remove_older_versions(repo, keep):
+    pattern = os.path.join(settings.REPO_ARCHIVE_CACHE_DIR, f'{repo.pk}-*.zip')
+    for old in glob.glob(pattern):
+        if old != keep:
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
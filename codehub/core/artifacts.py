@@ -0,0 +1,70 @@
+# core/artifacts.py
+
+"""
+Short-lived store for files produced by code runs (currently plots).
+
+Figures are kept in the 'artifacts' cache under the hash of their bytes and
+served from their own URL, so the run-code JSON only carries links and the
+browser can fetch the images in parallel and cache them. Because the id is
+derived from the content, publishing the same figure twice is harmless and
+the id doubles as the ETag.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.urls import reverse
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'webp': 'image/webp',
+}
+
+
+def publish(result):
+    """
+    Move the raw figures of a run result into the artifact store and replace
+    them with an 'images' list of URLs. Returns the result.
+    """
+    figures = result.pop('figures', None) or []
+    store = caches['artifacts']
+    urls = []
+    for figure in figures:
+        data = figure['data']
+        artifact_id = f"{hashlib.sha256(data).hexdigest()[:32]}.{figure['format']}"
+        store.set(artifact_id, data)
+        urls.append(reverse('artifact', args=[artifact_id]))
+    result['images'] = urls
+    return result
+
+
+def get(artifact_id):
+    """
+    Return (data, content_type) for a stored artifact, or None if it has
+    expired or never existed.
+    """
+    fmt = artifact_id.rpartition('.')[2]
+    if fmt not in CONTENT_TYPES:
+        return None
+    data = caches['artifacts'].get(artifact_id)
+    if data is None:
+        return None
+    return data, CONTENT_TYPES[fmt]
+
+
+def figure_options(data):
+    """
+    Read and validate the plot options of a run-code request: an output
+    format from CONTENT_TYPES and a DPI clamped to the configured range.
+    """
+    fmt = str(data.get('plot_format', 'png')).lower()
+    if fmt not in CONTENT_TYPES:
+        fmt = 'png'
+    try:
+        dpi = int(data.get('dpi', settings.RUN_CODE_PLOT_DPI))
+    except (TypeError, ValueError):
+        dpi = settings.RUN_CODE_PLOT_DPI
+    dpi = max(settings.RUN_CODE_PLOT_MIN_DPI, min(dpi, settings.RUN_CODE_PLOT_MAX_DPI))
+    return {'plot_format': fmt, 'dpi': dpi}
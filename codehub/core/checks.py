@@ -0,0 +1,18 @@
+# core/checks.py
+
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+
+@register(Tags.caches)
+def check_artifact_cache(app_configs, **kwargs):
+    """Plots are fetched in a later request, which another process may serve."""
+    backend = settings.CACHES.get('artifacts', {}).get('BACKEND', '')
+    if backend.endswith(('LocMemCache', 'DummyCache')):
+        return [Warning(
+            "The 'artifacts' cache is local to each server process.",
+            hint="Plot URLs answer 404 when served by another process. Use FileBasedCache, "
+                 "Redis or the database cache unless the site runs in a single process.",
+            id='core.W001',
+        )]
+    return []
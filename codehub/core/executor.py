@@ -0,0 +1,751 @@
+# core/executor.py
+
+"""
+Process pool that runs user-submitted Python code for the run-code API.
+
+Each worker is a long-lived interpreter that imports matplotlib/NumPy once at
+startup, then executes one job at a time with its own CPU-time and memory
+limits. The pool caps how many jobs may be running or waiting, so a burst of
+submissions is rejected early instead of piling up on the web workers.
+"""
+
+import builtins
+import collections
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+
+class PoolBusy(Exception):
+    """Raised when the job queue is full and a job cannot be admitted."""
+
+
+class ExecutionTimeout(Exception):
+    """Raised when a job exceeds its wall-clock limit."""
+
+
+class WorkerCrashed(Exception):
+    """Raised when a worker process dies while running a job."""
+
+
+class OutputLimitExceeded(BaseException):
+    """
+    Raised inside a worker when the job prints more than its output budget.
+    """
+
+
+class CPUTimeExceeded(BaseException):
+    """
+    Raised inside a worker when the job uses up its CPU-time budget.
+    Derives from BaseException so a bare 'except Exception' in user code
+    cannot swallow it.
+    """
+
+
+class _WorkerStopped(BaseException):
+    """
+    Raised inside a worker when the pool stops it or stops listening in the
+    middle of a job (a session closed at input(), a stream the client left),
+    so the job is abandoned without sending a result.
+    """
+
+
+# --- WORKER SIDE (runs inside the child process) ---
+
+class CapturingInput:
+    """
+    A context manager to capture 'input()' calls.
+
+    Values are taken from ``inputs_list`` first. Once it is used up,
+    ``on_exhausted`` is asked for the next value (an interactive session
+    suspends there); without it, EOFError signals that more input is needed.
+    """
+    def __init__(self, inputs_list, current_index, on_exhausted=None):
+        self.inputs_list = inputs_list
+        self.current_index = current_index
+        self.on_exhausted = on_exhausted
+        self._original_input = builtins.input
+        self.prompt = ""
+
+    def __enter__(self):
+        builtins.input = self.mock_input
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        builtins.input = self._original_input
+
+    def mock_input(self, prompt=""):
+        self.prompt = prompt
+        if self.current_index < len(self.inputs_list):
+            value = self.inputs_list[self.current_index]
+            self.current_index += 1
+            return value
+        elif self.on_exhausted is not None:
+            return self.on_exhausted(prompt)
+        else:
+            # Not enough inputs provided, raise an exception to signal for more.
+            raise EOFError("Input required")
+
+
+class CodeCache:
+    """
+    Bounded LRU cache of compiled code objects, keyed by a hash of the
+    source, so a snippet that is run again skips parsing and compiling.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def compile(self, source):
+        key = hashlib.sha256(source.encode('utf-8', 'surrogatepass')).digest()
+        code = self._entries.get(key)
+        if code is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return code
+
+        self.misses += 1
+        code = compile(source, '<string>', 'exec')
+        if self.maxsize:
+            self._entries[key] = code
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return code
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class _RendererPool:
+    """
+    Agg renderers kept by (width, height, dpi) across jobs.
+
+    Saving a figure normally allocates a fresh RendererAgg, whose pixel
+    buffer and text-metrics cache are thrown away with the figure. While
+    active (only inside _render_figures, which saves one figure at a time),
+    canvases borrow a renderer of the right size from here instead.
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.active = False
+        self._renderers = collections.OrderedDict()
+
+    def get(self, key, factory):
+        renderer = self._renderers.pop(key, None)
+        if renderer is None:
+            renderer = factory()
+        self._renderers[key] = renderer
+        if len(self._renderers) > self.maxsize:
+            self._renderers.popitem(last=False)
+        return renderer
+
+    def install(self):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg, RendererAgg
+
+        pool = self
+        original = FigureCanvasAgg.get_renderer
+
+        def get_renderer(canvas):
+            if not pool.active:
+                return original(canvas)
+            w, h = canvas.figure.bbox.size
+            key = w, h, canvas.figure.dpi
+            if canvas._lastKey != key:
+                canvas.renderer = pool.get(key, lambda: RendererAgg(w, h, canvas.figure.dpi))
+                canvas._lastKey = key
+            return canvas.renderer
+
+        FigureCanvasAgg.get_renderer = get_renderer
+
+    @contextlib.contextmanager
+    def lend(self, canvas):
+        """Let one canvas use pooled renderers, then detach it again."""
+        self.active = True
+        try:
+            yield
+        finally:
+            self.active = False
+            # The renderer goes back to the pool; the canvas must not keep it
+            canvas.renderer = None
+            canvas._lastKey = None
+
+
+_renderer_pool = _RendererPool()
+
+
+@contextlib.contextmanager
+def _figure_scope():
+    """
+    Give a job its own pyplot state: no figures left over from an earlier
+    job, and any rcParams or style the job changes rolled back afterwards.
+    """
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    plt.close('all')
+    with matplotlib.rc_context():
+        try:
+            yield
+        finally:
+            plt.close('all')
+
+
+def _warm_up():
+    """
+    Import the heavy libraries and render one throwaway plot so the font
+    cache, text metrics and an Agg renderer of the default size are ready
+    before the first real job arrives.
+    """
+    os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        pass
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    _renderer_pool.install()
+    fig, ax = plt.subplots()
+    ax.plot([0, 1, 2], [0, 1, 4], label='warm-up')
+    ax.set_title('warm-up')
+    ax.legend()
+    with _renderer_pool.lend(fig.canvas):
+        fig.savefig(io.BytesIO(), format='png', bbox_inches='tight')
+    plt.close('all')
+
+
+def _on_cpu_limit(signum, frame):
+    raise CPUTimeExceeded()
+
+
+def _virtual_memory_bytes():
+    """Current address-space size of this process, or 0 if unknown."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmSize:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+@contextlib.contextmanager
+def _job_limits(cpu_seconds, memory_mb):
+    """
+    Apply per-job resource limits on top of what the worker already uses,
+    and lift them again once the job is over.
+    """
+    if resource is None:
+        yield
+        return
+
+    _, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+    _, mem_hard = resource.getrlimit(resource.RLIMIT_AS)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+    if cpu_hard != resource.RLIM_INFINITY:
+        cpu_soft = min(cpu_soft, cpu_hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_soft, cpu_hard))
+
+    if memory_mb:
+        mem_soft = _virtual_memory_bytes() + memory_mb * 1024 * 1024
+        if mem_hard != resource.RLIM_INFINITY:
+            mem_soft = min(mem_soft, mem_hard)
+        resource.setrlimit(resource.RLIMIT_AS, (mem_soft, mem_hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_hard, cpu_hard))
+        if memory_mb:
+            resource.setrlimit(resource.RLIMIT_AS, (mem_hard, mem_hard))
+
+
+class _OutputWriter(io.TextIOBase):
+    """
+    Stand-in for sys.stdout/sys.stderr inside a job.
+
+    Text is either kept in a buffer until the parent asks for it, or, for
+    streaming jobs, sent to the parent in chunks as it is written. Both
+    streams draw from one shared character budget.
+    """
+    CHUNK_SIZE = 4096
+
+    def __init__(self, budget, kind='stdout', send=None, buffer=None):
+        self.budget = budget
+        self.kind = kind
+        self.send = send
+        self.buffer = buffer if buffer is not None else io.StringIO()
+        self._pending = []
+        self._pending_size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.budget['used'] += len(text)
+        if self.budget['limit'] and self.budget['used'] > self.budget['limit']:
+            raise OutputLimitExceeded()
+        if self.send is None:
+            self.buffer.write(text)
+        else:
+            self._pending.append(text)
+            self._pending_size += len(text)
+            if '\n' in text or self._pending_size >= self.CHUNK_SIZE:
+                self.flush()
+        return len(text)
+
+    def flush(self):
+        if self._pending:
+            self.send((self.kind, ''.join(self._pending)))
+            self._pending = []
+            self._pending_size = 0
+
+    def take(self):
+        """Return the buffered text not yet handed to the parent."""
+        self.flush()
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
+
+
+def _render_figures(fmt, dpi, max_figures):
+    """
+    Save every open figure (up to max_figures) and return them as raw bytes,
+    ready to be handed to the artifact store without base64 encoding.
+    """
+    import matplotlib.pyplot as plt
+
+    figures = []
+    for num in plt.get_fignums()[:max_figures]:
+        figure = plt.figure(num)
+        buffer = io.BytesIO()
+        with _renderer_pool.lend(figure.canvas):
+            figure.savefig(buffer, format=fmt, dpi=dpi, bbox_inches='tight')
+        figures.append({'format': fmt, 'data': buffer.getvalue()})
+    return figures
+
+
+@contextlib.contextmanager
+def _timed(timings, name):
+    """Add the seconds spent in the block to timings[name]."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - started
+
+
+def _execute(job, limits, conn, code_cache, timings):
+    """
+    Run a single job and return the response payload for the run-code API.
+    Time spent running the code and saving its figures is added to timings
+    as 'exec' and 'savefig' (seconds), leaving out waits for input().
+
+    Interactive jobs do not fail when input() runs out of values: the worker
+    sends the prompt (and any output produced since the last prompt) to the
+    parent and blocks until the parent sends the next value back.
+
+    Streaming jobs send ('stdout', text) and ('stderr', text) messages while
+    they run; the final payload then only carries what was not streamed.
+    """
+    code = job['code']
+    inputs = job.get('inputs', [])
+    input_index = job.get('input_index', 0)
+
+    # Prepare to capture stdout (and stderr, into the same buffer unless streaming)
+    budget = {'used': 0, 'limit': limits.get('max_output', 0)}
+    def send_to_parent(message):
+        try:
+            conn.send(message)
+        except OSError:
+            raise _WorkerStopped() # The pool closed the pipe
+
+    send = send_to_parent if job.get('stream') else None
+    stdout_capture = _OutputWriter(budget, 'stdout', send)
+    stderr_capture = _OutputWriter(budget, 'stderr', send, buffer=stdout_capture.buffer)
+
+    def unsent_output():
+        stderr_capture.flush()
+        return stdout_capture.take()
+
+    def wait_for_input(prompt):
+        send_to_parent(('input', {
+            'prompt': prompt or "Enter input:",
+            'output': unsent_output(),
+        }))
+        with _timed(timings, 'input'):
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = None
+        if message is None:
+            raise _WorkerStopped() # The session was closed or reaped
+        kind, value = message
+        return value
+
+    # Prepare to capture matplotlib plots: each job gets its own figures and rcParams
+    job_scope = contextlib.ExitStack()
+    job_scope.enter_context(_figure_scope())
+    input_handler = CapturingInput(
+        inputs, input_index,
+        on_exhausted=wait_for_input if job.get('interactive') else None,
+    )
+
+    try:
+        # Execute the code
+        try:
+            with _timed(timings, 'exec'), _job_limits(limits['cpu_seconds'], limits['memory_mb']):
+                with contextlib.redirect_stdout(stdout_capture), contextlib.redirect_stderr(stderr_capture):
+                    with input_handler:
+                        exec(code_cache.compile(code), {"__builtins__": __builtins__})
+        except SystemExit as e:
+            # exit() and sys.exit() end the program, not the worker. Like the
+            # interpreter, show a message passed instead of a status code
+            if e.code is not None and not isinstance(e.code, int):
+                stderr_capture.write(f"{e.code}\n")
+            if sys.stdin is not None and sys.stdin.closed:
+                sys.stdin = open(os.devnull) # exit() closes it on the way out
+
+        # If code finished without needing more input
+        output = unsent_output()
+        with _timed(timings, 'savefig'):
+            figures = _render_figures(
+                job.get('plot_format', 'png'), job.get('dpi'), limits.get('max_figures', 10),
+            )
+
+        return {
+            'status': 'success',
+            'output': output,
+            'figures': figures,
+            'html': None,
+        }
+
+    except EOFError:
+        # 'input()' was called but we ran out of inputs
+        return {
+            'status': 'input_required',
+            'prompt': input_handler.prompt or "Enter input:",
+            'next_input_index': input_handler.current_index,
+            'output': unsent_output(), # Send partial output
+        }
+    except OutputLimitExceeded:
+        return {
+            'status': 'error',
+            'output': unsent_output() + "\n--- EXECUTION ERROR ---\nOutput limit exceeded",
+        }
+    except CPUTimeExceeded:
+        return {
+            'status': 'error',
+            'output': unsent_output() + "\n--- EXECUTION ERROR ---\nCPU time limit exceeded",
+            'recycle': True,
+        }
+    except MemoryError:
+        return {
+            'status': 'error',
+            'output': unsent_output() + "\n--- EXECUTION ERROR ---\nMemory limit exceeded",
+            'recycle': True,
+        }
+    except KeyboardInterrupt:
+        return {
+            'status': 'error',
+            'output': unsent_output() + "\n--- EXECUTION ERROR ---\nKeyboardInterrupt",
+        }
+    except Exception as e:
+        # Code execution failed
+        return {
+            'status': 'error',
+            'output': unsent_output() + f"\n--- EXECUTION ERROR ---\n{type(e).__name__}: {e}",
+        }
+    finally:
+        job_scope.close() # Always clean up plot figures
+
+
+def _worker_main(conn, limits):
+    """
+    Entry point of a worker process: warm up, then serve jobs until the
+    parent closes the pipe or sends None.
+    """
+    if hasattr(signal, 'SIGXCPU'):
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    _warm_up()
+    code_cache = CodeCache(limits.get('code_cache_size', 128))
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        timings = {}
+        try:
+            result = _execute(job, limits, conn, code_cache, timings)
+        except _WorkerStopped:
+            break
+        result['code_cache'] = code_cache.stats()
+        # Time the user took to type input() values is not execution time
+        timings['exec'] = timings.get('exec', 0.0) - timings.pop('input', 0.0)
+        result['timings'] = timings
+        try:
+            conn.send(('result', result))
+        except OSError:
+            break
+
+
+# --- POOL SIDE (runs inside the web process) ---
+
+class _Worker:
+    """
+    Handle on one worker process and the pipe used to talk to it.
+    """
+    def __init__(self, context, limits):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, limits), daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.jobs_run = 0
+        self.code_cache_stats = {'hits': 0, 'misses': 0, 'size': 0}
+
+    def run(self, job, timeout):
+        """
+        Start a job. Returns ('result', payload) when it finished, or
+        ('input', payload) when an interactive job is waiting for input.
+        """
+        self.jobs_run += 1
+        return self._exchange(job, timeout)
+
+    def resume(self, value, timeout):
+        """Hand the next input() value to a suspended interactive job."""
+        return self._exchange(('resume', value), timeout)
+
+    def stream(self, job, timeout):
+        """Like run(), but yields every message including output chunks."""
+        self.jobs_run += 1
+        return self._messages(job, timeout)
+
+    def stream_resume(self, value, timeout):
+        """Like resume(), but yields every message including output chunks."""
+        return self._messages(('resume', value), timeout)
+
+    def _exchange(self, message, timeout):
+        for reply in self._messages(message, timeout):
+            pass
+        return reply
+
+    def _messages(self, message, timeout):
+        """
+        Send a message, then yield replies until the job finishes or waits
+        for input. The timeout covers the whole exchange.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            self.conn.send(message)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.conn.poll(remaining):
+                    raise ExecutionTimeout()
+                reply = self.conn.recv()
+                yield reply
+                if reply[0] in ('result', 'input'):
+                    return
+        except (EOFError, OSError) as e:
+            raise WorkerCrashed() from e
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.conn.close()
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class ExecutionPool:
+    """
+    Fixed-size set of pre-warmed worker processes with a bounded queue.
+
+    At most ``size`` jobs run at once and at most ``queue_size`` more may wait
+    for a free worker; anything beyond that is refused with PoolBusy.
+    """
+    def __init__(self, size, queue_size, queue_timeout, job_timeout,
+                 cpu_seconds, memory_mb, max_jobs_per_worker, max_output=0,
+                 code_cache_size=128, max_figures=10):
+        self.size = max(1, size)
+        self.queue_timeout = queue_timeout
+        self.job_timeout = job_timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.limits = {
+            'cpu_seconds': cpu_seconds,
+            'memory_mb': memory_mb,
+            'max_output': max_output,
+            'code_cache_size': code_cache_size,
+            'max_figures': max_figures,
+        }
+
+        self._context = multiprocessing.get_context('spawn')
+        self._slots = threading.BoundedSemaphore(self.size + max(0, queue_size))
+        self._idle = queue.LifoQueue()  # Most recently used worker is the warmest
+        self._closed = False
+        self._workers = set()
+        self._retired_stats = {'hits': 0, 'misses': 0}
+        self._stats_lock = threading.Lock()
+
+    def start(self):
+        for _ in range(self.size):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        worker = _Worker(self._context, self.limits)
+        with self._stats_lock:
+            self._workers.add(worker)
+        return worker
+
+    def acquire(self):
+        """
+        Reserve a queue slot and wait for a free worker. The caller must hand
+        the worker back with release().
+        """
+        if self._closed:
+            raise PoolBusy("Execution pool is shut down")
+        # Admission control: refuse outright once the queue is full
+        if not self._slots.acquire(blocking=False):
+            raise PoolBusy("Too many jobs queued")
+        try:
+            return self._idle.get(timeout=self.queue_timeout)
+        except queue.Empty:
+            self._slots.release()
+            raise PoolBusy("Timed out waiting for a free worker")
+
+    def finish(self, worker, result):
+        """
+        Release a worker after it returned a final result, stripping the
+        bookkeeping fields the worker adds to the payload.
+        """
+        stats = result.pop('code_cache', None)
+        if stats is not None:
+            worker.code_cache_stats = stats
+        timings = result.pop('timings', None)
+        if timings:
+            from shared import metrics
+
+            for name, seconds in timings.items():
+                metrics.record_span(name, seconds)
+        self.release(worker, healthy=not result.pop('recycle', False))
+        return result
+
+    def release(self, worker, healthy):
+        try:
+            self._release(worker, healthy)
+        finally:
+            self._slots.release()
+
+    def run(self, job):
+        """
+        Run a job on the next free worker and return its result payload.
+        """
+        worker = self.acquire()
+        try:
+            kind, result = worker.run(job, self.job_timeout)
+        except Exception:
+            self.release(worker, healthy=False)
+            raise
+        return self.finish(worker, result)
+
+    def code_cache_stats(self):
+        """Compiled-code cache hits and misses summed over all workers."""
+        with self._stats_lock:
+            live = [worker.code_cache_stats for worker in self._workers]
+            totals = dict(self._retired_stats)
+        for stats in live:
+            totals['hits'] += stats['hits']
+            totals['misses'] += stats['misses']
+        return totals
+
+    def _release(self, worker, healthy):
+        """
+        Return a worker to the idle queue, replacing it if it hit a limit,
+        timed out, crashed or has served its quota of jobs.
+        """
+        if healthy and worker.jobs_run < self.max_jobs_per_worker and not self._closed:
+            self._idle.put(worker)
+            return
+        worker.stop()
+        with self._stats_lock:
+            self._workers.discard(worker)
+            self._retired_stats['hits'] += worker.code_cache_stats['hits']
+            self._retired_stats['misses'] += worker.code_cache_stats['misses']
+        if not self._closed:
+            self._idle.put(self._spawn())
+
+    def shutdown(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the process-wide execution pool, starting it on first use.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from django.conf import settings
+                import atexit
+
+                pool = ExecutionPool(
+                    size=settings.RUN_CODE_WORKERS,
+                    queue_size=settings.RUN_CODE_QUEUE_SIZE,
+                    queue_timeout=settings.RUN_CODE_QUEUE_TIMEOUT,
+                    job_timeout=settings.RUN_CODE_TIMEOUT,
+                    cpu_seconds=settings.RUN_CODE_CPU_SECONDS,
+                    memory_mb=settings.RUN_CODE_MEMORY_MB,
+                    max_jobs_per_worker=settings.RUN_CODE_MAX_JOBS_PER_WORKER,
+                    max_output=settings.RUN_CODE_MAX_OUTPUT,
+                    code_cache_size=settings.RUN_CODE_CODE_CACHE_SIZE,
+                    max_figures=settings.RUN_CODE_MAX_FIGURES,
+                )
+                pool.start()
+                atexit.register(pool.shutdown)
+                _pool = pool
+    return _pool
+
+
+def run_code(code, inputs=None, input_index=0):
+    """
+    Execute a snippet on the shared pool. Returns the run-code API payload.
+    """
+    job = {'code': code, 'inputs': inputs or [], 'input_index': input_index}
+    return get_pool().run(job)
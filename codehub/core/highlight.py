@@ -0,0 +1,151 @@
+# core/highlight.py
+
+"""
+Server-side syntax highlighting for the file view.
+
+A file is tokenised with Pygments once per distinct content and lexer; the
+HTML is split into chunks of HIGHLIGHT_CHUNK_LINES lines and cached under
+the blob hash, so every later view of the same content (in any repository)
+is served straight from the cache. A changed file has a new hash and
+therefore new cache keys; entries of a blob are evicted when the blob
+itself is deleted. The page embeds the first chunk and the browser fetches
+the others as they scroll into view.
+
+The whole file is tokenised at once on purpose: a chunk cannot be
+highlighted on its own, since the lexer state at its first line (inside a
+docstring, say) depends on everything before it. Requests for chunks past
+the end are refused before any rendering.
+
+Files larger than HIGHLIGHT_MAX_SIZE are shown as plain text, which still
+goes through the same chunked and cached pipeline.
+"""
+
+import functools
+import posixpath
+
+import pygments
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.safestring import mark_safe
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name, get_lexer_for_filename
+from pygments.util import ClassNotFound
+from shared import metrics
+
+PLAIN_TEXT = 'text'
+
+
+def _cache():
+    return caches['highlight']
+
+
+@functools.lru_cache(maxsize=1024)
+def lexer_name(file_name):
+    """Pygments alias of the lexer for a file name, or 'text'."""
+    try:
+        lexer = get_lexer_for_filename(file_name)
+    except ClassNotFound:
+        return PLAIN_TEXT
+    return lexer.aliases[0] if lexer.aliases else PLAIN_TEXT
+
+
+def file_lexer(repo_file):
+    """Lexer alias used to render a file, from its name and size."""
+    if repo_file.size > settings.HIGHLIGHT_MAX_SIZE:
+        return PLAIN_TEXT
+    return lexer_name(posixpath.basename(repo_file.file_path))
+
+
+@functools.lru_cache(maxsize=None)
+def style_css():
+    """CSS for the token classes in the configured style."""
+    return HtmlFormatter(style=settings.HIGHLIGHT_STYLE).get_style_defs('.highlight')
+
+
+def _manifest_key(digest):
+    return f'highlight:{digest}'
+
+
+def _chunk_key(digest, lexer, chunk):
+    return f'highlight:{digest}:{lexer}:{pygments.__version__}:{chunk}'
+
+
+def etag(repo_file, chunk):
+    """Validator for one chunk of a file; it only changes with its HTML."""
+    return f'"{repo_file.blob_id}-{file_lexer(repo_file)}-{pygments.__version__}-{chunk}"'
+
+
+def _line_html(number, html):
+    # The number comes from CSS, so copying code does not copy it
+    return f'<span class="code-line" id="L{number}"><a class="line-number" href="#L{number}" data-line="{number}"></a>{html}</span>\n'
+
+
+def _line_count(text):
+    """Number of lines _render() returns for text, without rendering it."""
+    # Pygments turns \r\n and \r into \n and adds a final newline
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text.count('\n') + (not text.endswith('\n'))
+
+
+def _render(text, lexer_alias):
+    """Highlight text and return one HTML string per line."""
+    lexer = get_lexer_by_name(lexer_alias, stripnl=False, ensurenl=True)
+    html = pygments.highlight(text, lexer, HtmlFormatter(nowrap=True))
+    lines = html.split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def render_chunk(repo_file, chunk):
+    """
+    Return (html, line_count, chunk_count) for one chunk of a file, or None
+    if the file has no such chunk. Renders and caches every chunk on a miss.
+    """
+    digest = repo_file.blob_id
+    lexer = file_lexer(repo_file)
+    cached = _cache().get(_chunk_key(digest, lexer, chunk))
+    if cached is not None:
+        return cached
+
+    # Check the chunk exists before paying for a render: from the manifest
+    # if the blob was rendered before, else by counting its lines
+    size = settings.HIGHLIGHT_CHUNK_LINES
+    chunk_count = (_cache().get(_manifest_key(digest)) or {}).get(lexer)
+    if chunk_count is None:
+        chunk_count = max(1, -(-_line_count(repo_file.content) // size))
+    if not 0 <= chunk < chunk_count:
+        return None
+
+    with metrics.span('highlight'):
+        lines = _render(repo_file.content, lexer)
+    chunk_count = max(1, -(-len(lines) // size))
+    chunks = {}
+    for index in range(chunk_count):
+        start = index * size
+        html = ''.join(
+            _line_html(number, line)
+            for number, line in enumerate(lines[start:start + size], start=start + 1)
+        )
+        chunks[_chunk_key(digest, lexer, index)] = (mark_safe(html), len(lines), chunk_count)
+    _cache().set_many(chunks)
+
+    # Remember what was cached for this blob so evict() can find it
+    manifest = _cache().get(_manifest_key(digest)) or {}
+    manifest[lexer] = chunk_count
+    _cache().set(_manifest_key(digest), manifest)
+
+    return chunks.get(_chunk_key(digest, lexer, chunk))
+
+
+def evict(digest):
+    """Drop the cached HTML of a blob."""
+    manifest = _cache().get(_manifest_key(digest))
+    if not manifest:
+        return
+    keys = [
+        _chunk_key(digest, lexer, index)
+        for lexer, chunk_count in manifest.items()
+        for index in range(chunk_count)
+    ]
+    _cache().delete_many([*keys, _manifest_key(digest)])
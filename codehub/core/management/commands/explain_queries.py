@@ -0,0 +1,99 @@
+# core/management/commands/explain_queries.py
+
+"""
+Print the database's query plan for the hot queries of the core app.
+
+    python manage.py explain_queries
+    python manage.py explain_queries --user alice --repo alice/project --analyze
+
+Run it after changing a query or an index and look for full table scans
+("SCAN core_repository" on SQLite, "Seq Scan" on PostgreSQL) or temporary
+sort steps where an index should be used.
+"""
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+
+from core import tree
+from core.models import Repository, RepoFile
+from core.views import _dashboard_repositories
+from shared.pagination import after_cursor, encode_cursor
+
+
+class Command(BaseCommand):
+    help = "Prints EXPLAIN output for the hot queries of the core app."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help="Username to run the dashboard queries as (default: first user).")
+        parser.add_argument('--repo', help="owner/name of the repository to use (default: the largest one).")
+        parser.add_argument('--analyze', action='store_true', help="Execute the queries and show actual timings (PostgreSQL, MySQL/MariaDB).")
+        parser.add_argument('--sql', action='store_true', help="Also print the SQL of each query.")
+
+    def handle(self, *args, **options):
+        user = self._user(options['user'])
+        repo = self._repository(options['repo'])
+
+        self.stdout.write(f"Database: {connection.vendor}, user: {user.username}, repository: {repo}\n")
+        for title, queryset in self._queries(user, repo):
+            self.stdout.write(self.style.MIGRATE_HEADING(title))
+            if options['sql']:
+                self.stdout.write(str(queryset.query))
+            explain_options = {'analyze': True} if options['analyze'] else {}
+            try:
+                self.stdout.write(queryset.explain(**explain_options))
+            except ValueError as e:
+                raise CommandError(f"{connection.vendor} does not support these EXPLAIN options ({e}).")
+            self.stdout.write('')
+
+    def _user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f"User '{username}' does not exist.")
+        # Plans are still useful on an empty database
+        return User.objects.order_by('pk').first() or User(pk=0, username='nobody')
+
+    def _repository(self, full_name):
+        if full_name:
+            owner, _, name = full_name.partition('/')
+            try:
+                return Repository.objects.get(owner__username=owner, name=name)
+            except Repository.DoesNotExist:
+                raise CommandError(f"Repository '{full_name}' does not exist.")
+        largest = Repository.objects.annotate(file_total=Count('files')).order_by('-file_total', 'pk')
+        return largest.first() or Repository(pk=0, owner=User(pk=0, username='nobody'), name='nothing')
+
+    def _queries(self, user, repo):
+        """(title, queryset) for each query worth watching."""
+        # A cursor from the newest repository stands in for "page 2"
+        newest = Repository.objects.order_by('-updated_at', '-pk').first()
+        cursor = encode_cursor(newest) if newest is not None else None
+
+        folder = tree.FolderEntries(repo, '')
+        some_file = repo.files.only('file_path').first() if repo.pk else None
+
+        return [
+            ("Dashboard: my repositories, first page",
+             after_cursor(_dashboard_repositories(user, 'mine'), None)[:25]),
+            ("Dashboard: my repositories, next page",
+             after_cursor(_dashboard_repositories(user, 'mine'), cursor)[:25]),
+            ("Dashboard: public repositories, first page",
+             after_cursor(_dashboard_repositories(user, 'public'), None)[:25]),
+            ("Dashboard: public repositories, next page",
+             after_cursor(_dashboard_repositories(user, 'public'), cursor)[:25]),
+            ("Repository page: folders of the top level",
+             folder.folders[:100]),
+            ("Repository page: files of the top level",
+             folder.files[:100]),
+            ("Upload: existing file by path",
+             RepoFile.objects.filter(
+                 repository=repo, file_path=some_file.file_path if some_file else 'README.md',
+             )),
+            ("Download: files with their contents",
+             repo.files.select_related('blob')
+             .only('file_path', 'updated_at', 'blob__data', 'blob__compressed')
+             .order_by('file_path')),
+        ]
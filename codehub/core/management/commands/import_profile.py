@@ -0,0 +1,74 @@
+# core/management/commands/import_profile.py
+
+"""
+Show what Django start-up spends its import time on.
+
+    python manage.py import_profile
+    python manage.py import_profile --top 40 --module core.executor --self
+
+Starts a fresh interpreter with ``python -X importtime``, runs
+django.setup() and imports the URLconf (which pulls in every view, like
+the first request of a new worker does), then lists the slowest imports.
+Heavy libraries such as matplotlib or firebase_admin should not show up
+here; they are imported on first use.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Profiles the imports done while Django starts up."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=25, help="Number of imports to list (default: 25).")
+        parser.add_argument('--module', action='append', default=[], help="Also import this module (repeatable).")
+        parser.add_argument('--self', action='store_true', dest='self_time', help="Sort by time spent in the module itself instead of including its imports.")
+
+    def handle(self, *args, **options):
+        modules = [settings.ROOT_URLCONF, *options['module']]
+        script = 'import django; django.setup()\n' + ''.join(f'import {module}\n' for module in modules)
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'codehub.settings')}
+
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script],
+            capture_output=True, text=True, env=env, cwd=settings.BASE_DIR,
+        )
+        elapsed = time.perf_counter() - started
+        imports = self._parse(result.stderr)
+        if result.returncode != 0:
+            errors = [line for line in result.stderr.splitlines() if not line.startswith('import time:')]
+            raise CommandError("Start-up failed:\n" + '\n'.join(errors[-10:]))
+
+        key = (lambda row: row[1]) if options['self_time'] else (lambda row: row[2])
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{'self ms':>9} {'total ms':>9}  module"
+        ))
+        for name, self_us, total_us, depth in sorted(imports, key=key, reverse=True)[:options['top']]:
+            self.stdout.write(f"{self_us / 1000:9.1f} {total_us / 1000:9.1f}  {'  ' * depth}{name}")
+
+        self.stdout.write('')
+        self.stdout.write(
+            f"{len(imports)} modules, {sum(row[1] for row in imports) / 1000:.0f} ms importing, "
+            f"{elapsed * 1000:.0f} ms until {', '.join(modules)} was loaded."
+        )
+
+    def _parse(self, output):
+        """[(module, self_us, cumulative_us, depth)] from -X importtime output."""
+        imports = []
+        for line in output.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            fields = line[len('import time:'):].split('|')
+            if len(fields) != 3 or not fields[0].strip().isdigit():
+                continue # The header line
+            name = fields[2].rstrip()
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            imports.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+        return imports
@@ -0,0 +1,92 @@
+# Moves RepoFile.content into deduplicated, content-addressed Blob rows.
+
+import hashlib
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def _pack(text):
+    raw = (text or '').encode('utf-8', 'surrogatepass')
+    packed = zlib.compress(raw, 6)
+    if len(raw) >= 256 and len(packed) < len(raw):
+        return hashlib.sha256(raw).hexdigest(), packed, len(raw), True
+    return hashlib.sha256(raw).hexdigest(), raw, len(raw), False
+
+
+def contents_to_blobs(apps, schema_editor):
+    Blob = apps.get_model('core', 'Blob')
+    RepoFile = apps.get_model('core', 'RepoFile')
+
+    batch = []
+    known = set(Blob.objects.values_list('sha256', flat=True))
+    for f in RepoFile.objects.only('id', 'content').iterator(chunk_size=500):
+        digest, data, size, compressed = _pack(f.content)
+        if digest not in known:
+            Blob.objects.create(sha256=digest, data=data, size=size, compressed=compressed)
+            known.add(digest)
+        f.blob_id = digest
+        batch.append(f)
+        if len(batch) >= 500:
+            RepoFile.objects.bulk_update(batch, ['blob'])
+            batch = []
+    if batch:
+        RepoFile.objects.bulk_update(batch, ['blob'])
+
+
+def blobs_to_contents(apps, schema_editor):
+    RepoFile = apps.get_model('core', 'RepoFile')
+
+    batch = []
+    for f in RepoFile.objects.select_related('blob').iterator(chunk_size=500):
+        data = bytes(f.blob.data)
+        if f.blob.compressed:
+            data = zlib.decompress(data)
+        f.content = data.decode('utf-8', 'surrogatepass')
+        batch.append(f)
+        if len(batch) >= 500:
+            RepoFile.objects.bulk_update(batch, ['content'])
+            batch = []
+    if batch:
+        RepoFile.objects.bulk_update(batch, ['content'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_repository_content_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField()),
+                ('compressed', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='repofile',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='files', to='core.blob'),
+        ),
+        migrations.AlterField(
+            model_name='repofile',
+            name='content',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(contents_to_blobs, blobs_to_contents),
+        migrations.RemoveField(
+            model_name='repofile',
+            name='content',
+        ),
+        migrations.AlterField(
+            model_name='repofile',
+            name='blob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='files', to='core.blob'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Stores each file's size on the row so listings can skip the blob.
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_sizes(apps, schema_editor):
+    Blob = apps.get_model('core', 'Blob')
+    RepoFile = apps.get_model('core', 'RepoFile')
+    RepoFile.objects.update(
+        size=Subquery(Blob.objects.filter(pk=OuterRef('blob_id')).values('size')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_blob_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repofile',
+            name='size',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_sizes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.2.1 on 2026-10-18 02:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_tree(apps, schema_editor):
+    # Same rules as core.tree.split_path, inlined so the migration does not
+    # depend on the current code
+    RepoDirectory = apps.get_model('core', 'RepoDirectory')
+    RepoFile = apps.get_model('core', 'RepoFile')
+
+    counts = {}
+    batch = []
+    for f in RepoFile.objects.only('id', 'repository_id', 'file_path').iterator(chunk_size=500):
+        parts = [part for part in f.file_path.split('/') if part not in ('', '.')]
+        f.directory = '/'.join(parts[:-1])
+        for i in range(1, len(parts)):
+            key = (f.repository_id, '/'.join(parts[:i]))
+            counts[key] = counts.get(key, 0) + 1
+        batch.append(f)
+        if len(batch) >= 500:
+            RepoFile.objects.bulk_update(batch, ['directory'])
+            batch = []
+    if batch:
+        RepoFile.objects.bulk_update(batch, ['directory'])
+
+    RepoDirectory.objects.bulk_create(
+        [
+            RepoDirectory(
+                repository_id=repository_id, path=path, parent_path=path.rpartition('/')[0],
+                name=path.rpartition('/')[2], file_count=count,
+            )
+            for (repository_id, path), count in counts.items()
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_repofile_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RepoDirectory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=512)),
+                ('parent_path', models.CharField(blank=True, max_length=512)),
+                ('name', models.CharField(max_length=255)),
+                ('file_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='repofile',
+            name='directory',
+            field=models.CharField(blank=True, default='', editable=False, max_length=512),
+        ),
+        migrations.AddIndex(
+            model_name='repofile',
+            index=models.Index(fields=['repository', 'directory', 'file_path'], name='core_repofi_reposit_007e49_idx'),
+        ),
+        migrations.AddField(
+            model_name='repodirectory',
+            name='repository',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='directories', to='core.repository'),
+        ),
+        migrations.AddIndex(
+            model_name='repodirectory',
+            index=models.Index(fields=['repository', 'parent_path', 'name'], name='core_repodi_reposit_7dd144_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='repodirectory',
+            unique_together={('repository', 'path')},
+        ),
+        migrations.RunPython(build_tree, migrations.RunPython.noop),
+    ]
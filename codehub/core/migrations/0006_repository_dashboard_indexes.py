@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 02:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_repository_tree'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='repository',
+            index=models.Index(fields=['owner', '-updated_at', '-id'], name='repo_owner_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='repository',
+            index=models.Index(fields=['visibility', '-updated_at', '-id'], name='repo_visibility_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-18 02:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_repository_dashboard_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchPosting',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.FloatField()),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_postings', to='core.repofile')),
+                ('repository', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_postings', to='core.repository')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'repository'], name='core_search_term_da635c_idx')],
+                'unique_together': {('file', 'term')},
+            },
+        ),
+    ]
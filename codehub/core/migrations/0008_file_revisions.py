@@ -0,0 +1,56 @@
+# Generated by Django 5.2.1 on 2026-10-18 02:15
+
+import json
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def snapshot_existing_files(apps, schema_editor):
+    # The current content of every file becomes its first revision
+    FileRevision = apps.get_model('core', 'FileRevision')
+    RepoFile = apps.get_model('core', 'RepoFile')
+
+    batch = []
+    files = RepoFile.objects.select_related('blob').only('id', 'blob__sha256', 'blob__size', 'blob__data', 'blob__compressed')
+    for f in files.iterator(chunk_size=200):
+        data = bytes(f.blob.data)
+        if f.blob.compressed:
+            data = zlib.decompress(data)
+        text = data.decode('utf-8', 'surrogatepass')
+        batch.append(FileRevision(
+            file_id=f.id, number=1, base=1, sha256=f.blob.sha256, size=f.blob.size,
+            data=zlib.compress(json.dumps(text, separators=(',', ':')).encode('utf-8', 'surrogatepass'), 6),
+        ))
+        if len(batch) >= 200:
+            FileRevision.objects.bulk_create(batch)
+            batch = []
+    FileRevision.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileRevision',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('base', models.PositiveIntegerField()),
+                ('sha256', models.CharField(max_length=64)),
+                ('size', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='revisions', to='core.repofile')),
+            ],
+            options={
+                'unique_together': {('file', 'number')},
+            },
+        ),
+        migrations.RunPython(snapshot_existing_files, migrations.RunPython.noop),
+    ]
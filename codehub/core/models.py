@@ -1,4 +1,9 @@
-from django.db import models
+import hashlib
+import zlib
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import ProtectedError
 
 # Create your models here.
 from django.contrib.auth.models import User
@@ -15,24 +20,231 @@ class Repository(models.Model):
     visibility = models.CharField(max_length=10, choices=VISIBILITY_CHOICES, default='public')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True) # Automatically updates on save
+    # Bumped whenever one of the repository's files is saved or deleted;
+    # cached downloads are keyed on it (see core.archives)
+    content_version = models.PositiveIntegerField(default=0, editable=False)
+    content_updated_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return f'{self.owner.username}/{self.name}'
     class Meta:
         unique_together = ('owner', 'name')
+        indexes = [
+            # Dashboard sections, newest first (see shared.pagination):
+            # a user's own repositories, and everyone's public ones
+            models.Index(fields=['owner', '-updated_at', '-id'], name='repo_owner_updated_idx'),
+            models.Index(fields=['visibility', '-updated_at', '-id'], name='repo_visibility_updated_idx'),
+        ]
+
+class Blob(models.Model):
+    """
+    File contents, stored once per distinct content and addressed by the
+    SHA-256 of its UTF-8 bytes. Identical files in different repositories
+    (or forks) share one row. Larger contents are zlib-compressed.
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    size = models.PositiveIntegerField() # Uncompressed size in bytes
+    compressed = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256
+
+    @property
+    def text(self):
+        data = bytes(self.data)
+        if self.compressed:
+            data = zlib.decompress(data)
+        return data.decode('utf-8', 'surrogatepass')
+
+    @classmethod
+    def pack(cls, text):
+        """
+        Build (without saving) the blob for a text, compressed if enabled
+        and worthwhile.
+        """
+        raw = text.encode('utf-8', 'surrogatepass')
+        data, compressed = raw, False
+        if settings.BLOB_COMPRESSION and len(raw) >= settings.BLOB_COMPRESS_MIN_SIZE:
+            packed = zlib.compress(raw, 6)
+            if len(packed) < len(raw):
+                data, compressed = packed, True
+        return cls(sha256=hashlib.sha256(raw).hexdigest(), data=data, size=len(raw), compressed=compressed)
+
+    @classmethod
+    def store(cls, text):
+        """
+        Make sure a blob with this content exists and return its hash.
+        """
+        blob = cls.pack(text)
+        if cls.objects.filter(pk=blob.sha256).exists():
+            return blob.sha256
+        try:
+            with transaction.atomic():
+                blob.save(force_insert=True)
+        except IntegrityError:
+            pass # Stored concurrently by another request
+        return blob.sha256
+
+    @classmethod
+    def release(cls, digest):
+        """
+        Delete a blob once no file refers to it any more. Runs after the
+        current transaction commits, in a transaction of its own.
+        """
+        transaction.on_commit(lambda: cls._delete_unused(digest))
+
+    @classmethod
+    def _delete_unused(cls, digest):
+        try:
+            with transaction.atomic():
+                cls.objects.filter(pk=digest, files__isnull=True).delete()
+        except (IntegrityError, ProtectedError):
+            pass # Picked up by a new file in the meantime
+
+
+class RepoDirectory(models.Model):
+    """
+    A folder of a repository's file tree, with the number of files anywhere
+    below it. Maintained by core.tree as files are added and removed, so a
+    folder can be listed without scanning every path in the repository.
+    The root folder ('') is implicit and has no row.
+    """
+    repository = models.ForeignKey(Repository, on_delete=models.CASCADE, related_name='directories')
+    path = models.CharField(max_length=512)
+    parent_path = models.CharField(max_length=512, blank=True) # '' for top-level folders
+    name = models.CharField(max_length=255)
+    file_count = models.PositiveIntegerField(default=0)
+
+    is_folder = True # Tells folders from files in mixed listings
+
+    def __str__(self):
+        return f'{self.repository_id}:{self.path}/'
+
+    class Meta:
+        unique_together = ('repository', 'path')
+        indexes = [
+            models.Index(fields=['repository', 'parent_path', 'name']),
+        ]
+
 
 class RepoFile(models.Model):
     """
     Represents a single file within a repository.
+    The contents live in a shared Blob; use the ``content`` property to read
+    or replace them.
     """
     repository = models.ForeignKey(Repository, on_delete=models.CASCADE, related_name='files')
     file_path = models.CharField(max_length=512)
-    content = models.TextField(blank=True) # The code or text of the file
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, related_name='files')
+    # Size of the content in bytes, kept here so file listings never need
+    # to read the blob
+    size = models.PositiveIntegerField(default=0, editable=False)
+    # Folder the file lives in, derived from file_path ('' for the root)
+    directory = models.CharField(max_length=512, blank=True, default='', editable=False)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f'{self.repository.name}/{self.file_path}'
-    
+
+    @property
+    def name(self):
+        return self.file_path.rstrip('/').rpartition('/')[2]
+
+    @property
+    def content(self):
+        """The code or text of the file, loaded from its blob on first access."""
+        if getattr(self, '_content', None) is None:
+            self._content = self.blob.text if self.blob_id else ''
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value or ''
+        self._content_changed = True
+
+    def save(self, *args, **kwargs):
+        from .tree import split_path
+
+        self.directory = split_path(self.file_path)[0]
+        previous_blob_id = self.blob_id
+        content = None
+        if getattr(self, '_content_changed', False):
+            content = self._content
+            self.size = len(content.encode('utf-8', 'surrogatepass'))
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'blob', 'size'}
+        elif not self.blob_id:
+            content = ''
+
+        # Store the blob and write the row in one transaction. A concurrent
+        # save or delete may still release an identical, unreferenced blob
+        # in between; the foreign key check then fails and we store it again.
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    if content is not None:
+                        self.blob_id = Blob.store(content)
+                    super().save(*args, **kwargs)
+                break
+            except IntegrityError:
+                if attempt or content is None:
+                    raise
+        self._content_changed = False
+
+        if previous_blob_id and previous_blob_id != self.blob_id:
+            Blob.release(previous_blob_id)
+
     class Meta:
         # Prevent duplicate file paths within the same repository
         unique_together = ('repository', 'file_path')
+        indexes = [
+            models.Index(fields=['repository', 'directory', 'file_path']),
+        ]
+
+
+class FileRevision(models.Model):
+    """
+    One version of a file. data holds either a full snapshot of the content
+    (when base == number) or a delta against the previous revision; see
+    core.revisions for the format.
+    """
+    file = models.ForeignKey(RepoFile, on_delete=models.CASCADE, related_name='revisions')
+    number = models.PositiveIntegerField() # 1 for the first version of the file
+    base = models.PositiveIntegerField() # Number of the snapshot this revision's chain starts from
+    sha256 = models.CharField(max_length=64) # Hash of the full content
+    size = models.PositiveIntegerField() # Size of the full content in bytes
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.file_id}@{self.number}'
+
+    @property
+    def is_snapshot(self):
+        return self.base == self.number
+
+    class Meta:
+        unique_together = ('file', 'number')
+
+
+class SearchPosting(models.Model):
+    """
+    One entry of the code search index: a term that occurs in a file, with
+    its log-scaled frequency there. Maintained by core.search.
+    """
+    term = models.CharField(max_length=64)
+    file = models.ForeignKey(RepoFile, on_delete=models.CASCADE, related_name='search_postings')
+    # Copied from the file so visibility can be checked without a join through it
+    repository = models.ForeignKey(Repository, on_delete=models.CASCADE, related_name='search_postings')
+    weight = models.FloatField()
+
+    def __str__(self):
+        return f'{self.term} in {self.file_id}'
+
+    class Meta:
+        unique_together = ('file', 'term')
+        indexes = [
+            models.Index(fields=['term', 'repository']),
+        ]
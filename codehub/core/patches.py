@@ -0,0 +1,68 @@
+# core/patches.py
+
+"""
+Applying editor patches to file contents.
+
+The editor sends only what changed since the version it loaded: a list of
+[start, end, text] splices against that version, plus the version's blob
+hash. Offsets count UTF-16 code units, the way JavaScript string indices
+do, so a browser can compute them without re-encoding the file. The patch
+is applied only if the file still has the content it was computed
+against; otherwise the save is a conflict and nothing is written.
+"""
+
+MAX_EDITS = 1000
+
+
+class PatchError(ValueError):
+    """Raised for a malformed patch, or one that does not fit its base text."""
+
+
+def parse_edits(value):
+    """
+    Validate a list of [start, end, text] splices and return them as
+    tuples. They must be in order and must not overlap.
+    """
+    if not isinstance(value, list) or len(value) > MAX_EDITS:
+        raise PatchError(f"'edits' must be a list of at most {MAX_EDITS} [start, end, text] splices.")
+    edits = []
+    position = 0
+    for edit in value:
+        if (
+            not isinstance(edit, list) or len(edit) != 3
+            or not all(type(offset) is int for offset in edit[:2])
+            or not isinstance(edit[2], str)
+        ):
+            raise PatchError("Each edit must be [start, end, text].")
+        start, end, text = edit
+        if not position <= start <= end:
+            raise PatchError("Edits must be in order and must not overlap.")
+        edits.append((start, end, text))
+        position = end
+    return edits
+
+
+def apply_edits(text, edits):
+    """
+    Apply parsed splices to text. Offsets are UTF-16 code units, so the text
+    is spliced in its UTF-16 form (two bytes per unit) and decoded again.
+    """
+    units = text.encode('utf-16-le', 'surrogatepass')
+    if edits and edits[-1][1] * 2 > len(units):
+        raise PatchError("An edit reaches past the end of the file.")
+    parts = []
+    position = 0
+    for start, end, replacement in edits:
+        parts.append(units[position * 2:start * 2])
+        parts.append(replacement.encode('utf-16-le', 'surrogatepass'))
+        position = end
+    parts.append(units[position * 2:])
+    try:
+        return b''.join(parts).decode('utf-16-le')
+    except UnicodeDecodeError:
+        raise PatchError("An edit splits a character in two.")
+
+
+def utf16_length(text):
+    """Length of text as JavaScript counts it."""
+    return len(text.encode('utf-16-le', 'surrogatepass')) // 2
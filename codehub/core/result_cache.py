@@ -0,0 +1,140 @@
+# core/result_cache.py
+
+"""
+Opt-in cache of run-code results for deterministic snippets.
+
+In a classroom many people submit the same exercise with the same inputs.
+When RUN_CODE_RESULT_CACHE is on, a finished run is stored under a hash of
+the code, the inputs, the plot options and the interpreter version, and identical submissions
+are answered from the cache without touching the worker pool. Code that looks
+at the clock, randomness, the file system or the network is never cached.
+"""
+
+import ast
+import hashlib
+import json
+import platform
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Modules whose use makes a program's output depend on more than its source.
+# Submodules count too: 'numpy.random' matches 'import numpy.random as npr'
+# and 'from numpy.random import rand'
+NONDETERMINISTIC_MODULES = {
+    'datetime', 'time', 'random', 'secrets', 'uuid', 'numpy.random', 'builtins',
+    'os', 'sys', 'io', 'pathlib', 'shutil', 'tempfile', 'glob', 'fileinput',
+    'socket', 'ssl', 'http', 'urllib', 'requests', 'ftplib', 'smtplib',
+    'subprocess', 'threading', 'multiprocessing', 'asyncio', 'signal',
+    'sqlite3', 'pickle', 'shelve', 'importlib', 'ctypes', 'gc', 'inspect',
+    'platform', 'getpass', 'locale', 'resource',
+}
+
+# Builtins with the same problem, or that hide what the code does, e.g.
+# getattr(__builtins__, 'open'). Also matched as attributes (builtins.open)
+NONDETERMINISTIC_BUILTINS = {
+    'open', 'exec', 'eval', 'compile', '__import__', 'globals', 'locals',
+    'vars', 'id', 'hash', 'breakpoint', 'help', 'getattr', '__builtins__',
+}
+
+# Attribute names that reach randomness or the clock through another module,
+# e.g. numpy.random or pandas.Timestamp.now
+NONDETERMINISTIC_ATTRIBUTES = {
+    'random', 'now', 'today', 'utcnow', 'urandom', 'time', 'perf_counter',
+    'read_csv', 'savefig', 'imread', 'loadtxt', 'fromfile', 'load',
+}
+
+INTERPRETER_VERSION = f'{platform.python_implementation()}-{platform.python_version()}'
+
+
+def _nondeterministic_module(name):
+    """True if name or any module it is inside of (a, a.b, a.b.c) is listed."""
+    parts = (name or '').split('.')
+    return any('.'.join(parts[:end]) in NONDETERMINISTIC_MODULES for end in range(1, len(parts) + 1))
+
+
+def is_cacheable(code):
+    """
+    Return True if the code looks deterministic: it parses, and it uses none
+    of the modules, builtins or attributes listed above.
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return False
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            if any(_nondeterministic_module(alias.name) for alias in node.names):
+                return False
+        elif isinstance(node, ast.ImportFrom):
+            if _nondeterministic_module(node.module):
+                return False
+            if any(
+                alias.name in NONDETERMINISTIC_ATTRIBUTES or alias.name in NONDETERMINISTIC_BUILTINS
+                or (node.module and _nondeterministic_module(f'{node.module}.{alias.name}'))
+                for alias in node.names
+            ):
+                return False
+        elif isinstance(node, ast.Name):
+            if node.id in NONDETERMINISTIC_BUILTINS:
+                return False
+        elif isinstance(node, ast.Attribute):
+            if (node.attr in NONDETERMINISTIC_ATTRIBUTES or node.attr in NONDETERMINISTIC_BUILTINS
+                    or node.attr.startswith('__')):
+                return False
+    return True
+
+
+def _cache_key(job):
+    material = json.dumps([INTERPRETER_VERSION, job], sort_keys=True, separators=(',', ':'))
+    return 'run-code:' + hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def _enabled(job):
+    return settings.RUN_CODE_RESULT_CACHE and is_cacheable(job['code'])
+
+
+def lookup(job):
+    """Return the cached result payload for a job, or None."""
+    if not _enabled(job):
+        return None
+    return caches['run_code'].get(_cache_key(job))
+
+
+def store(job, result):
+    """
+    Store a finished run. Runs waiting for input and oversized results are
+    not cached.
+    """
+    if result.get('status') not in ('success', 'error') or not _enabled(job):
+        return
+    size = len(result.get('output') or '') + sum(
+        len(figure['data']) for figure in result.get('figures') or []
+    )
+    if size > settings.RUN_CODE_RESULT_CACHE_MAX_BYTES:
+        return
+    caches['run_code'].set(_cache_key(job), result)
+
+
+def recording(job, events):
+    """
+    Pass streaming execution events through unchanged, and cache the run
+    once it finishes, with the streamed output folded back into 'output'.
+    """
+    if not _enabled(job):
+        yield from events
+        return
+
+    streamed = []
+    for kind, payload in events:
+        if kind in ('stdout', 'stderr'):
+            streamed.append(payload)
+        elif kind == 'done':
+            store(job, dict(payload, output=''.join(streamed) + (payload.get('output') or '')))
+        yield kind, payload
+
+
+def replay(result):
+    """Turn a cached payload into the event sequence of a streamed run."""
+    yield 'done', dict(result)
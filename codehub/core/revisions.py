@@ -0,0 +1,179 @@
+# core/revisions.py
+
+"""
+Revision history of repository files.
+
+Every change to a file's content adds a FileRevision. Most revisions store
+only a line-level delta against the revision before them; every
+REVISION_SNAPSHOT_INTERVAL revisions (and whenever a delta would not be
+smaller) a full snapshot is stored instead. Each revision records the
+snapshot its chain starts from, so any version is rebuilt from one query
+and at most REVISION_SNAPSHOT_INTERVAL - 1 deltas.
+
+Deltas are JSON lists of [start, end, lines] edits against the previous
+version's lines, zlib-compressed like snapshots.
+"""
+
+import difflib
+import hashlib
+import json
+import zlib
+
+from django.conf import settings
+from django.db.models import Max
+
+from .models import FileRevision
+
+
+def _lines(text):
+    return text.splitlines(keepends=True)
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+# Above this many differing lines, let difflib ignore very common lines
+# (blank lines, lone braces) when matching; exact matching is quadratic in
+# the worst case
+EXACT_MATCH_LINES = 2000
+
+
+def make_delta(old, new):
+    """Edits that turn text old into text new, as [[start, end, lines], ...]."""
+    old_lines, new_lines = _lines(old), _lines(new)
+
+    # Most saves touch a small region; only that region needs matching
+    limit = min(len(old_lines), len(new_lines))
+    head = 0
+    while head < limit and old_lines[head] == new_lines[head]:
+        head += 1
+    tail = 0
+    while tail < limit - head and old_lines[-1 - tail] == new_lines[-1 - tail]:
+        tail += 1
+    old_middle = old_lines[head:len(old_lines) - tail]
+    new_middle = new_lines[head:len(new_lines) - tail]
+
+    matcher = difflib.SequenceMatcher(
+        None, old_middle, new_middle,
+        autojunk=max(len(old_middle), len(new_middle)) > EXACT_MATCH_LINES,
+    )
+    return [
+        [head + i1, head + i2, new_middle[j1:j2]]
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != 'equal'
+    ]
+
+
+def apply_delta(old, delta):
+    """Apply make_delta() edits to text old."""
+    old_lines = _lines(old)
+    result = []
+    position = 0
+    for start, end, lines in delta:
+        result.extend(old_lines[position:start])
+        result.extend(lines)
+        position = end
+    result.extend(old_lines[position:])
+    return ''.join(result)
+
+
+def _pack(value):
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8', 'surrogatepass'), 6)
+
+
+def _unpack(data):
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8', 'surrogatepass'))
+
+
+def text_at(file_id, number):
+    """Rebuild the content of a file at a revision number."""
+    revision = FileRevision.objects.only('base').get(file_id=file_id, number=number)
+    chain = FileRevision.objects.filter(
+        file_id=file_id, number__range=(revision.base, number),
+    ).order_by('number').values_list('data', flat=True)
+
+    text = None
+    for data in chain:
+        value = _unpack(data)
+        text = value if text is None else apply_delta(text, value)
+    return text
+
+
+def _latest(file_ids):
+    """{file_id: latest FileRevision} for the given files."""
+    numbers = (
+        FileRevision.objects.filter(file_id__in=file_ids)
+        .values('file').annotate(number=Max('number')).values_list('file', 'number')
+    )
+    latest = {}
+    for file_id, number in numbers:
+        latest[file_id] = number
+    if not latest:
+        return {}
+    revisions = FileRevision.objects.filter(
+        file_id__in=list(latest), number__in=set(latest.values()),
+    ).only('file_id', 'number', 'base', 'sha256')
+    return {r.file_id: r for r in revisions if latest[r.file_id] == r.number}
+
+
+def record(changes):
+    """
+    Add a revision for each changed file. changes holds (file_id, text,
+    previous_text) triples; previous_text may be None, in which case it is
+    rebuilt from the history when a delta is due. Files whose text matches
+    their latest revision get no new revision.
+    """
+    changes = list(changes)
+    if not changes:
+        return
+    latest = _latest([file_id for file_id, _, _ in changes])
+    interval = settings.REVISION_SNAPSHOT_INTERVAL
+
+    revisions = []
+    for file_id, text, previous_text in changes:
+        digest = _sha256(text)
+        size = len(text.encode('utf-8', 'surrogatepass'))
+        previous = latest.get(file_id)
+        if previous is not None and previous.sha256 == digest:
+            continue
+        number = previous.number + 1 if previous else 1
+
+        snapshot = _pack(text)
+        data, base = snapshot, number
+        if previous is not None and number - previous.base < interval:
+            if previous_text is None or _sha256(previous_text) != previous.sha256:
+                previous_text = text_at(file_id, previous.number)
+            delta = _pack(make_delta(previous_text, text))
+            if len(delta) < len(snapshot):
+                data, base = delta, previous.base
+
+        revisions.append(FileRevision(
+            file_id=file_id, number=number, base=base, sha256=digest, size=size, data=data,
+        ))
+    FileRevision.objects.bulk_create(revisions, batch_size=500)
+
+
+def diff_lines(old, new, old_label, new_label, context=3):
+    """
+    Unified diff of two texts as [(kind, line)] with kind one of
+    'header', 'hunk', 'add', 'remove' or 'context'.
+    """
+    diff = difflib.unified_diff(
+        _lines(old), _lines(new), fromfile=old_label, tofile=new_label, n=context,
+    )
+    lines = []
+    for line in diff:
+        line = line.rstrip('\r\n')
+        if line.startswith(('---', '+++')):
+            kind = 'header'
+        elif line.startswith('@@'):
+            kind = 'hunk'
+        elif line.startswith('+'):
+            kind = 'add'
+        elif line.startswith('-'):
+            kind = 'remove'
+        else:
+            kind = 'context'
+        lines.append((kind, line))
+    return lines
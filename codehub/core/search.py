@@ -0,0 +1,239 @@
+# core/search.py
+
+"""
+Code search over every repository a user can see.
+
+Each file's content is split into lowercase identifier tokens (with
+snake_case and camelCase words also indexed on their own) and stored as
+postings: one SearchPosting row per (file, term) with a log-scaled term
+frequency. The index is updated from core.signals when a file is saved and
+by core.uploads for bulk imports; postings of deleted files go with them.
+
+A query matches files that contain all of its terms. Files are ranked by
+tf-idf inside the database, so only the requested page of files, and only
+their contents, is loaded to build the snippets.
+"""
+
+import math
+import re
+from collections import Counter
+
+from django.core.cache import cache
+from django.db.models import Case, Count, F, FloatField, Q, Sum, Value, When
+from django.urls import reverse
+
+from .models import RepoFile, SearchPosting
+
+TOKEN_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+WORD_RE = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+')
+
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+MAX_TERMS_PER_FILE = 5000
+MAX_QUERY_TERMS = 8
+SNIPPET_LINES = 3
+SNIPPET_WIDTH = 200
+
+
+def tokens(text):
+    """
+    Yield the search terms of a text: every identifier, and the words of
+    compound identifiers ('parse_args' -> 'parse_args', 'parse', 'args').
+    """
+    for identifier in TOKEN_RE.findall(text):
+        words = [word for part in identifier.split('_') for word in WORD_RE.findall(part)]
+        candidates = [identifier, *words] if len(words) > 1 else [identifier]
+        for term in candidates:
+            if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH:
+                yield term.lower()
+
+
+def query_terms(query):
+    """
+    The terms a file must contain to match a query. Compound identifiers
+    are matched by their words, so 'arg_parser' also finds 'ArgParser'.
+    """
+    terms = []
+    for identifier in TOKEN_RE.findall(query):
+        words = [word for part in identifier.split('_') for word in WORD_RE.findall(part)]
+        for term in (words if len(words) > 1 else [identifier]):
+            if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH:
+                terms.append(term.lower())
+    return list(dict.fromkeys(terms))[:MAX_QUERY_TERMS]
+
+
+def _postings(file_id, repository_id, text):
+    counts = Counter(tokens(text)).most_common(MAX_TERMS_PER_FILE)
+    return [
+        SearchPosting(
+            file_id=file_id, repository_id=repository_id, term=term,
+            weight=1 + math.log(count),
+        )
+        for term, count in counts
+    ]
+
+
+def index_files(files):
+    """
+    (Re)index files given as (file_id, repository_id, text) triples.
+    """
+    files = list(files)
+    if not files:
+        return
+    SearchPosting.objects.filter(file_id__in=[file_id for file_id, _, _ in files]).delete()
+    postings = []
+    for file_id, repository_id, text in files:
+        postings.extend(_postings(file_id, repository_id, text))
+    SearchPosting.objects.bulk_create(postings, batch_size=1000)
+    cache.delete('search:file-count')
+
+
+def index_file(repo_file):
+    """(Re)index a single saved RepoFile."""
+    index_files([(repo_file.pk, repo_file.repository_id, repo_file.content)])
+
+
+def rebuild(chunk_size=200):
+    """Reindex every file. Returns the number of files indexed."""
+    SearchPosting.objects.all().delete()
+    files = RepoFile.objects.select_related('blob').only(
+        'id', 'repository_id', 'blob__data', 'blob__compressed',
+    ).order_by('pk')
+    batch = []
+    indexed = 0
+    for repo_file in files.iterator(chunk_size=chunk_size):
+        batch.append((repo_file.pk, repo_file.repository_id, repo_file.content))
+        if len(batch) >= chunk_size:
+            index_files(batch)
+            indexed += len(batch)
+            batch = []
+    index_files(batch)
+    return indexed + len(batch)
+
+
+def _indexed_file_count():
+    # Only feeds the idf, so a few minutes out of date is fine
+    count = cache.get('search:file-count')
+    if count is None:
+        count = RepoFile.objects.count()
+        cache.set('search:file-count', count, 300)
+    return count
+
+
+def visible_to(user):
+    """Q over postings restricted to repositories the user may read."""
+    visible = Q(repository__visibility='public')
+    if user.is_authenticated:
+        visible |= Q(repository__owner=user)
+    return visible
+
+
+def search(user, query, page=1, per_page=20):
+    """
+    Return (results, total) for a query. results is one page of dicts with
+    the matching 'file', its 'score' and its 'snippets', best match first.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return [], 0
+
+    # Document frequency of each term across the instance; a term nobody
+    # uses means no file can match all of them
+    frequencies = dict(
+        SearchPosting.objects.filter(term__in=terms)
+        .values('term').annotate(files=Count('id')).values_list('term', 'files')
+    )
+    if len(frequencies) < len(terms):
+        return [], 0
+    documents = max(_indexed_file_count(), max(frequencies.values()))
+    idf = {term: math.log(1 + documents / frequencies[term]) for term in terms}
+
+    matches = (
+        SearchPosting.objects.filter(visible_to(user), term__in=terms)
+        .values('file')
+        .annotate(
+            matched=Count('term'),
+            score=Sum(
+                F('weight') * Case(
+                    *[When(term=term, then=Value(idf[term])) for term in terms],
+                    output_field=FloatField(),
+                ),
+                output_field=FloatField(),
+            ),
+        )
+        .filter(matched=len(terms))
+    )
+    total = matches.count()
+    offset = (page - 1) * per_page
+    ranked = list(matches.order_by('-score', 'file')[offset:offset + per_page])
+    if not ranked:
+        return [], total
+
+    files = RepoFile.objects.select_related('repository__owner', 'blob').only(
+        'id', 'file_path', 'size', 'updated_at', 'blob__data', 'blob__compressed',
+        'repository__name', 'repository__visibility', 'repository__owner__username',
+    ).in_bulk([row['file'] for row in ranked])
+
+    results = []
+    for row in ranked:
+        repo_file = files.get(row['file'])
+        if repo_file is None:
+            continue # Deleted since the ranking query
+        results.append({
+            'file': repo_file,
+            'score': row['score'],
+            'snippets': snippets(repo_file.content, terms),
+        })
+    return results, total
+
+
+def _highlight(line, pattern):
+    """Split a line into [(text, is_match)] segments."""
+    segments = []
+    position = 0
+    for match in pattern.finditer(line):
+        if match.start() > position:
+            segments.append((line[position:match.start()], False))
+        segments.append((match.group(), True))
+        position = match.end()
+    if position < len(line):
+        segments.append((line[position:], False))
+    return segments
+
+
+def snippets(text, terms, limit=SNIPPET_LINES):
+    """
+    The first lines of text that contain a search term, as dicts with the
+    1-based 'line' number and highlighted 'segments'.
+    """
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    found = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if pattern.search(line):
+            line = line.strip()[:SNIPPET_WIDTH]
+            found.append({'line': number, 'segments': _highlight(line, pattern)})
+            if len(found) >= limit:
+                break
+    return found
+
+
+def result_json(result):
+    """JSON form of a search result, with match offsets instead of segments."""
+    repo_file = result['file']
+    repo = repo_file.repository
+    snippets_json = []
+    for snippet in result['snippets']:
+        text, matches, offset = '', [], 0
+        for segment, is_match in snippet['segments']:
+            if is_match:
+                matches.append([offset, offset + len(segment)])
+            text += segment
+            offset += len(segment)
+        snippets_json.append({'line': snippet['line'], 'text': text, 'matches': matches})
+    return {
+        'repository': f'{repo.owner.username}/{repo.name}',
+        'path': repo_file.file_path,
+        'url': reverse('file_view', args=[repo.owner.username, repo.name, repo_file.id]),
+        'score': round(result['score'], 4),
+        'snippets': snippets_json,
+    }
@@ -0,0 +1,197 @@
+# core/sessions.py
+
+"""
+Interactive run-code sessions.
+
+A program that calls input() keeps running in its worker process, suspended
+inside the input() call, until the browser sends the next value. Sessions are
+looked up by an unguessable id and reaped after a period of inactivity so an
+abandoned tab cannot hold a worker forever.
+"""
+
+import secrets
+import threading
+import time
+
+from . import executor
+
+
+class SessionNotFound(Exception):
+    """Raised when a session id is unknown, finished or already reaped."""
+
+
+class TooManySessions(Exception):
+    """Raised when the maximum number of suspended sessions is reached."""
+
+
+class ExecutionSession:
+    """
+    A job that is suspended at an input() call, together with the worker
+    running it.
+    """
+    def __init__(self, worker):
+        self.id = secrets.token_urlsafe(16)
+        self.worker = worker
+        self.last_active = time.monotonic()
+
+
+class SessionManager:
+    """
+    Keeps track of suspended sessions for one execution pool.
+    """
+    def __init__(self, pool, idle_timeout, max_sessions, reap_interval=5):
+        self.pool = pool
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.reap_interval = reap_interval
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def start(self, job):
+        """
+        Run a job interactively. Returns the response payload; when the
+        program waits for input, the payload carries a 'session_id'.
+        """
+        with self._lock:
+            if len(self._sessions) >= self.max_sessions:
+                raise TooManySessions()
+
+        job = dict(job, interactive=True)
+        worker = self.pool.acquire()
+        try:
+            reply = worker.run(job, self.pool.job_timeout)
+        except Exception:
+            self.pool.release(worker, healthy=False)
+            raise
+        return self._handle_reply(ExecutionSession(worker), reply)
+
+    def resume(self, session_id, value):
+        """
+        Send the next input() value to a suspended session and return the
+        response payload.
+        """
+        # Taking the session out of the table keeps the reaper (and a second
+        # request with the same id) away from it while it runs.
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            raise SessionNotFound()
+
+        try:
+            reply = session.worker.resume(value, self.pool.job_timeout)
+        except Exception:
+            self.pool.release(session.worker, healthy=False)
+            raise
+        return self._handle_reply(session, reply)
+
+    def start_stream(self, job):
+        """
+        Like start(), but a generator of (kind, payload) events:
+        ('stdout', text) and ('stderr', text) while the program runs, then
+        ('done', payload) with the same payload start() would return.
+
+        Nothing is reserved until the first event is requested, so a stream
+        that is never consumed holds no worker.
+        """
+        with self._lock:
+            if len(self._sessions) >= self.max_sessions:
+                raise TooManySessions()
+
+        job = dict(job, interactive=True, stream=True)
+        worker = self.pool.acquire()
+        yield from self._stream(ExecutionSession(worker), worker.stream(job, self.pool.job_timeout))
+
+    def resume_stream(self, session_id, value):
+        """Like resume(), but a generator of events as start_stream()."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            raise SessionNotFound()
+        yield from self._stream(session, session.worker.stream_resume(value, self.pool.job_timeout))
+
+    def _stream(self, session, messages):
+        finished = False
+        try:
+            for kind, payload in messages:
+                if kind in ('result', 'input'):
+                    finished = True
+                    yield 'done', self._handle_reply(session, (kind, payload))
+                else:
+                    yield kind, payload
+        finally:
+            # Timed out, crashed, or the client went away mid-stream
+            if not finished:
+                self.pool.release(session.worker, healthy=False)
+
+    def close(self, session_id):
+        """Abandon a session and kill the program it was running."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self.pool.release(session.worker, healthy=False)
+
+    def _handle_reply(self, session, reply):
+        kind, payload = reply
+        if kind == 'input':
+            session.last_active = time.monotonic()
+            with self._lock:
+                self._sessions[session.id] = session
+            self._ensure_reaper()
+            return {
+                'status': 'input_required',
+                'session_id': session.id,
+                'prompt': payload['prompt'],
+                'output': payload['output'],
+            }
+
+        # The program finished: the worker goes back to the pool
+        return self.pool.finish(session.worker, payload)
+
+    def _ensure_reaper(self):
+        if self._reaper is None:
+            with self._lock:
+                if self._reaper is None:
+                    self._reaper = threading.Thread(
+                        target=self._reap_forever, name='run-code-session-reaper', daemon=True,
+                    )
+                    self._reaper.start()
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(self.reap_interval)
+            self.reap()
+
+    def reap(self):
+        """Kill every session that has been idle longer than the timeout."""
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            expired = [
+                session_id for session_id, session in self._sessions.items()
+                if session.last_active < deadline
+            ]
+            stale = [self._sessions.pop(session_id) for session_id in expired]
+        for session in stale:
+            self.pool.release(session.worker, healthy=False)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    """
+    Return the process-wide session manager for the shared execution pool.
+    """
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                from django.conf import settings
+
+                _manager = SessionManager(
+                    executor.get_pool(),
+                    idle_timeout=settings.RUN_CODE_SESSION_IDLE_TIMEOUT,
+                    max_sessions=settings.RUN_CODE_MAX_SESSIONS,
+                )
+    return _manager
@@ -0,0 +1,41 @@
+# core/signals.py
+
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import highlight, revisions, search, tree
+from .models import Blob, Repository, RepoFile
+
+
+def bump_content_version(repository_id):
+    """
+    Mark a repository's files as changed, invalidating cached downloads.
+    """
+    Repository.objects.filter(pk=repository_id).update(
+        content_version=F('content_version') + 1,
+        content_updated_at=timezone.now(),
+    )
+
+
+@receiver(post_save, sender=RepoFile)
+def repo_file_saved(sender, instance, created, update_fields, **kwargs):
+    bump_content_version(instance.repository_id)
+    if created:
+        tree.add_file(instance.repository_id, instance.directory)
+    if update_fields is None or 'blob' in update_fields:
+        search.index_file(instance)
+        revisions.record([(instance.pk, instance.content, None)])
+
+
+@receiver(post_delete, sender=RepoFile)
+def repo_file_deleted(sender, instance, **kwargs):
+    bump_content_version(instance.repository_id)
+    tree.remove_file(instance.repository_id, instance.directory)
+    Blob.release(instance.blob_id)
+
+
+@receiver(post_delete, sender=Blob)
+def blob_deleted(sender, instance, **kwargs):
+    highlight.evict(instance.pk)
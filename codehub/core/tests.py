@@ -1,3 +1,1012 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import os
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.messages import get_messages
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import (
+    archives, artifacts, checks, executor, highlight, patches, result_cache, revisions, search, sessions, tree,
+)
+from .models import Blob, FileRevision, RepoDirectory, RepoFile, Repository, SearchPosting
+
+
+class RepositoryMixin:
+    """A user with a repository, and a helper to add files to it."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('alice', password='secret')
+        self.repo = Repository.objects.create(owner=self.user, name='project')
+
+    def add_file(self, path, content, repo=None):
+        repo_file = RepoFile(repository=repo or self.repo, file_path=path)
+        repo_file.content = content
+        repo_file.save()
+        return repo_file
+
+
+class ResultCacheTests(SimpleTestCase):
+
+    def test_deterministic_code_is_cacheable(self):
+        for code in (
+            "print(sum(range(10)))",
+            "import math\nprint(math.sqrt(2))",
+            "import numpy as np\nprint(np.arange(3).sum())",
+            "from collections import Counter\nprint(Counter('abca'))",
+            "name = input('Name: ')\nprint(name.upper())",
+        ):
+            with self.subTest(code=code):
+                self.assertTrue(result_cache.is_cacheable(code))
+
+    def test_nondeterministic_code_is_not_cacheable(self):
+        for code in (
+            "import random\nprint(random.random())",
+            "from numpy.random import rand\nprint(rand())",
+            "import numpy.random as npr\nprint(npr.rand())",
+            "from numpy import random\nprint(random.rand())",
+            "import numpy as np\nprint(np.random.default_rng().integers(10))",
+            "import os.path\nprint(os.path.exists('x'))",
+            "import builtins\nprint(builtins.open('/etc/hostname').read())",
+            "from builtins import open\nprint(open('/etc/hostname').read())",
+            "print(getattr(__builtins__, 'open')('/etc/hostname').read())",
+            "print(eval('1 + 1'))",
+            "exec('print(1)')",
+            "print(__import__('time').time())",
+            "print(().__class__.__base__.__subclasses__())",
+            "def broken(:",
+        ):
+            with self.subTest(code=code):
+                self.assertFalse(result_cache.is_cacheable(code))
+
+
+    @override_settings(RUN_CODE_RESULT_CACHE=True, RUN_CODE_RESULT_CACHE_MAX_BYTES=100)
+    def test_finished_runs_are_stored_and_looked_up(self):
+        caches['run_code'].clear()
+        job = {'code': "print(1 + 1)", 'inputs': []}
+        result = {'status': 'success', 'output': '2\n', 'figures': []}
+        self.assertIsNone(result_cache.lookup(job))
+        result_cache.store(job, result)
+        self.assertEqual(result_cache.lookup(job), result)
+        self.assertIsNone(result_cache.lookup(dict(job, inputs=['x']))) # Inputs are part of the key
+
+        for job, result in (
+            ({'code': "print(input())"}, {'status': 'input_required', 'output': ''}),
+            ({'code': "print('x' * 500)"}, {'status': 'success', 'output': 'x' * 500}),
+            ({'code': "import random\nprint(random.random())"}, {'status': 'success', 'output': '0.5\n'}),
+        ):
+            result_cache.store(job, result)
+            self.assertIsNone(result_cache.lookup(job))
+
+    @override_settings(RUN_CODE_RESULT_CACHE=False)
+    def test_cache_is_opt_in(self):
+        job = {'code': "print(3)"}
+        result_cache.store(job, {'status': 'success', 'output': '3\n'})
+        self.assertIsNone(result_cache.lookup(job))
+
+    @override_settings(RUN_CODE_RESULT_CACHE=True)
+    def test_streamed_runs_are_recorded_and_replayed(self):
+        caches['run_code'].clear()
+        job = {'code': "print('a')\nprint('b')"}
+        events = [('stdout', 'a\n'), ('stderr', 'b\n'), ('done', {'status': 'success', 'output': '', 'figures': []})]
+        self.assertEqual(list(result_cache.recording(job, iter(events))), events)
+
+        cached = result_cache.lookup(job)
+        self.assertEqual(cached['output'], 'a\nb\n')
+        self.assertEqual(list(result_cache.replay(cached)), [('done', cached)])
+
+
+class ExecutionPoolTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pool = executor.ExecutionPool(
+            size=1, queue_size=0, queue_timeout=5, job_timeout=5, cpu_seconds=1,
+            memory_mb=256, max_jobs_per_worker=100, max_output=1000,
+        )
+        cls.pool.start()
+        cls.addClassCleanup(cls.pool.shutdown)
+
+    def run_code(self, code, **job):
+        return self.pool.run({'code': code, **job})
+
+    def worker_pid(self):
+        [worker] = self.pool._workers
+        return worker.process.pid
+
+    def test_output_and_figures(self):
+        result = self.run_code(
+            "import matplotlib.pyplot as plt\nplt.plot([1, 2])\nprint('hello')",
+        )
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(result['output'], 'hello\n')
+        self.assertEqual(len(result['figures']), 1)
+        self.assertTrue(result['figures'][0]['data'].startswith(b'\x89PNG'))
+
+    def test_exit_ends_the_program_not_the_worker(self):
+        pid = self.worker_pid()
+        for code in ("print('answer: 42'); exit()", "import sys\nprint('answer: 42')\nsys.exit(0)"):
+            with self.subTest(code=code):
+                result = self.run_code(code)
+                self.assertEqual(result['status'], 'success')
+                self.assertEqual(result['output'], 'answer: 42\n')
+
+        result = self.run_code("import sys\nsys.exit('bad input')")
+        self.assertEqual((result['status'], result['output']), ('success', 'bad input\n'))
+        # exit() closes stdin; the next job still works in the same process
+        self.assertEqual(self.run_code("print(input())", inputs=['x'])['output'], 'x\n')
+        self.assertEqual(self.worker_pid(), pid)
+
+    def test_keyboard_interrupt_is_an_error(self):
+        pid = self.worker_pid()
+        result = self.run_code("print('before')\nraise KeyboardInterrupt")
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('before', result['output'])
+        self.assertIn('KeyboardInterrupt', result['output'])
+        self.assertEqual(self.worker_pid(), pid)
+
+    def test_output_limit(self):
+        result = self.run_code("print('x' * 5000)")
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('Output limit exceeded', result['output'])
+
+    @unittest.skipIf(executor.resource is None, "resource limits need the resource module")
+    def test_cpu_limit_replaces_the_worker(self):
+        pid = self.worker_pid()
+        result = self.run_code("while True:\n    pass")
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('CPU time limit exceeded', result['output'])
+        self.assertNotEqual(self.worker_pid(), pid)
+        self.assertEqual(self.run_code("print(1)")['output'], '1\n')
+
+    @unittest.skipIf(executor.resource is None, "resource limits need the resource module")
+    def test_memory_limit(self):
+        result = self.run_code("data = bytearray(1024 * 1024 * 1024)")
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('Memory limit exceeded', result['output'])
+
+    def test_wall_clock_timeout(self):
+        with self.assertRaises(executor.ExecutionTimeout):
+            self.pool.run({'code': "import time\ntime.sleep(10)"})
+        self.assertEqual(self.run_code("print(2)")['output'], '2\n')
+
+    def test_repeated_code_is_compiled_once(self):
+        before = self.pool.code_cache_stats()
+        for _ in range(3):
+            self.assertEqual(self.run_code("print('cached')")['output'], 'cached\n')
+        after = self.pool.code_cache_stats()
+        self.assertEqual((after['misses'] - before['misses'], after['hits'] - before['hits']), (1, 2))
+
+    def test_code_cache_evicts_least_recently_used(self):
+        cache = executor.CodeCache(maxsize=2)
+        first = cache.compile('a = 1')
+        cache.compile('b = 2')
+        self.assertIs(cache.compile('a = 1'), first)
+        cache.compile('c = 3') # Evicts 'b = 2'
+        cache.compile('b = 2')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 4, 'size': 2})
+        with self.assertRaises(SyntaxError):
+            cache.compile('def')
+
+    def test_jobs_do_not_share_pyplot_state(self):
+        self.run_code(
+            "import matplotlib.pyplot as plt\nplt.rcParams['lines.linewidth'] = 9\n"
+            "plt.style.use('dark_background')\nplt.figure()",
+        )
+        result = self.run_code(
+            "import matplotlib.pyplot as plt\n"
+            "print(plt.rcParams['lines.linewidth'], plt.rcParams['axes.facecolor'], plt.get_fignums())",
+        )
+        self.assertEqual(result['output'], '1.5 white []\n')
+        self.assertEqual(result['figures'], [])
+
+    def test_figures_of_each_size_render_correctly(self):
+        code = (
+            "import matplotlib.pyplot as plt\n"
+            "for size in [(2, 2), (4, 3), (2, 2)]:\n"
+            "    plt.figure(figsize=size)\n"
+            "    plt.plot([0, 1], [0, 1])\n"
+        )
+        first, second = (
+            [figure['data'] for figure in self.run_code(code, dpi=50)['figures']]
+            for _ in range(2) # The second run draws on pooled renderers
+        )
+        self.assertEqual(second, first)
+        small, large, small_again = (data[16:24] for data in first) # PNG width and height
+        self.assertEqual(small, small_again)
+        self.assertNotEqual(small, large)
+
+    def test_full_queue_is_refused(self):
+        worker = self.pool.acquire()
+        try:
+            with self.assertRaises(executor.PoolBusy):
+                self.pool.acquire()
+        finally:
+            self.pool.release(worker, healthy=True)
+
+
+class SessionTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pool = executor.ExecutionPool(
+            size=1, queue_size=0, queue_timeout=5, job_timeout=5, cpu_seconds=2,
+            memory_mb=256, max_jobs_per_worker=100, max_output=1000,
+        )
+        cls.pool.start()
+        cls.addClassCleanup(cls.pool.shutdown)
+
+    def setUp(self):
+        self.manager = sessions.SessionManager(self.pool, idle_timeout=60, max_sessions=1)
+
+    def worker_pid(self):
+        [worker] = self.pool._workers
+        return worker.process.pid
+
+    def test_program_stays_suspended_between_inputs(self):
+        code = "import os\nprint(os.getpid())\nname = input('Name? ')\nprint('hi', name)\nprint(input())"
+        reply = self.manager.start({'code': code})
+        self.assertEqual(reply['status'], 'input_required')
+        self.assertEqual((reply['prompt'], reply['output']), ('Name? ', f'{self.worker_pid()}\n'))
+
+        reply = self.manager.resume(reply['session_id'], 'Bob')
+        self.assertEqual((reply['status'], reply['output']), ('input_required', 'hi Bob\n'))
+        reply = self.manager.resume(reply['session_id'], 'bye')
+        self.assertEqual((reply['status'], reply['output']), ('success', 'bye\n'))
+        with self.assertRaises(sessions.SessionNotFound):
+            self.manager.resume(reply.get('session_id', 'finished'), 'again')
+
+    def test_session_limit(self):
+        reply = self.manager.start({'code': "input()"})
+        try:
+            with self.assertRaises(sessions.TooManySessions):
+                self.manager.start({'code': "input()"})
+        finally:
+            self.manager.close(reply['session_id'])
+        with self.assertRaises(sessions.SessionNotFound):
+            self.manager.resume(reply['session_id'], 'late')
+
+    def test_idle_sessions_are_reaped(self):
+        [worker] = self.pool._workers
+        reply = self.manager.start({'code': "input()"})
+        self.manager.idle_timeout = -1
+        self.manager.reap()
+        with self.assertRaises(sessions.SessionNotFound):
+            self.manager.resume(reply['session_id'], 'late')
+        # Stopped quietly at its input() and replaced
+        self.assertEqual(worker.process.exitcode, 0)
+        self.assertNotEqual(self.worker_pid(), worker.process.pid)
+        self.assertEqual(self.pool.run({'code': "print(3)"})['output'], '3\n')
+
+    def test_stream_events(self):
+        code = "import sys\nprint('out', flush=True)\nprint('err', file=sys.stderr)\nprint(input('? '))"
+        events = list(self.manager.start_stream({'code': code}))
+        self.assertEqual(events[:2], [('stdout', 'out\n'), ('stderr', 'err\n')])
+        kind, reply = events[2]
+        self.assertEqual((kind, reply['status'], reply['prompt']), ('done', 'input_required', '? '))
+
+        events = list(self.manager.resume_stream(reply['session_id'], 'back'))
+        self.assertEqual(events[0], ('stdout', 'back\n'))
+        self.assertEqual(events[-1][1]['status'], 'success')
+
+    def test_abandoned_stream_gives_the_worker_back(self):
+        [worker] = self.pool._workers
+        events = self.manager.start_stream({'code': "print('a', flush=True)\ninput()"})
+        self.assertEqual(next(events), ('stdout', 'a\n'))
+        events.close() # The client went away
+        self.assertEqual(worker.process.exitcode, 0)
+        self.assertEqual(self.pool.run({'code': "print(4)"})['output'], '4\n')
+
+    def test_stream_view_sends_server_sent_events(self):
+        with mock.patch.object(sessions, 'get_manager', return_value=self.manager):
+            response = self.client.post(
+                '/core/api/run-code/stream/',
+                json.dumps({'code': "import matplotlib.pyplot as plt\nprint('hi')\nplt.plot([1])"}),
+                content_type='application/json',
+            )
+            body = b''.join(response.streaming_content).decode()
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = [
+            (block.split('\n')[0].removeprefix('event: '), json.loads(block.split('\n')[1].removeprefix('data: ')))
+            for block in body.strip().split('\n\n')
+        ]
+        self.assertEqual(events[0], ('stdout', {'text': 'hi\n'}))
+        self.assertEqual(events[1][0], 'plot')
+        self.assertTrue(events[1][1]['url'].startswith('/core/api/artifacts/'))
+        self.assertEqual((events[2][0], events[2][1]['status']), ('done', 'success'))
+
+
+@override_settings(HIGHLIGHT_CHUNK_LINES=2)
+class HighlightTests(RepositoryMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches['highlight'].clear()
+        self.repo_file = self.add_file('app.py', 'def f():\n    return 1\n\nx = "a"\nprint(f())\n')
+
+    def test_chunks(self):
+        html, line_count, chunk_count = highlight.render_chunk(self.repo_file, 0)
+        self.assertEqual((line_count, chunk_count), (5, 3))
+        self.assertIn('id="L1"', html)
+        self.assertIn('id="L2"', html)
+        self.assertNotIn('id="L3"', html)
+        self.assertIn('class="k"', html) # 'def' highlighted as a keyword
+        html, _, _ = highlight.render_chunk(self.repo_file, 2)
+        self.assertIn('id="L5"', html)
+
+    def test_whole_file_is_rendered_once(self):
+        with mock.patch.object(highlight, '_render', wraps=highlight._render) as render:
+            for chunk in (1, 0, 2, 1):
+                highlight.render_chunk(self.repo_file, chunk)
+        self.assertEqual(render.call_count, 1)
+
+    def test_missing_chunks_are_not_rendered(self):
+        with mock.patch.object(highlight, '_render', wraps=highlight._render) as render:
+            self.assertIsNone(highlight.render_chunk(self.repo_file, 3))
+            self.assertIsNone(highlight.render_chunk(self.repo_file, 99999))
+            self.assertIsNone(highlight.render_chunk(self.repo_file, -1))
+            self.assertEqual(render.call_count, 0)
+
+            highlight.render_chunk(self.repo_file, 0)
+            highlight.evict(self.repo_file.blob_id)
+            self.assertIsNone(highlight.render_chunk(self.repo_file, 99999))
+            self.assertEqual(render.call_count, 1)
+
+    def test_line_count_matches_rendering(self):
+        for text in ('', 'a', 'a\n', 'a\nb', 'a\r\nb\r\n', 'a\rb', '\n\n', '"""\ndoc\n"""\n'):
+            with self.subTest(text=text):
+                self.assertEqual(highlight._line_count(text), len(highlight._render(text, 'python')))
+
+    def test_lines_api(self):
+        self.client.force_login(self.user)
+        url = f'/core/alice/project/api/files/{self.repo_file.pk}/lines/'
+        response = self.client.get(url, {'chunk': 1})
+        self.assertEqual(response.json()['next'], 2)
+        not_modified = self.client.get(url, {'chunk': 1}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        self.assertEqual(self.client.get(url, {'chunk': 3}).status_code, 404)
+
+
+class ArtifactTests(SimpleTestCase):
+
+    def test_publish_and_serve(self):
+        result = artifacts.publish({'status': 'success', 'figures': [{'format': 'png', 'data': b'\x89PNG plot'}]})
+        self.assertNotIn('figures', result)
+        [url] = result['images']
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(b''.join(response), b'\x89PNG plot')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(reverse('artifact', args=['0' * 32 + '.png'])).status_code, 404)
+
+    def test_store_is_shared_between_processes(self):
+        self.assertEqual(checks.check_artifact_cache(None), [])
+        local = {'artifacts': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES={**settings.CACHES, **local}):
+            [warning] = checks.check_artifact_cache(None)
+        self.assertEqual(warning.id, 'core.W001')
+
+
+class PatchTests(RepositoryMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+        self.repo_file = self.add_file('notes.txt', 'smile \U0001F600 here\n')
+        self.patch_url = f'/core/alice/project/api/files/{self.repo_file.pk}/patch/'
+        self.edit_url = f'/core/alice/project/edit/{self.repo_file.pk}/'
+
+    def patch(self, base, edits):
+        return self.client.post(self.patch_url, json.dumps({'base': base, 'edits': edits}), content_type='application/json')
+
+    def test_apply_edits_counts_utf16_units(self):
+        # The emoji is two UTF-16 code units, so 'here' starts at 9
+        text = self.repo_file.content
+        self.assertEqual(patches.apply_edits(text, patches.parse_edits([[9, 13, 'there']])), 'smile \U0001F600 there\n')
+        with self.assertRaises(patches.PatchError):
+            patches.apply_edits(text, patches.parse_edits([[7, 8, 'x']])) # Half of the emoji
+        with self.assertRaises(patches.PatchError):
+            patches.parse_edits([[5, 6, 'a'], [0, 1, 'b']])
+
+    def test_patch(self):
+        base = self.repo_file.blob_id
+        response = self.patch(base, [[0, 5, 'Smile']])
+        self.assertEqual(response.status_code, 200)
+        self.repo_file = RepoFile.objects.get(pk=self.repo_file.pk)
+        self.assertEqual(response.json()['sha256'], self.repo_file.blob_id)
+        self.assertEqual(self.repo_file.content, 'Smile \U0001F600 here\n')
+
+    def test_patch_against_stale_version_conflicts(self):
+        base = self.repo_file.blob_id
+        self.assertEqual(self.patch(base, [[0, 5, 'Smile']]).status_code, 200)
+        response = self.patch(base, [[0, 5, 'SMILE']])
+        self.assertEqual(response.status_code, 409)
+        self.repo_file = RepoFile.objects.get(pk=self.repo_file.pk)
+        self.assertEqual(response.json(), {'error': 'conflict', 'sha256': self.repo_file.blob_id})
+        self.assertEqual(self.repo_file.content, 'Smile \U0001F600 here\n')
+
+    def test_form_save_against_stale_version_conflicts(self):
+        base = self.repo_file.blob_id
+        self.assertEqual(self.client.post(self.edit_url, {'content': 'first', 'base': base}).status_code, 302)
+        response = self.client.post(self.edit_url, {'content': 'second', 'base': base})
+        self.assertEqual(response.status_code, 409)
+        self.assertContains(response, 'second', status_code=409) # The unsaved text is kept in the editor
+        self.repo_file = RepoFile.objects.get(pk=self.repo_file.pk)
+        self.assertEqual(self.repo_file.content, 'first')
+
+    def test_only_the_owner_can_patch(self):
+        User.objects.create_user('bob', password='secret')
+        self.client.login(username='bob', password='secret')
+        self.assertEqual(self.patch(self.repo_file.blob_id, [[0, 1, 'x']]).status_code, 404)
+
+
+class UploadTests(RepositoryMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def zip_bytes(self, files):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            for path, text in files.items():
+                zf.writestr(path, text)
+        return archive.getvalue()
+
+    def upload(self, files, directory='', name='upload.zip', data=None):
+        if data is None:
+            data = self.zip_bytes(files)
+        upload = SimpleUploadedFile(name, data)
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/core/alice/project/upload/', {'files': [upload], 'directory': directory})
+
+    def assertRejected(self, response, message):
+        self.assertRedirects(response, '/core/alice/project/upload/', fetch_redirect_response=False)
+        [error] = [str(m) for m in get_messages(response.wsgi_request)]
+        self.assertIn(message, error)
+        self.assertFalse(self.repo.files.exists())
+
+    def search(self, query):
+        results, _ = search.search(self.user, query)
+        return sorted(result['file'].file_path for result in results)
+
+    def test_archive_upload_does_the_bookkeeping_of_a_save(self):
+        self.upload({
+            'src/app.py': 'def handler():\n    return quokka\n',
+            'src/lib/util.py': 'quokka = 1\n',
+            'README.md': 'quokka = 1\n', # Same content as util.py
+            '__MACOSX/._app.py': 'clutter',
+            'logo.png': b'\x89PNG\0binary',
+        })
+        self.assertEqual(
+            sorted(self.repo.files.values_list('file_path', flat=True)),
+            ['README.md', 'src/app.py', 'src/lib/util.py'],
+        )
+        self.assertEqual(Blob.objects.count(), 2)
+        self.assertEqual(
+            dict(RepoDirectory.objects.filter(repository=self.repo).values_list('path', 'file_count')),
+            {'src': 2, 'src/lib': 1},
+        )
+        self.assertEqual(self.search('quokka'), ['README.md', 'src/app.py', 'src/lib/util.py'])
+        self.assertEqual(FileRevision.objects.count(), 3)
+        self.repo.refresh_from_db()
+        self.assertEqual(self.repo.content_version, 1)
+
+    def test_reupload_updates_search_history_and_blobs(self):
+        self.upload({'app.py': 'wombat = 1\n'})
+        old_blob = RepoFile.objects.get().blob_id
+        self.upload({'app.py': 'numbat = 2\n'})
+
+        repo_file = RepoFile.objects.get()
+        self.assertEqual(self.search('wombat'), [])
+        self.assertEqual(self.search('numbat'), ['app.py'])
+        self.assertEqual(list(repo_file.revisions.values_list('number', flat=True).order_by('number')), [1, 2])
+        self.assertFalse(Blob.objects.filter(pk=old_blob).exists()) # Released once unused
+
+    def test_corrupt_zip_entry_is_rejected(self):
+        data = bytearray(self.zip_bytes({'ok.py': 'fine\n', 'a.py': 'original\n'}))
+        position = data.rindex(b'original')
+        data[position] = ord('O') # Same length, wrong CRC
+        self.assertRejected(self.upload({}, data=bytes(data)), "'a.py' in 'upload.zip' is corrupt")
+
+    def test_encrypted_zip_entry_is_rejected(self):
+        data = bytearray(self.zip_bytes({'ok.py': 'fine\n', 'secret.py': 'x = 1\n'}))
+        # Set the "encrypted" flag of the second entry in its local header
+        # and in the central directory
+        local = data.index(b'PK\x03\x04', 1)
+        central = data.index(b'PK\x01\x02', data.index(b'PK\x01\x02') + 1)
+        data[local + 6] |= 1
+        data[central + 8] |= 1
+        self.assertRejected(self.upload({}, data=bytes(data)), "'secret.py' in 'upload.zip' is corrupt, encrypted")
+
+    def test_truncated_tarball_is_rejected(self):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tf:
+            for path, text in (('ok.py', 'fine\n'), ('big.py', 'x = 1\n' * 10000)):
+                info = tarfile.TarInfo(path)
+                info.size = len(text)
+                tf.addfile(info, io.BytesIO(text.encode()))
+        data = archive.getvalue()
+        response = self.upload({}, name='upload.tar.gz', data=data[:len(data) // 2])
+        self.assertRejected(response, "'upload.tar.gz' is truncated or corrupt.")
+
+    def test_path_traversal_is_ignored(self):
+        self.upload({'../../etc/passwd': 'x', 'ok.txt': 'fine'}, directory='docs')
+        self.assertEqual(list(self.repo.files.values_list('file_path', flat=True)), ['docs/ok.txt'])
+
+
+class BlobTests(RepositoryMixin, TestCase):
+
+    def test_identical_contents_share_one_blob(self):
+        other = Repository.objects.create(owner=self.user, name='fork')
+        first = self.add_file('a.py', 'same = 1\n')
+        second = self.add_file('a.py', 'same = 1\n', repo=other)
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertEqual(RepoFile.objects.get(pk=second.pk).content, 'same = 1\n')
+
+    @override_settings(BLOB_COMPRESS_MIN_SIZE=16)
+    def test_large_contents_are_compressed(self):
+        text = 'x = 1\n' * 100 + 'caf\u00e9 \ud800\n' # Lone surrogates survive too
+        repo_file = self.add_file('big.py', text)
+        blob = Blob.objects.get()
+        self.assertTrue(blob.compressed)
+        self.assertLess(len(bytes(blob.data)), blob.size)
+        self.assertEqual(repo_file.size, blob.size)
+        self.assertEqual(RepoFile.objects.get(pk=repo_file.pk).content, text)
+
+    def test_blob_is_released_with_its_last_file(self):
+        first = self.add_file('a.py', 'shared\n')
+        second = self.add_file('b.py', 'shared\n')
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(Blob.objects.filter(pk=second.blob_id).exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(Blob.objects.exists())
+
+    def test_old_blob_is_released_when_content_changes(self):
+        repo_file = self.add_file('a.py', 'old\n')
+        old_blob = repo_file.blob_id
+        with self.captureOnCommitCallbacks(execute=True):
+            repo_file.content = 'new\n'
+            repo_file.save()
+        self.assertEqual(list(Blob.objects.values_list('pk', flat=True)), [repo_file.blob_id])
+        self.assertNotEqual(repo_file.blob_id, old_blob)
+
+    def test_release_keeps_a_blob_picked_up_again(self):
+        repo_file = self.add_file('a.py', 'kept\n')
+        with self.captureOnCommitCallbacks() as callbacks:
+            repo_file.delete()
+        self.add_file('b.py', 'kept\n') # Before the release runs
+        for callback in callbacks:
+            callback()
+        self.assertTrue(Blob.objects.filter(pk=repo_file.blob_id).exists())
+
+
+class BlobMigrationTests(TransactionTestCase):
+    before = [('core', '0002_repository_content_version')]
+    after = [('core', '0003_blob_storage')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        super().tearDown()
+
+    def test_contents_move_into_shared_blobs_and_back(self):
+        apps = self.migrate(self.before)
+        owner = apps.get_model('auth', 'User').objects.create(username='alice')
+        repo = apps.get_model('core', 'Repository').objects.create(owner_id=owner.pk, name='project')
+        OldFile = apps.get_model('core', 'RepoFile')
+        contents = {'a.py': 'same\n', 'b.py': 'same\n', 'c.py': 'y = 2\n' * 100, 'd.py': ''}
+        for path, text in contents.items():
+            OldFile.objects.create(repository_id=repo.pk, file_path=path, content=text)
+
+        apps = self.migrate(self.after)
+        NewFile = apps.get_model('core', 'RepoFile')
+        self.assertEqual(apps.get_model('core', 'Blob').objects.count(), 3)
+        for repo_file in NewFile.objects.select_related('blob'):
+            blob = Blob(data=repo_file.blob.data, compressed=repo_file.blob.compressed)
+            self.assertEqual(blob.text, contents[repo_file.file_path])
+            self.assertEqual(repo_file.blob.size, len(contents[repo_file.file_path]))
+        self.assertTrue(NewFile.objects.get(file_path='c.py').blob.compressed)
+
+        apps = self.migrate(self.before)
+        self.assertEqual(
+            dict(apps.get_model('core', 'RepoFile').objects.values_list('file_path', 'content')),
+            contents,
+        )
+
+
+class StreamZipTests(RepositoryMixin, TestCase):
+
+    def test_entries_are_yielded_as_they_are_compressed(self):
+        modified = datetime.datetime(1975, 6, 1) # Clamped to the ZIP epoch
+        entries = [(f'dir/{n}.txt', f'line {n}\n' * 1000, modified) for n in range(3)]
+        chunks = list(archives.stream_zip(iter(entries), compresslevel=1))
+        self.assertEqual(len(chunks), 4) # One per entry, then the central directory
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ['dir/0.txt', 'dir/1.txt', 'dir/2.txt'])
+            self.assertEqual(zf.read('dir/2.txt').decode(), 'line 2\n' * 1000)
+            self.assertEqual(zf.getinfo('dir/0.txt').date_time, (1980, 1, 1, 0, 0, 0))
+
+    def test_repository_archive_holds_every_file(self):
+        self.add_file('src/main.py', 'print("hi")\n')
+        self.add_file('README.md', 'caf\u00e9\n')
+        archive = b''.join(archives.stream_repository_zip(self.repo))
+        with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+            self.assertEqual(zf.namelist(), ['README.md', 'src/main.py'])
+            self.assertEqual(zf.read('README.md').decode(), 'caf\u00e9\n')
+
+
+class ArchiveDownloadTests(RepositoryMixin, TestCase):
+    url = '/core/alice/project/download/'
+
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.enterContext(override_settings(REPO_ARCHIVE_CACHE_DIR=cache_dir.name))
+        self.cache_dir = cache_dir.name
+        self.client.force_login(self.user)
+        self.repo_file = self.add_file('main.py', 'print(1)\n')
+
+    def download(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, body
+
+    def names(self, body):
+        with zipfile.ZipFile(io.BytesIO(body)) as zf:
+            return {name: zf.read(name).decode() for name in zf.namelist()}
+
+    def test_unchanged_repository_answers_304(self):
+        response, body = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.names(body), {'main.py': 'print(1)\n'})
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        response, body = self.download(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(body, b'')
+        response, _ = self.download(if_modified_since=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_second_download_is_served_from_the_cache(self):
+        _, first = self.download()
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        with mock.patch.object(archives, 'stream_repository_zip') as stream:
+            response, second = self.download()
+        stream.assert_not_called()
+        self.assertEqual(second, first)
+
+    def test_edit_changes_the_etag_and_replaces_the_cached_archive(self):
+        response, _ = self.download()
+        old_etag = response['ETag']
+        self.repo_file.content = 'print(2)\n'
+        self.repo_file.save()
+
+        response, body = self.download(if_none_match=old_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], old_etag)
+        self.assertEqual(self.names(body), {'main.py': 'print(2)\n'})
+        self.assertEqual(os.listdir(self.cache_dir), [f'{archives.archive_version(Repository.objects.get())}.zip'])
+
+    def test_only_the_owner_can_download(self):
+        User.objects.create_user('bob', password='secret')
+        self.client.login(username='bob', password='secret')
+        response, _ = self.download()
+        self.assertEqual(response.status_code, 302)
+
+
+class RepositoryListingTests(RepositoryMixin, TestCase):
+
+    def test_listing_reads_metadata_but_no_contents(self):
+        for n in range(5):
+            self.add_file(f'file{n}.py', 'x' * (n + 1))
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/core/alice/project/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry.size for entry in response.context['entries']], [1, 2, 3, 4, 5])
+        self.assertFalse([q['sql'] for q in queries if 'core_blob' in q['sql']])
+
+        for n in range(5, 10):
+            self.add_file(f'file{n}.py', 'y')
+        with self.assertNumQueries(len(queries)):
+            self.client.get('/core/alice/project/')
+
+
+class TreeTests(RepositoryMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def folders(self):
+        return dict(self.repo.directories.values_list('path', 'file_count'))
+
+    def test_folder_counts_follow_files(self):
+        self.add_file('src//app/./main.py', '')
+        self.add_file('src/app/util.py', '')
+        self.add_file('src/setup.py', '')
+        self.add_file('README.md', '')
+        self.assertEqual(self.folders(), {'src': 3, 'src/app': 2})
+        self.assertEqual(RepoFile.objects.get(file_path='src//app/./main.py').directory, 'src/app')
+
+        RepoFile.objects.get(file_path='src/app/util.py').delete()
+        self.assertEqual(self.folders(), {'src': 2, 'src/app': 1})
+        RepoFile.objects.get(file_path='src//app/./main.py').delete()
+        self.assertEqual(self.folders(), {'src': 1})
+
+        incremental = self.folders()
+        tree.rebuild(self.repo)
+        self.assertEqual(self.folders(), incremental)
+
+    def test_folders_are_listed_before_files_and_paged(self):
+        for path in ('b.txt', 'a.txt', 'zeta/x.py', 'alpha/y.py'):
+            self.add_file(path, '')
+        page = tree.list_folder(self.repo, '', per_page=3)
+        self.assertEqual([entry.name for entry in page.object_list], ['alpha', 'zeta', 'a.txt'])
+        page = tree.list_folder(self.repo, '', page_number=2, per_page=3)
+        self.assertEqual([entry.name for entry in page.object_list], ['b.txt'])
+
+    def test_tree_api_and_folder_pages(self):
+        self.add_file('src/app/main.py', 'print(1)\n')
+        response = self.client.get('/core/alice/project/api/tree/', {'path': 'src/'})
+        self.assertEqual(response.json()['entries'], [
+            {'type': 'dir', 'name': 'app', 'path': 'src/app', 'file_count': 1},
+        ])
+        entry = self.client.get('/core/alice/project/api/tree/', {'path': 'src/app'}).json()['entries'][0]
+        self.assertEqual((entry['type'], entry['path'], entry['size']), ('file', 'src/app/main.py', 9))
+
+        self.assertEqual(self.client.get('/core/alice/project/tree/src/app/').status_code, 200)
+        self.assertEqual(self.client.get('/core/alice/project/tree/missing/').status_code, 404)
+        self.assertEqual(self.client.get('/core/alice/project/api/tree/', {'path': 'missing'}).status_code, 404)
+
+
+@override_settings(DASHBOARD_PAGE_SIZE=2)
+class DashboardPaginationTests(RepositoryMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        bob = User.objects.create_user('bob')
+        for n in range(4):
+            Repository.objects.create(owner=bob, name=f'public{n}')
+        Repository.objects.create(owner=bob, name='hidden', visibility='private')
+        # Same timestamp everywhere: pages must still be split on the id
+        Repository.objects.update(updated_at=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc))
+        self.client.force_login(self.user)
+
+    def pages(self, section, cursor=None):
+        names = []
+        while True:
+            data = self.client.get('/core/api/repositories/', {'section': section, 'cursor': cursor or ''}).json()
+            names.append([repo['name'] for repo in data['repositories']])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return names
+
+    def test_sections_are_paged_newest_first_without_gaps(self):
+        self.assertEqual(self.pages('public'), [['public3', 'public2'], ['public1', 'public0']])
+        self.assertEqual(self.pages('mine'), [['project']])
+        self.assertEqual(self.client.get('/core/api/repositories/', {'section': 'other'}).status_code, 400)
+
+    def test_updated_repository_does_not_shift_later_pages(self):
+        first = self.client.get('/core/api/repositories/', {'section': 'public'}).json()
+        Repository.objects.get(name='public0').save() # Now the newest
+        rest = self.pages('public', first['next_cursor'])
+        self.assertEqual(rest, [['public1']])
+
+    def test_malformed_cursor_starts_over(self):
+        self.assertEqual(self.pages('public', 'not-a-cursor')[0], ['public3', 'public2'])
+
+    def test_query_count_does_not_grow_with_the_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/core/dashboard/')
+        for n in range(4, 10):
+            Repository.objects.create(owner=User.objects.create_user(f'user{n}'), name=f'public{n}')
+        with self.assertNumQueries(len(queries)), override_settings(DASHBOARD_PAGE_SIZE=10):
+            self.client.get('/core/dashboard/')
+
+
+class ExplainQueriesTests(RepositoryMixin, TestCase):
+
+    def explain(self, *args):
+        out = io.StringIO()
+        call_command('explain_queries', *args, stdout=out)
+        return out.getvalue()
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'Checks SQLite query plans')
+    def test_dashboard_pages_walk_their_indexes(self):
+        self.add_file('README.md', '')
+        sections = self.explain('--user', 'alice', '--repo', 'alice/project').split('Dashboard: ')[1:5]
+        self.assertEqual(len(sections), 4)
+        for section in sections:
+            self.assertRegex(section, 'repo_(owner|visibility)_updated_idx')
+            self.assertNotIn('TEMP B-TREE', section)
+
+    def test_runs_on_an_empty_database(self):
+        Repository.objects.all().delete()
+        User.objects.all().delete()
+        self.assertIn('user: nobody, repository: nobody/nothing', self.explain('--sql'))
+
+    def test_unknown_names_are_reported(self):
+        with self.assertRaisesMessage(CommandError, "User 'nobody' does not exist."):
+            self.explain('--user', 'nobody')
+        with self.assertRaisesMessage(CommandError, "Repository 'alice/missing' does not exist."):
+            self.explain('--repo', 'alice/missing')
+
+
+class DatabaseTests(TransactionTestCase):
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'Checks the SQLite connection options')
+    def test_sqlite_connections_queue_writers(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1) # NORMAL
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.DATABASES['default']['OPTIONS']['timeout'] * 1000)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+    def test_save_stores_the_blob_again_if_it_vanished(self):
+        repo = Repository.objects.create(owner=User.objects.create_user('alice'), name='project')
+        store = Blob.store
+        calls = []
+
+        def released_meanwhile(text):
+            # The first time, another request deletes the blob between the
+            # check and the insert of the file row
+            calls.append(text)
+            digest = store(text)
+            if len(calls) == 1:
+                Blob.objects.filter(pk=digest).delete()
+            return digest
+
+        repo_file = RepoFile(repository=repo, file_path='a.py')
+        repo_file.content = 'raced\n'
+        with mock.patch.object(Blob, 'store', side_effect=released_meanwhile):
+            repo_file.save()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(RepoFile.objects.get().blob.text, 'raced\n')
+
+
+class SearchTests(RepositoryMixin, TestCase):
+
+    def paths(self, query, user=None):
+        results, total = search.search(user or self.user, query)
+        self.assertEqual(total, len(results))
+        return [result['file'].file_path for result in results]
+
+    def test_compound_identifiers_are_split_into_words(self):
+        self.assertEqual(list(search.tokens('parseArgs(HTTPServer) x')), [
+            'parseargs', 'parse', 'args', 'httpserver', 'http', 'server',
+        ])
+        self.assertEqual(search.query_terms('arg_parser ArgParser'), ['arg', 'parser'])
+
+    def test_edit_moves_the_hit(self):
+        repo_file = self.add_file('app.py', 'def load_config():\n    pass\n')
+        self.assertEqual(self.paths('load_config'), ['app.py'])
+        self.assertEqual(self.paths('loadConfig'), ['app.py'])
+
+        repo_file.content = 'def save_report():\n    pass\n'
+        repo_file.save()
+        self.assertEqual(self.paths('load_config'), [])
+        self.assertEqual(self.paths('save_report'), ['app.py'])
+
+        repo_file.delete()
+        self.assertEqual(self.paths('save_report'), [])
+        self.assertFalse(SearchPosting.objects.exists())
+
+    def test_all_terms_must_match_and_frequent_use_ranks_first(self):
+        self.add_file('one.py', 'token = 1\n')
+        self.add_file('many.py', 'token = token + token\nother = 2\n')
+        self.assertEqual(self.paths('token'), ['many.py', 'one.py'])
+        self.assertEqual(self.paths('token other'), ['many.py'])
+        self.assertEqual(self.paths('token missing'), [])
+
+    def test_private_repositories_of_others_are_hidden(self):
+        bob = User.objects.create_user('bob')
+        secret = Repository.objects.create(owner=bob, name='secret', visibility='private')
+        shared = Repository.objects.create(owner=bob, name='shared')
+        self.add_file('hidden.py', 'needle = 1\n', repo=secret)
+        self.add_file('open.py', 'needle = 2\n', repo=shared)
+        self.assertEqual(self.paths('needle'), ['open.py'])
+        self.assertEqual(sorted(self.paths('needle', user=bob)), ['hidden.py', 'open.py'])
+
+    def test_api_returns_match_offsets(self):
+        self.add_file('app.py', 'x = 1\n    value = compute(x)\n')
+        self.client.force_login(self.user)
+        data = self.client.get('/core/api/search/', {'q': 'compute'}).json()
+        self.assertEqual(data['total'], 1)
+        snippet = data['results'][0]['snippets'][0]
+        self.assertEqual(snippet, {'line': 2, 'text': 'value = compute(x)', 'matches': [[8, 15]]})
+        self.assertEqual(data['results'][0]['repository'], 'alice/project')
+
+    def test_rebuild_restores_the_index(self):
+        self.add_file('a.py', 'alpha beta\n')
+        self.add_file('b.py', 'beta gamma\n')
+        before = sorted(SearchPosting.objects.values_list('file__file_path', 'term', 'weight'))
+        SearchPosting.objects.all().delete()
+        call_command('rebuild_search_index', '--chunk-size', '1', stdout=io.StringIO())
+        self.assertEqual(sorted(SearchPosting.objects.values_list('file__file_path', 'term', 'weight')), before)
+
+
+class RevisionTests(RepositoryMixin, TestCase):
+
+    def save_versions(self, versions):
+        repo_file = self.add_file('notes.txt', versions[0])
+        for text in versions[1:]:
+            repo_file.content = text
+            repo_file.save()
+        return repo_file
+
+    def test_delta_round_trip(self):
+        old = 'a\nb\nc\nd\n'
+        for new in ('a\nB\nc\nd\n', 'x\n' + old + 'y', '', old.replace('\n', '\r\n'), 'caf\u00e9\n\ud800\n'):
+            self.assertEqual(revisions.apply_delta(old, revisions.make_delta(old, new)), new)
+
+    @override_settings(REVISION_SNAPSHOT_INTERVAL=3)
+    def test_every_version_is_rebuilt_from_its_chain(self):
+        lines = [f'line {n}\n' for n in range(200)]
+        versions = []
+        for n in range(7):
+            lines[n * 10] = f'changed in version {n}\n'
+            versions.append(''.join(lines))
+        repo_file = self.save_versions(versions)
+
+        history = list(repo_file.revisions.order_by('number'))
+        self.assertEqual([r.number for r in history], [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual([r.base for r in history], [1, 1, 1, 4, 4, 4, 7])
+        self.assertLess(len(bytes(history[1].data)), len(bytes(history[0].data)))
+        for number, text in enumerate(versions, start=1):
+            self.assertEqual(revisions.text_at(repo_file.pk, number), text)
+
+    def test_unchanged_save_adds_no_revision(self):
+        repo_file = self.add_file('a.py', 'same\n')
+        repo_file.content = 'same\n'
+        repo_file.save()
+        self.assertEqual(repo_file.revisions.count(), 1)
+
+    def test_history_and_diff_pages(self):
+        repo_file = self.save_versions(['one\ntwo\n', 'one\nthree\n'])
+        self.client.force_login(self.user)
+        response = self.client.get(f'/core/alice/project/history/{repo_file.pk}/')
+        self.assertEqual([r.number for r in response.context['page']], [2, 1])
+
+        response = self.client.get(f'/core/alice/project/diff/{repo_file.pk}/')
+        self.assertEqual(
+            [line for kind, line in response.context['diff'] if kind in ('add', 'remove')],
+            ['-two', '+three'],
+        )
+        response = self.client.get(f'/core/alice/project/diff/{repo_file.pk}/', {'from': 0, 'to': 1})
+        self.assertEqual([kind for kind, _ in response.context['diff']].count('add'), 2)
+        for query in ({'to': 3}, {'from': 'x'}, {'from': -1}):
+            self.assertEqual(self.client.get(f'/core/alice/project/diff/{repo_file.pk}/', query).status_code, 404)
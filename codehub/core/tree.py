@@ -0,0 +1,198 @@
+# core/tree.py
+
+"""
+Folder index of repository file trees.
+
+File paths are stored flat on RepoFile ('src/app/main.py'). To browse them
+folder by folder, every file also records its parent directory, and each
+folder has a RepoDirectory row counting the files below it. Adding or
+removing a file touches one row per level of its path, and listing a folder
+only reads the entries of that folder.
+"""
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
+
+from .models import RepoDirectory, RepoFile
+
+
+def split_path(file_path):
+    """
+    Split a file path into (directory, name), ignoring empty and '.'
+    segments: 'src//app/./main.py' -> ('src/app', 'main.py').
+    """
+    parts = [part for part in file_path.split('/') if part not in ('', '.')]
+    if not parts:
+        return '', ''
+    return '/'.join(parts[:-1]), parts[-1]
+
+
+def normalize_directory(path):
+    """Canonical form of a folder path as stored in the index."""
+    return '/'.join(part for part in (path or '').split('/') if part not in ('', '.'))
+
+
+def _ancestors(directory):
+    # 'a/b/c' -> 'a', 'a/b', 'a/b/c'; nothing for the root
+    if not directory:
+        return []
+    parts = directory.split('/')
+    return ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+def add_file(repository_id, directory, count=1):
+    """
+    Record `count` new files in a folder, creating the folder and its
+    parents as needed.
+    """
+    add_files(repository_id, {directory: count})
+
+
+def add_files(repository_id, counts):
+    """
+    Record new files in several folders at once: counts maps a folder path
+    to the number of files added to it. Takes a fixed number of queries per
+    500 folders, however many files were added.
+    """
+    totals = Counter()
+    for directory, count in counts.items():
+        for path in _ancestors(directory):
+            totals[path] += count
+    paths = list(totals)
+
+    for start in range(0, len(paths), 500):
+        chunk = paths[start:start + 500]
+        folders = RepoDirectory.objects.filter(repository_id=repository_id, path__in=chunk)
+
+        # Create missing folders empty, then count everything with one
+        # relative UPDATE, so folders created concurrently are still right
+        existing = set(folders.values_list('path', flat=True))
+        RepoDirectory.objects.bulk_create(
+            [
+                RepoDirectory(
+                    repository_id=repository_id, path=path,
+                    parent_path=path.rpartition('/')[0], name=path.rpartition('/')[2],
+                )
+                for path in chunk if path not in existing
+            ],
+            ignore_conflicts=True,
+        )
+        folders.update(file_count=F('file_count') + Case(
+            *[When(path=path, then=Value(totals[path])) for path in chunk],
+            default=Value(0),
+        ))
+
+
+def remove_file(repository_id, directory, count=1):
+    """
+    Record that `count` files left a folder; folders left empty are removed.
+    """
+    paths = _ancestors(directory)
+    if not paths:
+        return
+    folders = RepoDirectory.objects.filter(repository_id=repository_id, path__in=paths)
+    folders.update(file_count=Greatest(F('file_count') - count, 0))
+    folders.filter(file_count=0).delete()
+
+
+def rebuild(repository):
+    """Recompute the folder index of a repository from its files."""
+    counts = {}
+    for directory in repository.files.values_list('directory', flat=True).iterator():
+        for path in _ancestors(directory):
+            counts[path] = counts.get(path, 0) + 1
+
+    with transaction.atomic():
+        repository.directories.all().delete()
+        RepoDirectory.objects.bulk_create(
+            [
+                RepoDirectory(
+                    repository=repository, path=path, parent_path=path.rpartition('/')[0],
+                    name=path.rpartition('/')[2], file_count=count,
+                )
+                for path, count in counts.items()
+            ],
+            batch_size=500,
+        )
+
+
+class FolderEntries:
+    """
+    The entries of one folder, subfolders first and then files, both by
+    name. Sliced lazily by the paginator so only one page is read.
+    """
+    def __init__(self, repository, path):
+        self.folders = (
+            repository.directories.filter(parent_path=path)
+            .only('id', 'repository_id', 'path', 'name', 'file_count')
+            .order_by('name')
+        )
+        self.files = (
+            repository.files.filter(directory=path)
+            .only('id', 'repository_id', 'file_path', 'size', 'blob_id', 'updated_at')
+            .order_by('file_path')
+        )
+        self._folder_count = None
+
+    def folder_count(self):
+        if self._folder_count is None:
+            self._folder_count = self.folders.count()
+        return self._folder_count
+
+    def count(self):
+        return self.folder_count() + self.files.count()
+
+    def __getitem__(self, key):
+        start, stop = key.start or 0, key.stop
+        folders = self.folder_count()
+        entries = []
+        if start < folders:
+            entries += list(self.folders[start:min(stop, folders)])
+        if stop > folders:
+            entries += list(self.files[max(start - folders, 0):stop - folders])
+        return entries
+
+
+def folder_exists(repository, path):
+    return path == '' or repository.directories.filter(path=path).exists()
+
+
+def list_folder(repository, path, page_number=1, per_page=None):
+    """
+    Return one page (a django.core.paginator.Page) of a folder's entries:
+    RepoDirectory rows followed by RepoFile rows without their contents.
+    """
+    paginator = Paginator(
+        FolderEntries(repository, path), per_page or settings.REPO_TREE_PAGE_SIZE,
+    )
+    return paginator.get_page(page_number)
+
+
+def entry_json(entry):
+    """JSON form of a folder entry, as returned by the tree API."""
+    if isinstance(entry, RepoDirectory):
+        return {
+            'type': 'dir',
+            'name': entry.name,
+            'path': entry.path,
+            'file_count': entry.file_count,
+        }
+    return {
+        'type': 'file',
+        'id': entry.id,
+        'name': entry.name,
+        'path': entry.file_path,
+        'size': entry.size,
+        'sha256': entry.blob_id,
+        'updated_at': entry.updated_at.isoformat(),
+    }
+
+
+def breadcrumbs(path):
+    """[(name, path)] for each folder from the top of the tree down to path."""
+    return [(p.rpartition('/')[2], p) for p in _ancestors(path)]
@@ -0,0 +1,236 @@
+# core/uploads.py
+
+"""
+Importing many files into a repository at once.
+
+Uploaded files and the entries of uploaded ZIP archives and tarballs are
+read one at a time, with a cap on every entry and on the whole upload, so a
+large (or malicious) archive is never unpacked into memory or onto disk.
+Accepted files are written in batches with bulk inserts inside a single
+transaction. bulk_create() sends no signals, so import_files() does the
+bookkeeping of core.signals itself: blobs, folder index, search index,
+revision history and content version.
+"""
+
+import tarfile
+import zipfile
+import zlib
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import revisions, search, tree
+from .models import Blob, RepoFile
+from .signals import bump_content_version
+
+ZIP_SUFFIXES = ('.zip',)
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Archive clutter that is never worth importing
+IGNORED_PARTS = {'__MACOSX', '.DS_Store', '.git'}
+
+BATCH_SIZE = 500
+
+
+class UploadError(Exception):
+    """Raised when an upload as a whole is rejected; nothing is imported."""
+
+
+def _clean_path(path, prefix=''):
+    """
+    Normalise an uploaded path below the target folder, or return None for
+    paths that must not be imported (absolute, '..', clutter).
+    """
+    parts = [part for part in path.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or IGNORED_PARTS.intersection(parts):
+        return None
+    return '/'.join([*filter(None, prefix.split('/')), *parts])
+
+
+def _decode(data):
+    """Return the text of a file, or None if it looks binary."""
+    if b'\0' in data[:8192]:
+        return None
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+def _read_limited(fileobj, limit):
+    """Read at most limit + 1 bytes, enough to tell an oversized entry."""
+    return fileobj.read(limit + 1)
+
+
+def _zip_entries(uploaded_file, limit):
+    try:
+        archive = zipfile.ZipFile(uploaded_file)
+    except zipfile.BadZipFile:
+        raise UploadError(f"'{uploaded_file.name}' is not a valid ZIP archive.")
+    with archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            if info.file_size > limit:
+                yield info.filename, None
+                continue
+            try:
+                with archive.open(info) as entry:
+                    data = _read_limited(entry, limit)
+            except (zipfile.BadZipFile, RuntimeError, NotImplementedError, zlib.error, EOFError, OSError):
+                # Bad CRC, encrypted or unsupported compression, truncated data
+                raise UploadError(
+                    f"'{info.filename}' in '{uploaded_file.name}' is corrupt, encrypted or cannot be unpacked."
+                )
+            yield info.filename, data
+
+
+def _tar_entries(uploaded_file, limit):
+    try:
+        # Stream mode reads the tarball front to back without seeking
+        archive = tarfile.open(fileobj=uploaded_file, mode='r|*')
+    except tarfile.TarError:
+        raise UploadError(f"'{uploaded_file.name}' is not a valid tar archive.")
+    with archive:
+        try:
+            for member in archive:
+                if not member.isfile():
+                    continue # Folders, links and devices
+                if member.size > limit:
+                    yield member.name, None
+                    continue
+                yield member.name, _read_limited(archive.extractfile(member), limit)
+        except (tarfile.TarError, EOFError, OSError):
+            raise UploadError(f"'{uploaded_file.name}' is truncated or corrupt.")
+
+
+def upload_entries(uploaded_files):
+    """
+    Yield (path, data) for every file in an upload, expanding archives.
+    data is None when the entry is larger than UPLOAD_MAX_FILE_SIZE.
+    """
+    limit = settings.UPLOAD_MAX_FILE_SIZE
+    for uploaded_file in uploaded_files:
+        name = uploaded_file.name.lower()
+        if name.endswith(ZIP_SUFFIXES):
+            yield from _zip_entries(uploaded_file, limit)
+        elif name.endswith(TAR_SUFFIXES):
+            yield from _tar_entries(uploaded_file, limit)
+        elif uploaded_file.size > limit:
+            yield uploaded_file.name, None
+        else:
+            yield uploaded_file.name, _read_limited(uploaded_file, limit)
+
+
+def accepted_files(entries, skipped, prefix=''):
+    """
+    Filter upload entries down to importable text files below prefix.
+    Yields (path, text) and appends (path, reason) to skipped for the rest.
+    Raises UploadError when the upload exceeds the count or size limits.
+    """
+    total = 0
+    count = 0
+    for path, data in entries:
+        file_path = _clean_path(path, prefix)
+        if file_path is None:
+            continue
+        if len(file_path) > RepoFile._meta.get_field('file_path').max_length:
+            skipped.append((file_path, 'path too long'))
+            continue
+        if data is None or len(data) > settings.UPLOAD_MAX_FILE_SIZE:
+            skipped.append((file_path, 'too large'))
+            continue
+        total += len(data)
+        if total > settings.UPLOAD_MAX_TOTAL_SIZE:
+            raise UploadError("The upload is larger than the allowed total size.")
+        text = _decode(data)
+        if text is None:
+            skipped.append((file_path, 'binary'))
+            continue
+        count += 1
+        if count > settings.UPLOAD_MAX_FILES:
+            raise UploadError(f"Uploads are limited to {settings.UPLOAD_MAX_FILES} files.")
+        yield file_path, text
+
+
+def _batches(items, size):
+    batch = {}
+    for path, text in items:
+        batch[path] = text # A later entry with the same path wins
+        if len(batch) >= size:
+            yield batch
+            batch = {}
+    if batch:
+        yield batch
+
+
+def _import_batch(repo, batch):
+    """
+    Write one batch of {path: text}. Returns a Counter of new files per
+    folder and the number of files overwritten.
+    """
+    paths = list(batch)
+    existing = dict(repo.files.filter(file_path__in=paths).values_list('file_path', 'blob_id'))
+
+    # Contents first: the files refer to their blobs. Blobs that already
+    # exist are locked: if another transaction releases one of them (its
+    # last file was deleted) it now waits for this import, and its delete
+    # fails on the new files' foreign keys instead of this upload failing
+    # on a blob deleted under it. RepoFile.save() retries for the same race.
+    packed = {path: Blob.pack(text) for path, text in batch.items()}
+    digests = {blob.sha256 for blob in packed.values()}
+    known = set(Blob.objects.select_for_update().filter(pk__in=digests).values_list('pk', flat=True))
+    new_blobs = {blob.sha256: blob for blob in packed.values() if blob.sha256 not in known}
+    Blob.objects.bulk_create(new_blobs.values(), ignore_conflicts=True, batch_size=BATCH_SIZE)
+
+    now = timezone.now()
+    RepoFile.objects.bulk_create(
+        [
+            RepoFile(
+                repository=repo, file_path=path, blob_id=packed[path].sha256,
+                size=packed[path].size, directory=tree.split_path(path)[0], updated_at=now,
+            )
+            for path in paths
+        ],
+        update_conflicts=True,
+        unique_fields=['repository', 'file_path'],
+        update_fields=['blob', 'size', 'directory', 'updated_at'],
+        batch_size=BATCH_SIZE,
+    )
+
+    # What the post_save receivers would have done per file; the folder
+    # index is updated once for the whole import
+    changed = [path for path in paths if existing.get(path) != packed[path].sha256]
+    ids = dict(repo.files.filter(file_path__in=changed).values_list('file_path', 'id'))
+    search.index_files((ids[path], repo.pk, batch[path]) for path in changed)
+    # The replaced blobs are only released after commit, so the previous
+    # versions can still be read for the history deltas
+    previous = Blob.objects.in_bulk({existing[path] for path in changed if path in existing})
+    revisions.record(
+        (ids[path], batch[path], previous[existing[path]].text if path in existing else None)
+        for path in changed
+    )
+    for path, blob_id in existing.items():
+        if blob_id != packed[path].sha256:
+            Blob.release(blob_id)
+    return Counter(tree.split_path(path)[0] for path in paths if path not in existing), len(existing)
+
+
+def import_files(repo, files):
+    """
+    Create or overwrite files of a repository from (path, text) pairs in
+    one transaction. Returns (created, updated).
+    """
+    new_files = Counter()
+    updated = 0
+    with transaction.atomic():
+        for batch in _batches(files, BATCH_SIZE):
+            batch_new, batch_updated = _import_batch(repo, batch)
+            new_files += batch_new
+            updated += batch_updated
+        tree.add_files(repo.pk, new_files)
+        if new_files or updated:
+            bump_content_version(repo.pk)
+    return sum(new_files.values()), updated
@@ -6,15 +6,27 @@ from . import views
 urlpatterns = [
 # Match the updated, more descriptive view names
     path("dashboard/", views.dashboard_view, name="dashboard"),
+    path("api/repositories/", views.dashboard_api_view, name="dashboard_api"),
     path("create/", views.create_repo_view, name="create_repo"),
     path("python-env/", views.python_env_view, name="python_env"),
+    path("search/", views.search_view, name="search"),
+    path("api/search/", views.search_api_view, name="search_api"),
 # Python compiler API
     path("api/run-code/", views.run_code_view, name="run_code"),
+    path("api/run-code/stream/", views.run_code_stream_view, name="run_code_stream"),
+    path("api/artifacts/<str:artifact_id>/", views.artifact_view, name="artifact"),
 # Repository detail and basic file management
     path("<str:username>/<str:repo_name>/", views.repository_detail_view, name="repository_detail"),
+    path("<str:username>/<str:repo_name>/tree/<path:dir_path>/", views.repository_detail_view, name="repository_tree"),
+    path("<str:username>/<str:repo_name>/api/tree/", views.repository_tree_api_view, name="repository_tree_api"),
     path("<str:username>/<str:repo_name>/create/", views.create_file_view, name="create_file"),
+    path("<str:username>/<str:repo_name>/blob/<int:file_id>/", views.file_view, name="file_view"),
+    path("<str:username>/<str:repo_name>/api/files/<int:file_id>/lines/", views.file_lines_api_view, name="file_lines_api"),
     path("<str:username>/<str:repo_name>/edit/<int:file_id>/", views.edit_file_view, name="edit_file"),
+    path("<str:username>/<str:repo_name>/api/files/<int:file_id>/patch/", views.file_patch_api_view, name="file_patch_api"),
     path("<str:username>/<str:repo_name>/delete/<int:file_id>/", views.delete_file_view, name="delete_file"),
+    path("<str:username>/<str:repo_name>/history/<int:file_id>/", views.file_history_view, name="file_history"),
+    path("<str:username>/<str:repo_name>/diff/<int:file_id>/", views.file_diff_view, name="file_diff"),
     path("<str:username>/<str:repo_name>/upload/", views.upload_file_view, name="upload_file"),
 # Repository-level edit and delete (new routes)
     path("<str:username>/<str:repo_name>/settings/", views.repository_settings_view, name="repository_settings"),
@@ -4,41 +4,141 @@ from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required # Import the decorator
 from django.contrib.auth.models import User
 from django.contrib import messages
+from django.db import transaction
 from django.db.models import Q
-from django.http import JsonResponse, HttpResponse
+from django.db.models.functions import Length
+from django.core.paginator import Paginator
+from django.http import JsonResponse, HttpResponse, FileResponse, Http404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.utils.timesince import timesince
+from django.urls import reverse
+from django.views.decorators.http import condition
+from django.conf import settings
 from django.shortcuts import get_object_or_404
 from django.core.files.uploadedfile import UploadedFile
+from shared import metrics
+from shared.pagination import keyset_page
+from shared.streaming import streaming_response
 from .models import Repository, RepoFile
+from . import archives, artifacts, executor, highlight, patches, result_cache, revisions, search, sessions, tree, uploads
 import json
-import io
-from io import BytesIO
-import sys
 import contextlib
-import base64
-import builtins
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import zipfile
+
+DASHBOARD_SECTIONS = ('mine', 'public')
+
+def _dashboard_repositories(user, section):
+    """
+    Repositories of one dashboard section, with their owner joined in and
+    only the columns the cards show.
+    """
+    repos = Repository.objects.select_related('owner').only(
+        'id', 'name', 'description', 'visibility', 'updated_at',
+        'owner', 'owner__username', 'owner__first_name',
+    )
+    if section == 'mine':
+        # Owned by user (any visibility)
+        return repos.filter(owner=user)
+    # Public repos from others
+    return repos.filter(visibility='public').exclude(owner=user)
 
 @login_required(login_url='/accounts/login/')
 def dashboard_view(request):
     """
-    Displays repositories for the logged-in user:
-    - user_repos: all repos owned by the user (public + private)
+    Displays repositories for the logged-in user, newest first, one page
+    per section:
+    - user_repos: repos owned by the user (public + private)
     - other_public_repos: public repos from other users
+    Further pages are loaded through dashboard_api_view as the user scrolls
+    (or with the ?mine= / ?public= cursor links without JavaScript).
     """
-    # Owned by user (any visibility)
-    user_repos = Repository.objects.filter(owner=request.user).order_by('-updated_at')
-
-    # Public repos from others
-    other_public_repos = Repository.objects.filter(
-        visibility='public'
-    ).exclude(owner=request.user).order_by('-updated_at')
+    user_repos, user_repos_next = keyset_page(
+        _dashboard_repositories(request.user, 'mine'),
+        request.GET.get('mine'), settings.DASHBOARD_PAGE_SIZE,
+    )
+    other_public_repos, other_public_repos_next = keyset_page(
+        _dashboard_repositories(request.user, 'public'),
+        request.GET.get('public'), settings.DASHBOARD_PAGE_SIZE,
+    )
 
     return render(request, "dashboard.html", {
         "user_repos": user_repos,
+        "user_repos_next": user_repos_next,
         "other_public_repos": other_public_repos,
+        "other_public_repos_next": other_public_repos_next,
+    })
+
+@login_required(login_url='/accounts/login/')
+def dashboard_api_view(request):
+    """
+    JSON page of a dashboard section for infinite scroll:
+    ?section=mine|public&cursor=<next_cursor of the previous page>
+    """
+    section = request.GET.get('section', 'mine')
+    if section not in DASHBOARD_SECTIONS:
+        return JsonResponse({'error': 'Unknown section'}, status=400)
+
+    repos, next_cursor = keyset_page(
+        _dashboard_repositories(request.user, section),
+        request.GET.get('cursor'), settings.DASHBOARD_PAGE_SIZE,
+    )
+    return JsonResponse({
+        'repositories': [
+            {
+                'owner': repo.owner.username,
+                'owner_name': repo.owner.first_name or repo.owner.username,
+                'name': repo.name,
+                'description': repo.description or '',
+                'visibility': repo.visibility,
+                'updated_at': repo.updated_at.isoformat(),
+                'updated_since': timesince(repo.updated_at),
+                'url': reverse('repository_detail', args=[repo.owner.username, repo.name]),
+            }
+            for repo in repos
+        ],
+        'next_cursor': next_cursor,
+    })
+
+SEARCH_PAGE_SIZE = 20
+
+def _search_request(request):
+    """Read ?q= and ?page= and run the search. Returns (query, page, results, total)."""
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    results, total = search.search(request.user, query, page, SEARCH_PAGE_SIZE) if query else ([], 0)
+    return query, page, results, total
+
+@login_required(login_url='/accounts/login/')
+def search_view(request):
+    """
+    Searches the contents of every file in repositories the user can see
+    (their own and all public ones).
+    """
+    query, page, results, total = _search_request(request)
+    return render(request, "search.html", {
+        "query": query,
+        "results": results,
+        "total": total,
+        "page": page,
+        "has_previous": page > 1,
+        "has_next": page * SEARCH_PAGE_SIZE < total,
+    })
+
+@login_required(login_url='/accounts/login/')
+def search_api_view(request):
+    """
+    JSON variant of search_view: ?q=<query>&page=<n>
+    """
+    query, page, results, total = _search_request(request)
+    return JsonResponse({
+        'query': query,
+        'total': total,
+        'page': page,
+        'has_next': page * SEARCH_PAGE_SIZE < total,
+        'results': [search.result_json(result) for result in results],
     })
 
 @login_required(login_url='/accounts/login/')
@@ -68,107 +168,177 @@ def python_env_view(request):
     """
     return render(request, "python_environment.html")
 
-class CapturingInput:
-    """
-    A context manager to capture 'input()' calls.
-    """
-    def __init__(self, inputs_list, current_index):
-        self.inputs_list = inputs_list
-        self.current_index = current_index
-        self._original_input = builtins.input
-        self.prompt = ""
-
-    def __enter__(self):
-        builtins.input = self.mock_input
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        builtins.input = self._original_input
-
-    def mock_input(self, prompt=""):
-        self.prompt = prompt
-        if self.current_index < len(self.inputs_list):
-            value = self.inputs_list[self.current_index]
-            self.current_index += 1
-            return value
-        else:
-            # Not enough inputs provided, raise an exception to signal for more.
-            raise EOFError("Input required")
+# --- VIEW 2: THE CODE EXECUTION API ---
 
+EXECUTION_ERRORS = (
+    sessions.SessionNotFound,
+    sessions.TooManySessions,
+    executor.PoolBusy,
+    executor.ExecutionTimeout,
+    executor.WorkerCrashed,
+)
 
-# --- VIEW 2: THE CODE EXECUTION API ---
+def _execution_error_payload(error):
+    """
+    Map an execution-engine exception to a response payload and HTTP status.
+    """
+    if isinstance(error, sessions.SessionNotFound):
+        # The program was reaped or lives in another server process; the
+        # browser falls back to re-running it with every input so far.
+        return {'status': 'session_expired'}, 200
+    if isinstance(error, (executor.PoolBusy, sessions.TooManySessions)):
+        return {
+            'status': 'error',
+            'output': 'Error: The server is busy running other code. Please try again shortly.'
+        }, 503
+    if isinstance(error, executor.ExecutionTimeout):
+        return {
+            'status': 'error',
+            'output': "\n--- EXECUTION ERROR ---\nTime limit exceeded"
+        }, 200
+    return {
+        'status': 'error',
+        'output': "\n--- EXECUTION ERROR ---\nThe interpreter stopped unexpectedly"
+    }, 200
+
+def _job_from_request(data):
+    return {
+        'code': data.get('code', ''),
+        'inputs': data.get('inputs', []),
+        'input_index': data.get('input_index', 0),
+        **artifacts.figure_options(data),
+    }
 
-def run_code_view(request):
+def _parse_run_request(request):
     """
-    Executes Python code from the API.
-    Handles standard output, matplotlib plots, and 'input()' prompts.
+    Read the JSON body shared by the run-code endpoints.
+    Returns (data, error_response).
     """
     if request.method != 'POST':
-        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
-
+        return None, JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
     try:
         data = json.loads(request.body)
-        code = data.get('code', '')
-        inputs = data.get('inputs', [])
-        input_index = data.get('input_index', 0)
     except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
-    if not code.strip():
-        return JsonResponse({
+        return None, JsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not data.get('session_id') and not data.get('code', '').strip():
+        return None, JsonResponse({
             'status': 'error',
             'output': 'Error: No code provided'
         })
-    # Prepare to capture stdout
-    stdout_capture = io.StringIO()
-    
-    # Prepare to capture matplotlib plots
-    plt.close('all') # Clear any previous plots
-    img_buffer = io.BytesIO()
+    return data, None
+
+def run_code_view(request):
+    """
+    Executes Python code from the API on the shared worker pool.
+    Handles standard output, matplotlib plots, and 'input()' prompts.
+
+    A program that calls input() stays suspended in its worker and the
+    response carries a 'session_id'. The browser resumes it by posting
+    {"session_id": ..., "input": ...}, or stops it with {"session_id": ...,
+    "cancel": true}.
+    """
+    data, error_response = _parse_run_request(request)
+    if error_response:
+        return error_response
+    session_id = data.get('session_id')
+
+    manager = sessions.get_manager()
+    if session_id and data.get('cancel'):
+        manager.close(session_id)
+        return JsonResponse({'status': 'cancelled'})
 
     try:
-        # Execute the code
-        with contextlib.redirect_stdout(stdout_capture):
-            with CapturingInput(inputs, input_index) as input_handler:
-                exec(code, {"__builtins__": __builtins__})
-        
-        # If code finished without needing more input
-        output = stdout_capture.getvalue()
-        
-        # Check if a plot was created and save it
-        img_base64 = None
-        if plt.get_fignums(): # Check if any figures exist
-            plt.savefig(img_buffer, format='png', bbox_inches='tight')
-            img_buffer.seek(0)
-            img_base64 = base64.b64encode(img_buffer.read()).decode('utf-8')
-
-        return JsonResponse({
-            'status': 'success',
-            'output': output,
-            'image': img_base64,
-            'html': None # You can add logic for Folium/Plotly here if needed
-        })
+        if session_id:
+            result = manager.resume(session_id, str(data.get('input', '')))
+        else:
+            job = _job_from_request(data)
+            result = result_cache.lookup(job)
+            if result is None:
+                result = manager.start(job)
+                result_cache.store(job, result)
+    except EXECUTION_ERRORS as e:
+        payload, status = _execution_error_payload(e)
+        response = JsonResponse(payload, status=status)
+        if status == 503:
+            response['Retry-After'] = '5'
+        return response
+
+    return JsonResponse(artifacts.publish(result))
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+def _sse_stream(events):
+    """
+    Encode execution events as Server-Sent Events:
+    'stdout'/'stderr' chunks, a 'plot' per figure, and a final 'done'
+    carrying the same payload run_code_view would return.
+    """
+    with contextlib.closing(events):
+        try:
+            for kind, payload in events:
+                if kind != 'done':
+                    yield _sse(kind, {'text': payload})
+                    continue
+                for url in artifacts.publish(payload).pop('images'):
+                    yield _sse('plot', {'url': url})
+                yield _sse('done', payload)
+        except EXECUTION_ERRORS as e:
+            payload, status = _execution_error_payload(e)
+            yield _sse('done', payload)
+
+def run_code_stream_view(request):
+    """
+    Streaming variant of run_code_view. Takes the same JSON body and answers
+    with a text/event-stream so output shows up while the program runs.
+    Under ASGI the stream is consumed asynchronously, so a slow client
+    pauses the program instead of buffering its output in memory.
+    """
+    data, error_response = _parse_run_request(request)
+    if error_response:
+        return error_response
+    session_id = data.get('session_id')
+
+    manager = sessions.get_manager()
+    if session_id:
+        events = manager.resume_stream(session_id, str(data.get('input', '')))
+    else:
+        job = _job_from_request(data)
+        cached = result_cache.lookup(job)
+        if cached is not None:
+            events = result_cache.replay(cached)
+        else:
+            events = result_cache.recording(job, manager.start_stream(job))
 
-    except EOFError:
-        # 'input()' was called but we ran out of inputs
-        return JsonResponse({
-            'status': 'input_required',
-            'prompt': input_handler.prompt or "Enter input:",
-            'next_input_index': input_handler.current_index,
-            'output': stdout_capture.getvalue() # Send partial output
-        })
-    except Exception as e:
-        # Code execution failed
-        return JsonResponse({
-            'status': 'error',
-            'output': stdout_capture.getvalue() + f"\n--- EXECUTION ERROR ---\n{type(e).__name__}: {e}"
-        })
-    finally:
-        plt.close('all') # Always clean up plot figures
+    response = streaming_response(request, _sse_stream(events), 'text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+@condition(etag_func=lambda request, artifact_id: f'"{artifact_id}"')
+def artifact_view(request, artifact_id):
+    """
+    Serves a plot produced by a code run. Artifact ids are content hashes,
+    so a URL always refers to the same bytes and can be cached for as long
+    as it exists.
+    """
+    artifact = artifacts.get(artifact_id)
+    if artifact is None:
+        raise Http404("Artifact not found or expired")
+    data, content_type = artifact
+
+    response = HttpResponse(data, content_type=content_type)
+    response['Cache-Control'] = f'private, max-age={settings.RUN_CODE_ARTIFACT_TTL}, immutable'
+    # Figures come out of user code: never let an SVG run scripts
+    response['Content-Security-Policy'] = "default-src 'none'; style-src 'unsafe-inline'"
+    response['X-Content-Type-Options'] = 'nosniff'
+    return response
 
 @login_required(login_url='/accounts/login/')
-def repository_detail_view(request, username, repo_name):
+def repository_detail_view(request, username, repo_name, dir_path=''):
     """
-    Displays the file list and details for a single repository.
+    Displays the details of a single repository and one folder of its file
+    tree (the top level by default), a page at a time.
     """
     # 1. Get the repository owner and the repository
     owner = get_object_or_404(User, username=username)
@@ -179,16 +349,48 @@ def repository_detail_view(request, username, repo_name):
         # (Later, you can add logic here for collaborators)
         return redirect('dashboard') # Or show a 404/Permission Denied
 
-    # 3. Get all files for this repository from the new model
-    files = repo.files.all().order_by('file_path')
+    # 3. List the folder from the tree index; only metadata is read, the
+    #    contents stay in their blobs until a file is opened
+    dir_path = tree.normalize_directory(dir_path)
+    if not tree.folder_exists(repo, dir_path):
+        raise Http404("Folder not found")
+    page = tree.list_folder(repo, dir_path, request.GET.get('page'))
 
     context = {
         'repo': repo,
-        'files': files,
+        'dir_path': dir_path,
+        'breadcrumbs': tree.breadcrumbs(dir_path),
+        'page': page,
+        'entries': page.object_list,
     }
-    
+
     return render(request, "repository_detail.html", context)
 
+@login_required(login_url='/accounts/login/')
+def repository_tree_api_view(request, username, repo_name):
+    """
+    JSON listing of one folder of a repository (?path=src/app&page=2), used
+    to expand folders in place on the repository page.
+    """
+    owner = get_object_or_404(User, username=username)
+    repo = get_object_or_404(Repository, owner=owner, name=repo_name)
+
+    if repo.visibility == 'private' and request.user != repo.owner:
+        return JsonResponse({'error': 'Repository not found'}, status=404)
+
+    dir_path = tree.normalize_directory(request.GET.get('path', ''))
+    if not tree.folder_exists(repo, dir_path):
+        return JsonResponse({'error': 'Folder not found'}, status=404)
+    page = tree.list_folder(repo, dir_path, request.GET.get('page'))
+
+    return JsonResponse({
+        'path': dir_path,
+        'entries': [tree.entry_json(entry) for entry in page.object_list],
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'has_next': page.has_next(),
+    })
+
 @login_required(login_url='/accounts/login/')
 def repository_settings_view(request, username, repo_name):
     """
@@ -276,18 +478,33 @@ def download_repository_view(request, username, repo_name):
         messages.error(request, "You don't have permission to download this repository.")
         return redirect('repository_detail', username=username, repo_name=repo_name)
 
-    # Create an in-memory ZIP file
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for f in repo.files.all():
-            # Skip folder placeholders if you ever add them
-            if hasattr(f, "is_folder") and f.is_folder:
-                continue
-            zip_file.writestr(f.file_path, f.content or "")
-
-    zip_buffer.seek(0)
-    response = HttpResponse(zip_buffer.read(), content_type="application/zip")
+    # Unchanged since the client's copy: answer 304 without touching any file
+    etag = f'"{archives.archive_version(repo)}"'
+    last_modified = repo.content_updated_at or repo.updated_at
+    not_modified = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified.timestamp()),
+    )
+    if not_modified is not None:
+        # A 304 repeats the validators the 200 would have carried
+        not_modified["ETag"] = etag
+        not_modified["Last-Modified"] = http_date(last_modified.timestamp())
+        not_modified["Cache-Control"] = "private, no-cache"
+        return not_modified
+
+    # Serve the cached archive of this version, or stream the ZIP entry by
+    # entry (instead of building it in memory) and cache it on the way
+    cached = archives.open_cached_archive(repo)
+    if cached is not None:
+        response = FileResponse(cached, content_type="application/zip")
+    else:
+        response = streaming_response(
+            request, metrics.timed_iter('zip', archives.stream_and_cache_repository_zip(repo)),
+            "application/zip",
+        )
     response["Content-Disposition"] = f'attachment; filename="{repo.name}.zip"'
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified.timestamp())
+    response["Cache-Control"] = "private, no-cache"
     return response
 
 
@@ -353,22 +570,238 @@ def edit_file_view(request, username, repo_name, file_id):
     if request.method == "POST":
         # Get the new content from the form
         content = request.POST.get("content")
-        
-        # Update the file's content and save it
-        file_to_edit.content = content
-        file_to_edit.save()
-        
+
+        # Refuse to overwrite changes saved since the editor was opened. The
+        # row is locked from the check to the write, so two saves from the
+        # same version cannot both pass the check
+        base = request.POST.get("base")
+        with transaction.atomic():
+            file_to_edit = get_object_or_404(RepoFile.objects.select_for_update(), pk=file_to_edit.pk)
+            stale = bool(base) and base != file_to_edit.blob_id
+            if not stale:
+                # Update the file's content and save it
+                file_to_edit.content = content
+                file_to_edit.save()
+
+        if stale:
+            context = {
+                'repo': repo,
+                'file_to_edit': file_to_edit,
+                'content': content,
+                'error': 'This file was changed since you opened it. Copy your changes, reload the page and apply them again.',
+            }
+            return render(request, "edit_file.html", context, status=409)
+
         # Redirect back to the repository's main page
         return redirect('repository_detail', username=username, repo_name=repo_name)
 
     # 4. Handle the initial page load (GET request)
+    content = file_to_edit.content
     context = {
         'repo': repo,
         'file_to_edit': file_to_edit,
+        'content': content,
+        # Lets the editor check that the textarea holds the exact text the
+        # patch offsets refer to
+        'content_length': patches.utf16_length(content),
     }
     
     return render(request, "edit_file.html", context)
 
+@login_required(login_url='/accounts/login/')
+def file_patch_api_view(request, username, repo_name, file_id):
+    """
+    Saves an edit as a patch against a known version of the file:
+    {"base": "<blob sha256>", "edits": [[start, end, "text"], ...]}, offsets
+    in UTF-16 code units of the base text. Answers 409 with the current hash
+    when the file no longer matches the base, so stale edits are never
+    written over newer ones.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+
+    owner = get_object_or_404(User, username=username)
+    repo = get_object_or_404(Repository, owner=owner, name=repo_name)
+
+    # Only the owner can edit files
+    if request.user != repo.owner:
+        return JsonResponse({'error': 'Repository not found'}, status=404)
+
+    try:
+        data = json.loads(request.body)
+        base = data['base']
+        edits = patches.parse_edits(data['edits'])
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    except (KeyError, TypeError):
+        return JsonResponse({'error': "'base' and 'edits' are required"}, status=400)
+    except patches.PatchError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    # Lock the row so a concurrent save cannot slip in between the check
+    # and the write
+    with transaction.atomic():
+        repo_file = get_object_or_404(
+            RepoFile.objects.select_for_update().select_related('blob'), repository=repo, id=file_id,
+        )
+        if repo_file.blob_id != base:
+            return JsonResponse({'error': 'conflict', 'sha256': repo_file.blob_id}, status=409)
+        try:
+            content = patches.apply_edits(repo_file.content, edits)
+        except patches.PatchError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        if 'length' in data and data['length'] != patches.utf16_length(content):
+            return JsonResponse({'error': 'The patched file does not have the expected length'}, status=400)
+        if edits:
+            repo_file.content = content
+            repo_file.save()
+
+    return JsonResponse({
+        'sha256': repo_file.blob_id,
+        'size': repo_file.size,
+        'updated_at': repo_file.updated_at.isoformat(),
+    })
+
+def _viewable_file(request, username, repo_name, file_id):
+    """
+    The repository and file for the file view, or (repo, None) when the
+    user may not read the repository. Only the columns needed to find the
+    cached rendering are loaded; the content is read on a cache miss.
+    """
+    owner = get_object_or_404(User, username=username)
+    repo = get_object_or_404(Repository, owner=owner, name=repo_name)
+    if repo.visibility == 'private' and request.user != repo.owner:
+        return repo, None
+    repo_file = get_object_or_404(
+        RepoFile.objects.only('id', 'repository_id', 'file_path', 'blob_id', 'size', 'updated_at'),
+        repository=repo, id=file_id,
+    )
+    return repo, repo_file
+
+@login_required(login_url='/accounts/login/')
+def file_view(request, username, repo_name, file_id):
+    """
+    Shows a file with server-side syntax highlighting. The page carries the
+    first chunk of lines; the rest is loaded from file_lines_api_view.
+    """
+    repo, repo_file = _viewable_file(request, username, repo_name, file_id)
+    if repo_file is None:
+        return redirect('dashboard')
+
+    html, line_count, chunk_count = highlight.render_chunk(repo_file, 0)
+    return render(request, "file_view.html", {
+        'repo': repo,
+        'file': repo_file,
+        'lexer': highlight.file_lexer(repo_file),
+        'style_css': highlight.style_css(),
+        'code': html,
+        'line_count': line_count,
+        'chunk_count': chunk_count,
+        'chunk_lines': settings.HIGHLIGHT_CHUNK_LINES,
+    })
+
+@login_required(login_url='/accounts/login/')
+def file_lines_api_view(request, username, repo_name, file_id):
+    """
+    One chunk of a highlighted file (?chunk=3) as HTML inside JSON.
+    Chunks only change with the file's content, so repeat requests are
+    answered 304 from the ETag.
+    """
+    repo, repo_file = _viewable_file(request, username, repo_name, file_id)
+    if repo_file is None:
+        return JsonResponse({'error': 'Repository not found'}, status=404)
+    try:
+        chunk = int(request.GET.get('chunk', 0))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid chunk'}, status=400)
+
+    etag = highlight.etag(repo_file, chunk)
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified['ETag'] = etag
+        not_modified['Cache-Control'] = 'private, no-cache'
+        return not_modified
+
+    rendered = highlight.render_chunk(repo_file, chunk) if chunk >= 0 else None
+    if rendered is None:
+        return JsonResponse({'error': 'Chunk not found'}, status=404)
+    html, line_count, chunk_count = rendered
+    response = JsonResponse({
+        'chunk': chunk,
+        'html': html,
+        'line_count': line_count,
+        'next': chunk + 1 if chunk + 1 < chunk_count else None,
+    })
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+@login_required(login_url='/accounts/login/')
+def file_history_view(request, username, repo_name, file_id):
+    """
+    Lists the revisions of a file, newest first.
+    """
+    # 1. Get the repository and the specific file
+    owner = get_object_or_404(User, username=username)
+    repo = get_object_or_404(Repository, owner=owner, name=repo_name)
+    repo_file = get_object_or_404(RepoFile.objects.only('id', 'repository_id', 'file_path'), repository=repo, id=file_id)
+
+    # 2. Check for private repository access
+    if repo.visibility == 'private' and request.user != repo.owner:
+        return redirect('dashboard')
+
+    # 3. Revision metadata only; stored_size shows what each one costs
+    history = repo_file.revisions.only('number', 'base', 'size', 'created_at').annotate(
+        stored_size=Length('data'),
+    ).order_by('-number')
+    page = Paginator(history, 50).get_page(request.GET.get('page'))
+
+    return render(request, "file_history.html", {
+        'repo': repo,
+        'file': repo_file,
+        'page': page,
+    })
+
+@login_required(login_url='/accounts/login/')
+def file_diff_view(request, username, repo_name, file_id):
+    """
+    Shows the changes between two revisions of a file
+    (?from=<n>&to=<m>, by default the latest revision against the one before it).
+    """
+    # 1. Get the repository and the specific file
+    owner = get_object_or_404(User, username=username)
+    repo = get_object_or_404(Repository, owner=owner, name=repo_name)
+    repo_file = get_object_or_404(RepoFile.objects.only('id', 'repository_id', 'file_path'), repository=repo, id=file_id)
+
+    # 2. Check for private repository access
+    if repo.visibility == 'private' and request.user != repo.owner:
+        return redirect('dashboard')
+
+    # 3. Pick the revisions to compare; revision 0 is the empty file
+    latest = repo_file.revisions.order_by('-number').values_list('number', flat=True).first()
+    if latest is None:
+        raise Http404("This file has no history")
+    try:
+        to_number = int(request.GET.get('to', latest))
+        from_number = int(request.GET.get('from', to_number - 1))
+    except ValueError:
+        raise Http404("Invalid revision")
+    if not (0 <= from_number <= latest and 1 <= to_number <= latest):
+        raise Http404("Revision not found")
+
+    old = revisions.text_at(repo_file.id, from_number) if from_number else ''
+    new = revisions.text_at(repo_file.id, to_number)
+
+    return render(request, "file_diff.html", {
+        'repo': repo,
+        'file': repo_file,
+        'from_number': from_number,
+        'to_number': to_number,
+        'diff': revisions.diff_lines(
+            old, new, f'{repo_file.file_path}@{from_number}', f'{repo_file.file_path}@{to_number}',
+        ),
+    })
+
 @login_required(login_url='/accounts/login/')
 def delete_file_view(request, username, repo_name, file_id):
     """
@@ -396,7 +829,9 @@ def delete_file_view(request, username, repo_name, file_id):
 @login_required(login_url='/accounts/login/')
 def upload_file_view(request, username, repo_name):
     """
-    Upload a single text file into the repository.
+    Upload text files into the repository: one or more files, or ZIP
+    archives and tarballs, which are unpacked entry by entry.
+    Existing files with the same path are overwritten.
     Only owner can upload.
     """
     owner = get_object_or_404(User, username=username)
@@ -407,34 +842,31 @@ def upload_file_view(request, username, repo_name):
         return redirect('repository_detail', username=username, repo_name=repo_name)
 
     if request.method == "POST":
-        uploaded_file = request.FILES.get("file")
-        if not uploaded_file:
+        uploaded_files = request.FILES.getlist("files") or request.FILES.getlist("file")
+        if not uploaded_files:
             messages.error(request, "No file selected.")
             return redirect('repository_detail', username=username, repo_name=repo_name)
 
-        # For now, put file at root with its name; no folders
-        file_path = uploaded_file.name
+        # Optional folder to upload into
+        directory = tree.normalize_directory(request.POST.get("directory", ""))
 
-        # Read content as text (assuming UTF‑8 source code / text files)
-        content_bytes = uploaded_file.read()
+        skipped = []
         try:
-            content = content_bytes.decode("utf-8")
-        except UnicodeDecodeError:
-            content = ""  # or you could store binary differently
-
-        # Create RepoFile (or overwrite if same path exists)
-        existing = RepoFile.objects.filter(repository=repo, file_path=file_path).first()
-        if existing:
-            existing.content = content
-            existing.save()
-        else:
-            RepoFile.objects.create(
-                repository=repo,
-                file_path=file_path,
-                content=content,
+            created, updated = uploads.import_files(
+                repo, uploads.accepted_files(uploads.upload_entries(uploaded_files), skipped, directory),
             )
-
-        messages.success(request, f"File '{file_path}' uploaded successfully.")
+        except uploads.UploadError as e:
+            messages.error(request, f"Upload failed: {e}")
+            return redirect('upload_file', username=username, repo_name=repo_name)
+
+        if created or updated:
+            messages.success(request, f"Uploaded {created + updated} file(s): {created} new, {updated} updated.")
+        if skipped:
+            shown = ", ".join(f"{path} ({reason})" for path, reason in skipped[:10])
+            more = f" and {len(skipped) - 10} more" if len(skipped) > 10 else ""
+            messages.warning(request, f"Skipped {len(skipped)} file(s): {shown}{more}.")
+        if not (created or updated or skipped):
+            messages.error(request, "The upload did not contain any files.")
         return redirect('repository_detail', username=username, repo_name=repo_name)
 
     # For GET, a simple upload page
@@ -0,0 +1,204 @@
+# shared/mailqueue.py
+
+"""
+Background delivery of outgoing email.
+
+send_mail() puts the message on an in-process queue and returns at once; a
+single worker thread per process delivers the queue over one SMTP
+connection, which stays open between messages and is closed after
+EMAIL_QUEUE_IDLE_CLOSE seconds without mail.
+
+A message that fails with a temporary error (network, timeouts, 4xx
+answers) is retried after EMAIL_QUEUE_RETRY_DELAY seconds, doubling with
+every attempt. Messages that fail permanently (5xx answers, refused
+recipients) or EMAIL_QUEUE_MAX_ATTEMPTS times are appended to the
+dead-letter file EMAIL_DEAD_LETTER_FILE as JSON lines. Each line holds the
+subject, sender, recipients, attempts and last error, but not the body,
+which may carry one-time codes.
+
+The queue lives in memory: mail still queued when the process is killed
+is lost. On a normal exit the worker gets EMAIL_QUEUE_SHUTDOWN_TIMEOUT
+seconds to finish.
+"""
+
+import atexit
+import heapq
+import itertools
+import json
+import queue
+import random
+import smtplib
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+
+def is_permanent(error):
+    """True for SMTP errors that retrying will not fix."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+class MailQueue:
+    """
+    Delivers queued EmailMessages from a worker thread, reusing one
+    connection from connection_factory.
+    """
+
+    def __init__(self, connection_factory=get_connection, max_size=1000, max_attempts=5,
+                 retry_delay=2.0, retry_max_delay=300.0, idle_close=30.0, dead_letter_file=None):
+        self.connection_factory = connection_factory
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.idle_close = idle_close
+        self.dead_letter_file = dead_letter_file
+
+        self._queue = queue.Queue(max_size)
+        self._retries = [] # Heap of (due, sequence, message, attempts); worker thread only
+        self._sequence = itertools.count()
+        self._connection = None
+        self._pending = 0
+        self._pending_changed = threading.Condition()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self.delivered = 0
+        self.failed = 0
+
+    def enqueue(self, message):
+        """
+        Queue an EmailMessage for delivery. Returns False without queueing it
+        when the queue is full.
+        """
+        with self._pending_changed:
+            self._pending += 1
+        try:
+            self._queue.put_nowait((message, 0))
+        except queue.Full:
+            self._done()
+            return False
+        self._ensure_worker()
+        return True
+
+    def flush(self, timeout=None):
+        """Wait until every queued message was delivered or given up on."""
+        with self._pending_changed:
+            return self._pending_changed.wait_for(lambda: self._pending == 0, timeout)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _done(self):
+        with self._pending_changed:
+            self._pending -= 1
+            self._pending_changed.notify_all()
+
+    def _ensure_worker(self):
+        if self._worker is None:
+            with self._worker_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name='mail-queue', daemon=True)
+                    self._worker.start()
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            if self._retries and self._retries[0][0] <= now:
+                _, _, message, attempts = heapq.heappop(self._retries)
+            else:
+                # Sleep until the next message, the next retry is due, or it
+                # is time to close the idle connection
+                timeout = self.idle_close
+                if self._retries:
+                    timeout = min(timeout, self._retries[0][0] - now)
+                try:
+                    message, attempts = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    if timeout == self.idle_close:
+                        self._close()
+                    continue
+            self._deliver(message, attempts)
+
+    def _deliver(self, message, attempts):
+        attempts += 1
+        try:
+            if self._connection is None:
+                self._connection = self.connection_factory(fail_silently=False)
+                self._connection.open()
+            self._connection.send_messages([message])
+        except Exception as error:
+            # The connection may be half-broken; start over with a new one
+            self._close()
+            if is_permanent(error) or attempts >= self.max_attempts:
+                self.failed += 1
+                self._dead_letter(message, attempts, error)
+                self._done()
+                return
+            delay = min(self.retry_max_delay, self.retry_delay * 2 ** (attempts - 1))
+            due = time.monotonic() + delay * random.uniform(0.8, 1.2)
+            heapq.heappush(self._retries, (due, next(self._sequence), message, attempts))
+            return
+        self.delivered += 1
+        self._done()
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass # Closing a dead connection
+            self._connection = None
+
+    def _dead_letter(self, message, attempts, error):
+        if not self.dead_letter_file:
+            return
+        record = {
+            'time': datetime.now(timezone.utc).isoformat(),
+            'subject': message.subject,
+            'from': message.from_email,
+            'to': list(message.recipients()),
+            'attempts': attempts,
+            'error': f'{type(error).__name__}: {error}',
+        }
+        try:
+            with open(self.dead_letter_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+        except OSError:
+            pass # Nowhere left to report it
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """The process-wide MailQueue configured from settings."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = MailQueue(
+                    max_size=settings.EMAIL_QUEUE_MAX_SIZE,
+                    max_attempts=settings.EMAIL_QUEUE_MAX_ATTEMPTS,
+                    retry_delay=settings.EMAIL_QUEUE_RETRY_DELAY,
+                    retry_max_delay=settings.EMAIL_QUEUE_RETRY_MAX_DELAY,
+                    idle_close=settings.EMAIL_QUEUE_IDLE_CLOSE,
+                    dead_letter_file=settings.EMAIL_DEAD_LETTER_FILE,
+                )
+                atexit.register(_queue.flush, settings.EMAIL_QUEUE_SHUTDOWN_TIMEOUT)
+    return _queue
+
+
+def send_mail(subject, message, from_email, recipient_list):
+    """
+    Like django.core.mail.send_mail, but delivered in the background.
+    When the queue is full the message is sent right away instead.
+    """
+    email = EmailMessage(subject, message, from_email, recipient_list)
+    if not get_queue().enqueue(email):
+        email.send(fail_silently=False)
@@ -0,0 +1,351 @@
+# shared/metrics.py
+
+"""
+Request metrics in the Prometheus text format.
+
+MetricsMiddleware times every request and counts the database queries it
+runs, per view (the URL pattern name, so /blob/1/ and /blob/2/ are one
+series). Hot sections report named spans: 'exec' and 'savefig' from the
+execution workers, 'zip' while a repository archive is built, 'highlight'
+for Pygments and 'firebase' for the sign-in round trip. Everything is
+exported at /metrics, and each response carries a Server-Timing header
+with its own database time and spans, which browsers show in the network
+panel.
+
+A jump in the codehub_request_queries histogram of one view is the mark of
+an N+1 query; the span histograms show which part of a slow run took the
+time.
+
+Metrics are kept in the memory of each process. With several server
+processes, every scrape sees the process that happens to answer it; give
+each process its own address to scrape, or run one process per container.
+Work done while a streaming response is sent (a ZIP download, run-code
+streams) is counted in the span histograms, but not in the request's
+duration, query counts or Server-Timing header, which are settled when the
+view returns.
+"""
+
+import bisect
+import contextlib
+import contextvars
+import math
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A count per combination of label values that only goes up."""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            yield f'{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}'
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, with their sum and count."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {} # labelvalues -> [per-bucket counts (last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, *labelvalues):
+        entry = self._values.get(labelvalues)
+        return sum(entry[0]) if entry else 0
+
+    def total(self, *labelvalues):
+        entry = self._values.get(labelvalues)
+        return entry[1] if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = [(labelvalues, list(counts), total) for labelvalues, (counts, total) in self._values.items()]
+        for labelvalues, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f'{self.name}_bucket{_labels(self.labelnames, labelvalues, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labelvalues)} {_number(float(total))}'
+            yield f'{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}'
+
+
+class Registry:
+    """
+    The metrics of a process. Collectors are callables run at every scrape
+    that return further (kind, name, documentation, [(labels, value)]) for
+    numbers kept elsewhere, such as the execution pool's cache statistics.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, function):
+        self._collectors.append(function)
+        return function
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        for collect in self._collectors:
+            for kind, name, documentation, samples in collect():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_labels(labels.keys(), labels.values())} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    'codehub_requests_total', 'Requests answered, by view, method and status code.',
+    ('view', 'method', 'status'),
+))
+REQUEST_DURATION = registry.register(Histogram(
+    'codehub_request_duration_seconds', 'Time until the view returned a response.',
+    ('view', 'method'),
+))
+REQUEST_QUERIES = registry.register(Histogram(
+    'codehub_request_queries', 'Database queries run per request.',
+    ('view',), buckets=QUERY_BUCKETS,
+))
+REQUEST_QUERY_DURATION = registry.register(Histogram(
+    'codehub_request_query_duration_seconds', 'Time spent in database queries per request.',
+    ('view',),
+))
+SPAN_DURATION = registry.register(Histogram(
+    'codehub_span_duration_seconds', 'Time spent in named hot sections (exec, savefig, zip, ...).',
+    ('span',),
+))
+
+
+@registry.collector
+def _code_cache():
+    # Only report on a pool that is already running; a scrape must not start one
+    from core import executor
+
+    pool = executor._pool
+    if pool is None:
+        return []
+    stats = pool.code_cache_stats()
+    return [
+        ('counter', 'codehub_code_cache_hits_total', 'Runs that reused compiled code.', [({}, stats['hits'])]),
+        ('counter', 'codehub_code_cache_misses_total', 'Runs that had to compile their code.', [({}, stats['misses'])]),
+    ]
+
+
+# --- PER-REQUEST TIMINGS ---
+
+class RequestTimings:
+    """What one request spent its time on, for the Server-Timing header."""
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.spans = {} # name -> seconds, summed over repeats
+
+    def add_span(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+
+# Copied into the threads sync_to_async runs views in, so queries made
+# there are counted for the request that started them
+_current = contextvars.ContextVar('codehub_request_timings', default=None)
+
+
+def record_span(name, seconds):
+    """Count seconds spent in a named section, e.g. measured in a worker process."""
+    SPAN_DURATION.observe(seconds, name)
+    timings = _current.get()
+    if timings is not None:
+        timings.add_span(name, seconds)
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Time a block, or a function when used as a decorator, as a named span:
+
+        with metrics.span('zip'):
+            ...
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+
+def timed_iter(name, iterable):
+    """
+    Iterate over iterable, recording the time spent producing its items as
+    one span. Time spent by the consumer between items (e.g. a slow client
+    reading a download) is not counted.
+    """
+    elapsed = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - started
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+        record_span(name, elapsed)
+
+
+def _count_query(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.queries += 1
+        timings.query_time += time.perf_counter() - started
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """connection_created receiver: count the queries of every new connection."""
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+# --- MIDDLEWARE ---
+
+def _view_name(request):
+    # The URL name, or the dotted path of views without one
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+def server_timing(timings, total):
+    """The Server-Timing header value for one request."""
+    entries = [f'db;dur={timings.query_time * 1000:.1f};desc="{timings.queries} queries"']
+    entries.extend(f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.spans.items())
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+
+class MetricsMiddleware:
+    """
+    Records the duration, status and database queries of every request
+    and adds the Server-Timing header. Goes first in MIDDLEWARE, so the
+    time of the other middleware is included. Works under WSGI and ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._record(request, response, timings, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.METRICS_ENABLED:
+            return await self.get_response(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._record(request, response, timings, time.perf_counter() - started)
+        return response
+
+    def _record(self, request, response, timings, total):
+        view = _view_name(request)
+        method = request.method if request.method in METHODS else 'other'
+        REQUESTS.inc(view, method, str(response.status_code))
+        REQUEST_DURATION.observe(total, view, method)
+        REQUEST_QUERIES.observe(timings.queries, view)
+        REQUEST_QUERY_DURATION.observe(timings.query_time, view)
+        if settings.METRICS_SERVER_TIMING:
+            response['Server-Timing'] = server_timing(timings, total)
@@ -0,0 +1,65 @@
+# shared/pagination.py
+
+"""
+Keyset (cursor) pagination for lists ordered newest first.
+
+Instead of OFFSET, each page continues after the (updated_at, id) of the
+last row of the previous page, passed around as an opaque cursor. Every
+page costs the same however deep the client has scrolled, and rows that are
+updated in the meantime do not shift the following pages.
+"""
+
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+
+def encode_cursor(obj, field='updated_at'):
+    """Opaque cursor pointing just after obj."""
+    raw = f'{getattr(obj, field).isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Return (timestamp, pk) from a cursor, or None for a missing or
+    malformed one.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        timestamp, pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(pk)
+    except ValueError:
+        return None
+
+
+def after_cursor(queryset, cursor, field='updated_at'):
+    """
+    Order queryset newest first and skip everything up to cursor.
+    """
+    queryset = queryset.order_by(f'-{field}', '-pk')
+    position = decode_cursor(cursor)
+    if position is not None:
+        timestamp, pk = position
+        queryset = queryset.filter(
+            Q(**{f'{field}__lt': timestamp}) | Q(**{field: timestamp, 'pk__lt': pk})
+        )
+    return queryset
+
+
+def keyset_page(queryset, cursor, per_page, field='updated_at'):
+    """
+    Return (rows, next_cursor) for the page of queryset after cursor,
+    newest first. next_cursor is None on the last page.
+    """
+    queryset = after_cursor(queryset, cursor, field)
+
+    # One extra row tells whether another page follows
+    rows = list(queryset[:per_page + 1])
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    return rows, encode_cursor(rows[-1], field)
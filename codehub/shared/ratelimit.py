@@ -0,0 +1,264 @@
+# shared/ratelimit.py
+
+"""
+Rate limiting with token buckets.
+
+Each limited scope (e.g. 'otp-send') has a rate such as '5/m': a bucket of
+5 tokens per client that refills at 5 tokens a minute, so short bursts
+pass and sustained floods are cut down to the rate. Clients are told apart
+by a key function ('ip', 'user', 'user_or_ip' or any callable taking the
+request), so one abusive client only empties its own bucket.
+
+Limits are applied with the @ratelimit decorator on a view, or by
+RateLimitMiddleware for the path patterns in RATELIMIT_RULES. Rates are
+looked up in RATELIMIT_RATES by scope when a request comes in; a scope
+without a rate is not limited. A limited request gets a 429 with a
+Retry-After header.
+
+Buckets live in the process (RATELIMIT_BACKEND = 'local') or in a Django
+cache shared by all processes ('cache', using RATELIMIT_CACHE), or in any
+backend class given by dotted path.
+"""
+
+import functools
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from django.utils.module_loading import import_string
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+RATE_RE = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*([smhd])\s*$')
+
+
+class InvalidRate(ValueError):
+    """Raised for a rate that is not '<count>/<period>', e.g. '10/m' or '100/5m'."""
+
+
+@functools.lru_cache(maxsize=None)
+def parse_rate(rate):
+    """Return (capacity, tokens_per_second) for a rate like '10/m' or '100/5m'."""
+    match = RATE_RE.match(rate)
+    if not match or int(match.group(1)) == 0:
+        raise InvalidRate(f"Invalid rate {rate!r}; expected e.g. '10/m' or '100/5m'.")
+    count, multiplier, unit = match.groups()
+    period = int(multiplier or 1) * PERIODS[unit]
+    return int(count), int(count) / period
+
+
+def _take(tokens, updated, now, capacity, refill):
+    """
+    Refill a bucket up to now and try to take one token. Returns
+    (allowed, tokens_left, retry_after_seconds).
+    """
+    tokens = min(capacity, tokens + (now - updated) * refill)
+    if tokens >= 1:
+        return True, tokens - 1, 0.0
+    return False, tokens, (1 - tokens) / refill
+
+
+class LocalBackend:
+    """Buckets in this process's memory; the least recently used are dropped first."""
+
+    def __init__(self, max_keys=100_000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, capacity, refill):
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            allowed, tokens, retry_after = _take(tokens, updated, now, capacity, refill)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+
+class CacheBackend:
+    """
+    Buckets in a Django cache shared by every process (Redis, Memcached,
+    database). A short-lived lock key taken with cache.add() keeps
+    concurrent requests for the same bucket from both spending the last
+    token. Requests that cannot get the lock quickly are refused: only a
+    client sending many requests at once contends for its own bucket.
+    """
+
+    LOCK_ATTEMPTS = 5
+
+    def __init__(self, alias='default', clock=time.time):
+        self.alias = alias
+        self.clock = clock
+
+    def hit(self, key, capacity, refill):
+        cache = caches[self.alias]
+        bucket_key = f'ratelimit:{key}'
+        lock_key = f'{bucket_key}:lock'
+        for attempt in range(self.LOCK_ATTEMPTS):
+            if cache.add(lock_key, 1, timeout=2):
+                break
+            time.sleep(0.002 * (attempt + 1))
+        else:
+            return False, 1.0
+
+        try:
+            now = self.clock()
+            tokens, updated = cache.get(bucket_key) or (capacity, now)
+            allowed, tokens, retry_after = _take(tokens, updated, now, capacity, refill)
+            # An untouched bucket is full again after capacity / refill seconds
+            cache.set(bucket_key, (tokens, now), timeout=math.ceil(capacity / refill) + 1)
+        finally:
+            cache.delete(lock_key)
+        return allowed, retry_after
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """The backend configured by RATELIMIT_BACKEND."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = settings.RATELIMIT_BACKEND
+                if name == 'local':
+                    _backend = LocalBackend()
+                elif name == 'cache':
+                    _backend = CacheBackend(settings.RATELIMIT_CACHE)
+                else:
+                    _backend = import_string(name)()
+    return _backend
+
+
+def client_ip(request):
+    """
+    The client address. Behind RATELIMIT_PROXY_HOPS trusted proxies, it is
+    the entry of RATELIMIT_IP_HEADER that the outermost proxy appended,
+    counted from the right: entries further left come from the client and
+    can be anything. Without a header, or with fewer entries than proxies,
+    it is REMOTE_ADDR.
+    """
+    header = settings.RATELIMIT_IP_HEADER
+    hops = settings.RATELIMIT_PROXY_HOPS
+    if header and hops > 0:
+        forwarded = [entry.strip() for entry in request.META.get(header, '').split(',') if entry.strip()]
+        if len(forwarded) >= hops:
+            return forwarded[-hops]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def _user_key(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return None
+
+
+KEYS = {
+    'ip': lambda request: f'ip:{client_ip(request)}',
+    'user': _user_key,
+    'user_or_ip': lambda request: _user_key(request) or f'ip:{client_ip(request)}',
+}
+
+
+def check(request, scope, key='ip', rate=None):
+    """
+    Count a request against scope. Returns None if it may go ahead, or the
+    number of seconds until the client may retry.
+    """
+    if not settings.RATELIMIT_ENABLED:
+        return None
+    rate = rate or settings.RATELIMIT_RATES.get(scope)
+    if not rate:
+        return None
+    value = (KEYS[key] if isinstance(key, str) else key)(request)
+    if not value:
+        return None # Nothing to tell this client apart by, e.g. 'user' when logged out
+    capacity, refill = parse_rate(rate)
+    allowed, retry_after = get_backend().hit(f'{scope}:{value}', capacity, refill)
+    return None if allowed else retry_after
+
+
+def too_many_requests(retry_after):
+    """The 429 response for a limited request."""
+    response = JsonResponse(
+        {'success': False, 'error': 'Too many requests', 'message': 'Too many requests. Please try again later.'},
+        status=429,
+    )
+    response['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def ratelimit(scope, key='ip', rate=None, methods=('POST',)):
+    """
+    Limit a view to the rate of scope (from RATELIMIT_RATES unless given),
+    per client as told apart by key. Only the listed methods count; pass
+    methods=None to count every request. Stack several for several limits.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if methods is None or request.method in methods:
+                retry_after = check(request, scope, key, rate)
+                if retry_after is not None:
+                    return too_many_requests(retry_after)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class RateLimitMiddleware:
+    """
+    Applies RATELIMIT_RULES: (path regex, scope, key, methods) tuples,
+    checked in order; every matching rule counts. Must come after
+    AuthenticationMiddleware for user keys. Works under WSGI and ASGI;
+    requests that match no rule pass straight through.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.rules = [
+            (re.compile(pattern), scope, key, methods)
+            for pattern, scope, key, methods in settings.RATELIMIT_RULES
+        ]
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _matching(self, request):
+        return [
+            (scope, key) for pattern, scope, key, methods in self.rules
+            if (methods is None or request.method in methods) and pattern.match(request.path_info)
+        ]
+
+    def _limit(self, request, rules):
+        """The 429 response if any rule refuses the request, else None."""
+        for scope, key in rules:
+            retry_after = check(request, scope, key)
+            if retry_after is not None:
+                return too_many_requests(retry_after)
+        return None
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        rules = self._matching(request)
+        limited = self._limit(request, rules) if rules else None
+        return limited or self.get_response(request)
+
+    async def __acall__(self, request):
+        rules = self._matching(request)
+        # Backends (and request.user) may block, so they run in a thread
+        limited = await sync_to_async(self._limit)(request, rules) if rules else None
+        return limited or await self.get_response(request)
@@ -0,0 +1,41 @@
+# shared/streaming.py
+
+"""
+Helpers for streaming responses that work under both WSGI and ASGI.
+
+Django buffers a synchronous iterator completely before sending it under
+ASGI, so views that stream hand their iterator to streaming_response(),
+which drives it from the event loop one chunk at a time instead.
+"""
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+
+async def _async_stream(iterator):
+    """
+    Drive a blocking iterator from the ASGI event loop one chunk at a time,
+    so the next chunk is only produced once the previous one was sent.
+    The iterator runs in the request's own sync thread, so it may use the ORM.
+    """
+    next_chunk = sync_to_async(next)
+    finished = object()
+    try:
+        while (chunk := await next_chunk(iterator, finished)) is not finished:
+            yield chunk
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await sync_to_async(close)()
+
+
+def streaming_response(request, iterator, content_type):
+    """
+    Wrap a generator of bytes in a StreamingHttpResponse suited to the
+    server the request came through.
+    """
+    iterator = iter(iterator)
+    if isinstance(request, ASGIRequest):
+        return StreamingHttpResponse(_async_stream(iterator), content_type=content_type)
+    return StreamingHttpResponse(iterator, content_type=content_type)
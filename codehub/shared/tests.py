@@ -1,3 +1,305 @@
-from django.test import TestCase
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.mail import EmailMessage, get_connection
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from . import metrics, ratelimit
+from .mailqueue import MailQueue
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib, with scripted answers to MAIL FROM."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 stub ESMTP')
+        while line := self.rfile.readline():
+            command = line.decode().strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 stub')
+            elif command.startswith('MAIL'):
+                with server.lock:
+                    self.reply(server.mail_replies.pop(0) if server.mail_replies else '250 OK')
+            elif command.startswith('RCPT'):
+                self.reply(server.rcpt_reply)
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while (line := self.rfile.readline()) not in (b'.\r\n', b''):
+                    data.append(line)
+                time.sleep(server.data_delay)
+                with server.lock:
+                    server.messages.append(b''.join(data).decode())
+                self.reply('250 Queued')
+            elif command in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Not implemented')
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mail_replies=(), rcpt_reply='250 OK', data_delay=0):
+        super().__init__(('127.0.0.1', 0), StubSMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+        self.mail_replies = list(mail_replies)
+        self.rcpt_reply = rcpt_reply
+        self.data_delay = data_delay
+
+
+class MailQueueTests(SimpleTestCase):
+
+    def start_stub(self, **options):
+        server = StubSMTPServer(**options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def make_queue(self, server, **options):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dead_letter_file = os.path.join(directory.name, 'dead-letter.jsonl')
+
+        def connection_factory(**kwargs):
+            return get_connection(
+                'django.core.mail.backends.smtp.EmailBackend',
+                host='127.0.0.1', port=server.server_address[1], username='', password='',
+                use_tls=False, timeout=2, **kwargs,
+            )
+
+        options.setdefault('retry_delay', 0.05)
+        return MailQueue(connection_factory, dead_letter_file=self.dead_letter_file, **options)
+
+    def message(self, number=1):
+        return EmailMessage(f'Code {number}', f'Your code is {number}', 'noreply@example.com', ['a@example.com'])
+
+    def dead_letters(self):
+        if not os.path.exists(self.dead_letter_file):
+            return []
+        with open(self.dead_letter_file, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_delivers_over_one_connection(self):
+        server = self.start_stub()
+        mail = self.make_queue(server)
+        for number in range(3):
+            self.assertTrue(mail.enqueue(self.message(number)))
+        self.assertTrue(mail.flush(5))
+        self.assertEqual(len(server.messages), 3)
+        self.assertIn('Your code is 2', server.messages[2])
+        self.assertEqual(server.connections, 1)
+
+    def test_enqueue_does_not_wait_for_smtp(self):
+        server = self.start_stub(data_delay=0.5)
+        mail = self.make_queue(server)
+        started = time.monotonic()
+        mail.enqueue(self.message())
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertTrue(mail.flush(5))
+        self.assertEqual(mail.delivered, 1)
+
+    def test_temporary_failures_are_retried(self):
+        server = self.start_stub(mail_replies=['451 Try again later', '421 Too busy'])
+        mail = self.make_queue(server)
+        mail.enqueue(self.message())
+        self.assertTrue(mail.flush(5))
+        self.assertEqual(len(server.messages), 1)
+        self.assertEqual(mail.delivered, 1)
+        self.assertEqual(self.dead_letters(), [])
+
+    def test_permanent_failure_is_dead_lettered(self):
+        server = self.start_stub(rcpt_reply='550 No such user')
+        mail = self.make_queue(server)
+        mail.enqueue(self.message())
+        self.assertTrue(mail.flush(5))
+        [record] = self.dead_letters()
+        self.assertEqual(record['attempts'], 1)
+        self.assertEqual(record['to'], ['a@example.com'])
+        self.assertIn('SMTPRecipientsRefused', record['error'])
+        self.assertNotIn('body', record)
+
+    def test_gives_up_after_max_attempts(self):
+        server = self.start_stub(mail_replies=['451 Try again later'] * 10)
+        mail = self.make_queue(server, max_attempts=3)
+        mail.enqueue(self.message())
+        self.assertTrue(mail.flush(5))
+        self.assertEqual(mail.failed, 1)
+        self.assertEqual(self.dead_letters()[0]['attempts'], 3)
+
+    def test_unreachable_server(self):
+        server = self.start_stub()
+        mail = self.make_queue(server, max_attempts=2)
+        server.shutdown()
+        server.server_close()
+        mail.enqueue(self.message())
+        self.assertTrue(mail.flush(5))
+        self.assertEqual(self.dead_letters()[0]['attempts'], 2)
+
+    def test_full_queue_refuses(self):
+        server = self.start_stub(data_delay=0.3)
+        mail = self.make_queue(server, max_size=1)
+        results = [mail.enqueue(self.message(number)) for number in range(3)]
+        self.assertIn(False, results)
+        self.assertTrue(mail.flush(5))
+        self.assertEqual(len(server.messages), results.count(True))
+
+
+class RateLimitTests(SimpleTestCase):
+
+    def setUp(self):
+        ratelimit._backend = None
+        self.addCleanup(setattr, ratelimit, '_backend', None)
+        self.factory = RequestFactory()
+
+    def test_parse_rate(self):
+        self.assertEqual(ratelimit.parse_rate('10/m'), (10, 10 / 60))
+        self.assertEqual(ratelimit.parse_rate('100/5m'), (100, 100 / 300))
+        for rate in ('10', '0/m', '10/w', 'ten/m'):
+            with self.assertRaises(ratelimit.InvalidRate):
+                ratelimit.parse_rate(rate)
+
+    def test_bucket_refills(self):
+        now = [0.0]
+        backend = ratelimit.LocalBackend(clock=lambda: now[0])
+        capacity, refill = ratelimit.parse_rate('3/m')
+        self.assertEqual([backend.hit('k', capacity, refill)[0] for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(backend.hit('k', capacity, refill)[1], 20)
+        now[0] = 20
+        self.assertTrue(backend.hit('k', capacity, refill)[0])
+        self.assertFalse(backend.hit('k', capacity, refill)[0])
+        self.assertTrue(backend.hit('other', capacity, refill)[0])
+
+    def test_cache_backend(self):
+        backend = ratelimit.CacheBackend('default')
+        capacity, refill = ratelimit.parse_rate('2/h')
+        results = [backend.hit('cache-test', capacity, refill) for _ in range(3)]
+        self.assertEqual([allowed for allowed, _ in results], [True, True, False])
+        self.assertGreater(results[2][1], 1000)
+
+    @override_settings(RATELIMIT_RATES={'test': '2/m'})
+    def test_decorator(self):
+        view = ratelimit.ratelimit('test', key='ip')(lambda request: HttpResponse('ok'))
+        statuses = [view(self.factory.post('/', REMOTE_ADDR='10.0.0.1')).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(view(self.factory.get('/', REMOTE_ADDR='10.0.0.1')).status_code, 200)
+        self.assertEqual(view(self.factory.post('/', REMOTE_ADDR='10.0.0.2')).status_code, 200)
+
+        response = view(self.factory.post('/', REMOTE_ADDR='10.0.0.1'))
+        self.assertEqual(response['Retry-After'], '30')
+
+    @override_settings(RATELIMIT_RATES={'test': '1/m'}, RATELIMIT_RULES=[(r'^/api/', 'test', 'ip', None)])
+    def test_middleware(self):
+        middleware = ratelimit.RateLimitMiddleware(lambda request: HttpResponse('ok'))
+        self.assertEqual(middleware(self.factory.get('/api/x')).status_code, 200)
+        self.assertEqual(middleware(self.factory.get('/api/x')).status_code, 429)
+        self.assertEqual(middleware(self.factory.get('/other')).status_code, 200)
+
+    @override_settings(RATELIMIT_IP_HEADER='HTTP_X_FORWARDED_FOR', RATELIMIT_PROXY_HOPS=1)
+    def test_client_ip_ignores_spoofed_entries(self):
+        def client_ip(forwarded, **extra):
+            return ratelimit.client_ip(self.factory.get('/', HTTP_X_FORWARDED_FOR=forwarded, **extra))
+
+        # The proxy appends the address it saw to whatever the client sent
+        self.assertEqual(client_ip('203.0.113.7'), '203.0.113.7')
+        self.assertEqual(client_ip('127.0.0.1, 203.0.113.7'), '203.0.113.7')
+        with override_settings(RATELIMIT_PROXY_HOPS=2):
+            self.assertEqual(client_ip('1.2.3.4, 203.0.113.7, 10.0.0.2'), '203.0.113.7')
+            self.assertEqual(client_ip('203.0.113.7', REMOTE_ADDR='10.0.0.3'), '10.0.0.3')
+
+    @override_settings(
+        RATELIMIT_IP_HEADER='HTTP_X_FORWARDED_FOR', RATELIMIT_RATES={'test': '2/m'},
+    )
+    def test_spoofed_header_does_not_reset_the_bucket(self):
+        view = ratelimit.ratelimit('test', key='ip')(lambda request: HttpResponse('ok'))
+        statuses = [
+            view(self.factory.post('/', HTTP_X_FORWARDED_FOR=f'10.9.9.{number}, 203.0.113.7')).status_code
+            for number in range(3)
+        ]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    @override_settings(RATELIMIT_ENABLED=False, RATELIMIT_RATES={'test': '1/m'})
+    def test_disabled(self):
+        view = ratelimit.ratelimit('test')(lambda request: HttpResponse('ok'))
+        self.assertEqual([view(self.factory.post('/')).status_code for _ in range(3)], [200, 200, 200])
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_histogram_rendering(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('view',), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, 'a"b')
+        self.assertEqual(list(histogram.samples()), [
+            'test_seconds_bucket{view="a\\"b",le="0.1"} 1',
+            'test_seconds_bucket{view="a\\"b",le="1"} 2',
+            'test_seconds_bucket{view="a\\"b",le="+Inf"} 3',
+            'test_seconds_sum{view="a\\"b"} 5.55',
+            'test_seconds_count{view="a\\"b"} 3',
+        ])
+
+    def test_middleware_counts_queries_and_spans(self):
+        def view(request):
+            for _ in range(3):
+                User.objects.count()
+            with metrics.span('test-span'):
+                pass
+            return HttpResponse('ok')
+
+        before = metrics.REQUEST_QUERIES.count('unmatched')
+        response = metrics.MetricsMiddleware(view)(self.factory.get('/'))
+        timing = response['Server-Timing']
+        self.assertIn('desc="3 queries"', timing)
+        self.assertIn('test-span;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        self.assertEqual(metrics.REQUEST_QUERIES.count('unmatched'), before + 1)
+        self.assertGreaterEqual(metrics.REQUESTS.value('unmatched', 'GET', '200'), 1)
+
+    def test_timed_iter_leaves_out_the_consumer(self):
+        count, total = metrics.SPAN_DURATION.count('test-iter'), metrics.SPAN_DURATION.total('test-iter')
+        for _ in metrics.timed_iter('test-iter', range(3)):
+            time.sleep(0.05)
+        self.assertEqual(metrics.SPAN_DURATION.count('test-iter'), count + 1)
+        self.assertLess(metrics.SPAN_DURATION.total('test-iter') - total, 0.05)
+
+    def test_metrics_endpoint(self):
+        self.client.get('/')
+        response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('codehub_requests_total{view="index",method="GET",status="200"}', response.content.decode())
+        self.assertIn('Server-Timing', response)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 404)
+
+        # A forged X-Forwarded-For is ignored directly and behind a proxy
+        forged = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': '127.0.0.1'}
+        self.assertEqual(self.client.get('/metrics', **forged).status_code, 404)
+        with override_settings(RATELIMIT_IP_HEADER='HTTP_X_FORWARDED_FOR'):
+            response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1', HTTP_X_FORWARDED_FOR='127.0.0.1, 203.0.113.7')
+            self.assertEqual(response.status_code, 404)
+
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+            response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
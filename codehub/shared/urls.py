@@ -5,4 +5,5 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
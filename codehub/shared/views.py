@@ -1,5 +1,12 @@
+import hmac
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
 from django.shortcuts import render, redirect
 
+from . import metrics
+from .ratelimit import client_ip
+
 # Create your views here.
 def index(request):
     """
@@ -11,3 +18,21 @@ def index(request):
     
     # If the user is not logged in, show the normal homepage
     return render(request, 'index.html')
+
+def metrics_view(request):
+    """
+    Serves the metrics of this process in the Prometheus text format.
+    Needs the METRICS_TOKEN bearer token when one is set, otherwise a
+    request from METRICS_ALLOWED_IPS; anyone else gets a 404.
+    """
+    if settings.METRICS_TOKEN:
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        allowed = scheme.lower() == 'bearer' and hmac.compare_digest(
+            token.strip().encode(), settings.METRICS_TOKEN.encode(),
+        )
+    else:
+        allowed = client_ip(request) in settings.METRICS_ALLOWED_IPS
+    if not allowed:
+        raise Http404()
+
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')